@@ -0,0 +1,330 @@
+"""Benchmarks for the monodepth hot paths.
+"""
+
+from __future__ import division
+
+import argparse
+import json
+import numpy as np
+import sys
+import tensorflow as tf
+import tensorflow.contrib.slim as slim
+
+from monodepth_model import *
+from monodepth_utils import benchmark_params, count_flops, load_images, parse_resolutions, time_run
+from bilinear_sampler import bilinear_sample
+from spherical import cubic_to_equirectangular, equirectangular_to_cubic, face_map
+from training_monitor import peak_memory_bytes
+
+def reference_SSIM(x, y):
+    # SSIM with one pooling call per moment, as used before the fused implementation.
+    C1 = 0.01 ** 2
+    C2 = 0.03 ** 2
+
+    mu_x = slim.avg_pool2d(x, 3, 1, 'VALID')
+    mu_y = slim.avg_pool2d(y, 3, 1, 'VALID')
+
+    sigma_x  = slim.avg_pool2d(x ** 2, 3, 1, 'VALID') - mu_x ** 2
+    sigma_y  = slim.avg_pool2d(y ** 2, 3, 1, 'VALID') - mu_y ** 2
+    sigma_xy = slim.avg_pool2d(x * y , 3, 1, 'VALID') - mu_x * mu_y
+
+    SSIM_n = (2 * mu_x * mu_y + C1) * (2 * sigma_xy + C2)
+    SSIM_d = (mu_x ** 2 + mu_y ** 2 + C1) * (sigma_x + sigma_y + C2)
+
+    SSIM = SSIM_n / SSIM_d
+
+    return tf.clip_by_value((1 - SSIM) / 2, 0, 1)
+
+def polar_face_benchmark(batch_size, height, width, num_iterations, checkpoint_path = '', images = None):
+    """Latency and FLOPs of the cubic model for each polar face scale.
+
+    With a checkpoint and images, also reports the mean relative difference of the top depth
+    with the depth predicted with full resolution polar faces.
+    """
+    results = {}
+    reference_depths = None
+    # Only the scales whose polar faces are multiples of the network stride can be built at this width.
+    polar_face_scales = [scale for scale in [1, 2, 4] if (width // 4 // scale) % network_stride == 0]
+    for polar_face_scale in polar_face_scales:
+        params = benchmark_params(height=height, width=width, batch_size=batch_size, polar_face_scale=polar_face_scale)
+        with tf.Graph().as_default() as graph:
+            top = tf.placeholder(tf.float32, [batch_size, height, width, 3])
+            model = MonodepthModel(params, 'test', top, None)
+            depth = model.depth_top_est[0]
+            flops = count_flops(graph)
+
+            session = tf.Session()
+            session.run(tf.global_variables_initializer())
+            if checkpoint_path != '':
+                tf.train.Saver().restore(session, checkpoint_path)
+
+            inputs = np.random.rand(batch_size, height, width, 3)
+            result = {'flops': flops, 'latency': time_run(session, depth, num_iterations, {top: inputs})}
+            if images is not None:
+                depths = np.concatenate([session.run(depth, {top: images[i:i + batch_size]}) for i in range(0, len(images) - batch_size + 1, batch_size)], 0)
+                if reference_depths is None:
+                    reference_depths = depths
+                result['relative_difference'] = float(np.mean(np.abs(depths - reference_depths) / reference_depths))
+            results[polar_face_scale] = result
+            session.close()
+    return results
+
+def count_parameters():
+    return int(sum(np.prod(variable.get_shape().as_list()) for variable in tf.trainable_variables()))
+
+def encoder_benchmark(batch_size, height, width, num_iterations):
+    """Parameters, FLOPs, CPU latency and peak memory of a test forward pass per encoder and projection."""
+    results = []
+    for encoder in ['resnet50', 'vgg', 'mobile']:
+        for projection in ['cubic', 'equirectangular']:
+            params = benchmark_params(height=height, width=width, batch_size=batch_size, encoder=encoder, projection=projection)
+            with tf.Graph().as_default() as graph:
+                top = tf.placeholder(tf.float32, [batch_size, height, width, 3])
+                model = MonodepthModel(params, 'test', top, None)
+                disparity = model.disparity_top_est[0]
+                flops = count_flops(graph)
+
+                config = tf.ConfigProto(device_count = {'GPU': 0})
+                session = tf.Session(config = config)
+                session.run(tf.global_variables_initializer())
+
+                feed_dict = {top: np.random.rand(batch_size, height, width, 3)}
+                latency = time_run(session, disparity, num_iterations, feed_dict)
+
+                run_metadata = tf.RunMetadata()
+                session.run(disparity, feed_dict, options = tf.RunOptions(trace_level = tf.RunOptions.FULL_TRACE), run_metadata = run_metadata)
+
+                results.append({
+                    'encoder': encoder,
+                    'projection': projection,
+                    'parameters': count_parameters(),
+                    'flops': flops,
+                    'latency': latency,
+                    'peak_memory': peak_memory_bytes(run_metadata)
+                })
+                session.close()
+    return results
+
+def ssim_benchmark(batch_size, height, width, num_iterations):
+    """Compares the fused SSIM loss with the per-view, per-moment reference over a four scale pyramid."""
+    model = MonodepthModel.__new__(MonodepthModel)
+    with tf.Graph().as_default():
+        shapes = [[batch_size, height // 2 ** i, width // 2 ** i, 3] for i in range(4)]
+        top_est = [tf.Variable(tf.random_uniform(shape)) for shape in shapes]
+        bottom_est = [tf.Variable(tf.random_uniform(shape)) for shape in shapes]
+        top = [tf.constant(np.random.rand(*shape), tf.float32) for shape in shapes]
+        bottom = [tf.constant(np.random.rand(*shape), tf.float32) for shape in shapes]
+
+        reference_loss = tf.add_n([tf.reduce_mean(reference_SSIM(top_est[i], top[i])) +
+                                   tf.reduce_mean(reference_SSIM(bottom_est[i], bottom[i])) for i in range(4)])
+
+        fused_loss = []
+        for i in range(4):
+            ssim = model.SSIM(tf.concat([top_est[i], bottom_est[i]], 0), tf.concat([top[i], bottom[i]], 0))
+            fused_loss.append(tf.reduce_mean(ssim[:batch_size]) + tf.reduce_mean(ssim[batch_size:]))
+        fused_loss = tf.add_n(fused_loss)
+
+        variables = top_est + bottom_est
+        reference_gradients = tf.gradients(reference_loss, variables)
+        fused_gradients = tf.gradients(fused_loss, variables)
+
+        session = tf.Session()
+        session.run(tf.global_variables_initializer())
+
+        reference_values = session.run([reference_loss] + reference_gradients)
+        fused_values = session.run([fused_loss] + fused_gradients)
+        max_difference = max(np.abs(r - f).max() for r, f in zip(reference_values, fused_values))
+
+        results = {
+            'reference_forward': time_run(session, reference_loss, num_iterations),
+            'fused_forward': time_run(session, fused_loss, num_iterations),
+            'reference_backward': time_run(session, reference_gradients, num_iterations),
+            'fused_backward': time_run(session, fused_gradients, num_iterations),
+            'max_difference': float(max_difference)
+        }
+        session.close()
+    return results
+
+def loss_benchmark(batch_size, height, width, num_iterations, loss_samples, num_estimates = 50):
+    """Compares the dense losses with the uniform and gradient sampled losses.
+
+    Reports forward+backward time and peak memory of the training step and the mean over
+    `num_estimates` draws of each sampled loss against the dense loss of the same weights.
+    """
+    results = {}
+    with tf.Graph().as_default():
+        top = tf.placeholder(tf.float32, [batch_size, height, width, 3])
+        bottom = tf.placeholder(tf.float32, [batch_size, height, width, 3])
+        models = {}
+        for loss_sampling in ['', 'uniform', 'gradient']:
+            params = benchmark_params(height=height, width=width, batch_size=batch_size, loss_sampling=loss_sampling, loss_samples=loss_samples)
+            models[loss_sampling or 'dense'] = MonodepthModel(params, 'train', top, bottom, reuse_variables=len(models) > 0)
+
+        session = tf.Session()
+        session.run(tf.global_variables_initializer())
+        feed_dict = {top: np.random.rand(batch_size, height, width, 3), bottom: np.random.rand(batch_size, height, width, 3)}
+        for name, model in models.items():
+            gradients = tf.gradients(model.total_loss, tf.trainable_variables())
+            run_metadata = tf.RunMetadata()
+            session.run(gradients, feed_dict, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+            losses = model.image_loss + model.tb_loss
+            results[name] = {
+                'latency': time_run(session, gradients, num_iterations, feed_dict),
+                'peak_memory': peak_memory_bytes(run_metadata),
+                'loss': float(np.mean([session.run(losses, feed_dict) for _ in range(num_estimates if name != 'dense' else 1)]))
+            }
+        session.close()
+    return results
+
+def measure(session, fetches, feed_dict, batch_size, num_iterations):
+    """Latency, throughput in images per second and peak memory of session.run(fetches)."""
+    latency = time_run(session, fetches, num_iterations, feed_dict)
+    run_metadata = tf.RunMetadata()
+    session.run(fetches, feed_dict, options = tf.RunOptions(trace_level = tf.RunOptions.FULL_TRACE), run_metadata = run_metadata)
+    return {'latency': latency, 'throughput': batch_size / latency, 'peak_memory': peak_memory_bytes(run_metadata)}
+
+def suite_case(name, batch_size, height, width):
+    """Builds the graph of a suite case and returns its fetches and feed dict."""
+    face_size = width // 4
+    top = tf.placeholder(tf.float32, [batch_size, height, width, 3])
+    feed_dict = {top: np.random.rand(batch_size, height, width, 3)}
+
+    if name == 'equirectangular_to_cubic':
+        return equirectangular_to_cubic(top, [face_size, face_size]), feed_dict
+    elif name == 'cubic_to_equirectangular':
+        faces = [tf.placeholder(tf.float32, [batch_size, face_size, face_size, 3]) for _ in face_map]
+        feed_dict = dict((face, np.random.rand(batch_size, face_size, face_size, 3)) for face in faces)
+        return cubic_to_equirectangular(faces, [height, width]), feed_dict
+    elif name == 'bilinear_sample':
+        # vertical warp of the top image, as in MonodepthModel.generate_image_top
+        disparity = tf.placeholder(tf.float32, [batch_size, height, width, 1])
+        feed_dict[disparity] = 0.05 * np.random.rand(batch_size, height, width, 1)
+        return bilinear_sample(top, x_t = None, y_t = None, x_offset = 0.0, y_offset = disparity), feed_dict
+    elif name == 'SSIM':
+        bottom = tf.placeholder(tf.float32, [batch_size, height, width, 3])
+        feed_dict[bottom] = np.random.rand(batch_size, height, width, 3)
+        return MonodepthModel.__new__(MonodepthModel).SSIM(top, bottom), feed_dict
+
+    # cubic_net or equirectangular_net, forward in test mode or forward+backward of the training losses
+    projection, mode = name.split('_net_')
+    params = benchmark_params(height=height, width=width, batch_size=batch_size, projection=projection)
+    if mode == 'forward':
+        model = MonodepthModel(params, 'test', top, None)
+        return model.disparity_top_est[0], feed_dict
+    bottom = tf.placeholder(tf.float32, [batch_size, height, width, 3])
+    feed_dict[bottom] = np.random.rand(batch_size, height, width, 3)
+    model = MonodepthModel(params, 'train', top, bottom)
+    return tf.gradients(model.total_loss, tf.trainable_variables()), feed_dict
+
+suite_cases = ['equirectangular_to_cubic', 'cubic_to_equirectangular', 'bilinear_sample', 'SSIM',
+               'cubic_net_forward', 'equirectangular_net_forward', 'cubic_net_train', 'equirectangular_net_train']
+
+def suite_benchmark(batch_sizes, resolutions, num_iterations, cases = suite_cases):
+    """CPU latency, throughput and peak memory of the projections, sampling, SSIM and networks.
+
+    Every case is measured for each batch size and (height, width) resolution in its own graph.
+    """
+    results = []
+    for height, width in resolutions:
+        for batch_size in batch_sizes:
+            for name in cases:
+                with tf.Graph().as_default():
+                    fetches, feed_dict = suite_case(name, batch_size, height, width)
+                    session = tf.Session(config = tf.ConfigProto(device_count = {'GPU': 0}))
+                    session.run(tf.global_variables_initializer())
+                    result = {'name': name, 'batch_size': batch_size, 'height': height, 'width': width}
+                    result.update(measure(session, fetches, feed_dict, batch_size, num_iterations))
+                    results.append(result)
+                    session.close()
+                print("{:>28} {:>6} {:>10} {:>15.3f} {:>18.1f} {:>18.1f}".format(
+                    name, batch_size, '{}x{}'.format(height, width), 1e3 * result['latency'],
+                    result['throughput'], result['peak_memory'] / 2 ** 20))
+    return results
+
+def suite_key(result):
+    return (result['name'], result['batch_size'], result['height'], result['width'])
+
+def compare_with_baseline(results, baseline, threshold):
+    """Returns the cases whose latency or peak memory grew by more than threshold over the baseline."""
+    baseline_results = dict((suite_key(result), result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        reference = baseline_results.get(suite_key(result))
+        if reference is None:
+            continue
+        for metric in ['latency', 'peak_memory']:
+            ratio = result[metric] / max(reference[metric], 1e-12)
+            if ratio > 1.0 + threshold:
+                regressions.append((suite_key(result), metric, ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Monodepth benchmarks.')
+    parser.add_argument('--benchmark',       type=str, help='benchmark to run', default='ssim', choices=['ssim', 'polar_faces', 'encoders', 'loss', 'suite'])
+    parser.add_argument('--checkpoint_path', type=str, help='checkpoint used for the accuracy comparisons', default='')
+    parser.add_argument('--data_path',       type=str, help='path to the data of the accuracy comparisons', default='')
+    parser.add_argument('--filenames_file',  type=str, help='filenames of the accuracy comparisons', default='')
+    parser.add_argument('--num_images',      type=int, help='number of images of the accuracy comparisons', default=32)
+    parser.add_argument('--batch_size',      type=int, help='batch size', default=8)
+    parser.add_argument('--height',          type=int, help='input height', default=256)
+    parser.add_argument('--width',           type=int, help='input width', default=512)
+    parser.add_argument('--num_iterations',  type=int, help='number of timed iterations', default=20)
+    parser.add_argument('--loss_samples',    type=int, help='number of sampled pixels per image and scale of the loss benchmark', default=4096)
+    parser.add_argument('--batch_sizes',     type=str, help='comma separated batch sizes of the suite', default='1,4')
+    parser.add_argument('--resolutions',     type=str, help='comma separated HEIGHTxWIDTH resolutions of the suite', default='128x256,256x512')
+    parser.add_argument('--suite_cases',     type=str, help='comma separated cases of the suite, all by default', default='')
+    parser.add_argument('--output_path',     type=str, help='if set, writes the suite results to this JSON file', default='')
+    parser.add_argument('--baseline_path',   type=str, help='if set, compares the suite results with this JSON file', default='')
+    parser.add_argument('--regression_threshold', type=float, help='relative increase of latency or peak memory reported as a regression', default=0.1)
+    args = parser.parse_args()
+
+    if args.benchmark == 'ssim':
+        results = ssim_benchmark(args.batch_size, args.height, args.width, args.num_iterations)
+        print("Maximum difference of loss and gradients: {:.3e}".format(results['max_difference']))
+        print("{:>10} {:>15} {:>22}".format('', 'forward (ms)', 'forward+backward (ms)'))
+        for name in ['reference', 'fused']:
+            print("{:>10} {:>15.3f} {:>22.3f}".format(name, 1e3 * results[name + '_forward'], 1e3 * results[name + '_backward']))
+    elif args.benchmark == 'encoders':
+        results = encoder_benchmark(args.batch_size, args.height, args.width, args.num_iterations)
+        print("{:>10} {:>16} {:>14} {:>10} {:>15} {:>18}".format('encoder', 'projection', 'parameters (M)', 'GFLOPs', 'latency (ms)', 'peak memory (MB)'))
+        for result in results:
+            print("{:>10} {:>16} {:>14.2f} {:>10.2f} {:>15.3f} {:>18.1f}".format(
+                result['encoder'], result['projection'], result['parameters'] / 1e6, result['flops'] / 1e9,
+                1e3 * result['latency'], result['peak_memory'] / 2 ** 20))
+    elif args.benchmark == 'loss':
+        results = loss_benchmark(args.batch_size, args.height, args.width, args.num_iterations, args.loss_samples)
+        print("{:>10} {:>22} {:>18} {:>12}".format('loss', 'forward+backward (ms)', 'peak memory (MB)', 'mean loss'))
+        for name in ['dense', 'uniform', 'gradient']:
+            print("{:>10} {:>22.3f} {:>18.1f} {:>12.5f}".format(name, 1e3 * results[name]['latency'], results[name]['peak_memory'] / 2 ** 20, results[name]['loss']))
+    elif args.benchmark == 'suite':
+        batch_sizes = [int(batch_size) for batch_size in args.batch_sizes.split(',')]
+        resolutions = parse_resolutions(args.resolutions)
+        cases = args.suite_cases.split(',') if args.suite_cases != '' else suite_cases
+        print("{:>28} {:>6} {:>10} {:>15} {:>18} {:>18}".format('case', 'batch', 'resolution', 'latency (ms)', 'images per second', 'peak memory (MB)'))
+        results = suite_benchmark(batch_sizes, resolutions, args.num_iterations, cases)
+
+        if args.output_path != '':
+            with open(args.output_path, 'w') as f:
+                json.dump({'num_iterations': args.num_iterations, 'tensorflow': tf.__version__, 'results': results}, f, indent = 2)
+
+        if args.baseline_path != '':
+            with open(args.baseline_path, 'r') as f:
+                baseline = json.load(f)
+            regressions = compare_with_baseline(results, baseline, args.regression_threshold)
+            for (name, batch_size, height, width), metric, ratio in regressions:
+                print("regression: {} batch {} at {}x{}, {} is {:.2f}x the baseline".format(name, batch_size, height, width, metric, ratio))
+            if regressions:
+                sys.exit(1)
+            print("no regression above {:.0%} of the baseline".format(args.regression_threshold))
+    elif args.benchmark == 'polar_faces':
+        images = None
+        if args.checkpoint_path != '' and args.filenames_file != '':
+            images = load_images(args.data_path, args.filenames_file, args.height, args.width, args.num_images)
+        results = polar_face_benchmark(args.batch_size, args.height, args.width, args.num_iterations, args.checkpoint_path, images)
+        print("{:>12} {:>12} {:>15} {:>22}".format('polar scale', 'GFLOPs', 'latency (ms)', 'relative difference'))
+        for polar_face_scale, result in sorted(results.items()):
+            print("{:>12} {:>12.2f} {:>15.3f} {:>22}".format(polar_face_scale, result['flops'] / 1e9, 1e3 * result['latency'],
+                                                              '{:.4f}'.format(result['relative_difference']) if 'relative_difference' in result else '-'))
+
+if __name__ == '__main__':
+    main()
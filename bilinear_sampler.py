@@ -114,6 +114,19 @@ def transform(input_images, x_t, y_t, x_offset, y_offset):
             input_transformed, tf.stack([batch_size, out_height, out_width, num_channels]))
         return output
 
+def sample_points(input_images, x, y, name = "point_sampler"):
+    """Bilinearly samples the images at [batch, num_points] normalised coordinates.
+
+    Returns [batch, num_points, channels], only the sampled locations are gathered.
+    """
+    with tf.variable_scope(name):
+        batch_size   = tf.shape(input_images)[0]
+        num_channels = tf.shape(input_images)[3]
+        num_points   = tf.shape(x)[1]
+
+        output = interpolate(input_images, tf.reshape(x, [-1]), tf.reshape(y, [-1]), [1, num_points])
+        return tf.reshape(output, tf.stack([batch_size, num_points, num_channels]))
+
 def uv_grid(shape):
     u, v = tf.meshgrid(tf.linspace(0.0, 1.0, shape[1]), tf.linspace(0.0, 1.0, shape[0]))
     return u, v
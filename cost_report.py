@@ -0,0 +1,224 @@
+"""Static cost report of the monodepth model.
+
+Builds the model for given parameters without running it and reports the FLOPs, parameters and
+activation memory of every scope: encoder stages, decoder layers, samplers and losses. The shapes
+are inferred by grappler, which also resolves the shapes that depend on tf.shape of static tensors.
+"""
+
+from __future__ import division
+
+import argparse
+import json
+import re
+import numpy as np
+import tensorflow as tf
+
+from collections import OrderedDict
+
+from monodepth_utils import benchmark_params, parse_resolutions
+from monodepth_model import *
+
+# Ops whose outputs are views, constants or variables do not count as activation memory.
+view_ops = set(['Const', 'VariableV2', 'VarHandleOp', 'Identity', 'Reshape', 'Shape', 'Placeholder', 'NoOp', 'Assign', 'ExpandDims', 'Squeeze'])
+
+elementwise_ops = set(['Add', 'AddV2', 'AddN', 'Sub', 'Mul', 'RealDiv', 'Div', 'Maximum', 'Minimum', 'Pow', 'Square', 'Sqrt', 'Rsqrt',
+                       'Abs', 'Neg', 'Exp', 'Log', 'Elu', 'EluGrad', 'Relu', 'ReluGrad', 'Sigmoid', 'SigmoidGrad', 'Tanh', 'Tan', 'Atan',
+                       'Sin', 'Cos', 'BiasAdd', 'Select', 'Floor', 'Cast', 'ClipByValue', 'Greater', 'Less', 'Equal', 'GreaterEqual',
+                       'LogicalAnd', 'SquaredDifference', 'FloorMod', 'Sign', 'Reciprocal', 'ReciprocalGrad'])
+
+reduction_ops = set(['Mean', 'Sum', 'Max', 'Min', 'Prod', 'ArgMax', 'BiasAddGrad'])
+
+loss_scopes = set(['losses', 'smoothness', 'images', 'top-bottom'])
+
+def inferred_shapes(graph, fetches):
+    """Output shapes of every op, from grappler if available and from the graph otherwise."""
+    shapes = dict((op.name, [output.shape.as_list() if output.shape.dims is not None else None for output in op.outputs])
+                  for op in graph.get_operations())
+    try:
+        from tensorflow.python.grappler import item as grappler_item
+        meta_graph = tf.train.export_meta_graph(graph = graph)
+        meta_graph.collection_def['train_op'].node_list.value.extend([fetch.name for fetch in fetches])
+        for name, properties in grappler_item.Item(meta_graph).GetOpProperties().items():
+            shapes[name] = [None if p.shape.unknown_rank else [dim.size if dim.size >= 0 else None for dim in p.shape.dim]
+                            for p in properties]
+    except (ImportError, AttributeError, ValueError, tf.errors.OpError) as error:
+        print('grappler shape inference unavailable, using the graph shapes: {}'.format(error))
+    return shapes
+
+def num_elements(shape):
+    if shape is None or None in shape:
+        return None
+    return int(np.prod(shape))
+
+def op_flops(op, input_shapes, output_shapes):
+    """FLOPs of an op with the conventions of the TF profiler, None if a shape is unknown."""
+    output_size = num_elements(output_shapes[0]) if output_shapes else 0
+    if op.type == 'Conv2D':
+        kernel = input_shapes[1]
+        return None if output_size is None or num_elements(kernel) is None else 2 * output_size * kernel[0] * kernel[1] * kernel[2]
+    elif op.type == 'DepthwiseConv2dNative':
+        kernel = input_shapes[1]
+        return None if output_size is None or num_elements(kernel) is None else 2 * output_size * kernel[0] * kernel[1] * kernel[3]
+    elif op.type in ['Conv2DBackpropInput', 'Conv2DBackpropFilter']:
+        # both gradients cost as much as the forward convolution producing out_backprop
+        out_backprop = num_elements(input_shapes[2])
+        kernel = output_shapes[0] if op.type == 'Conv2DBackpropFilter' else input_shapes[1]
+        return None if out_backprop is None or num_elements(kernel) is None else 2 * out_backprop * kernel[0] * kernel[1] * kernel[2]
+    elif op.type == 'MatMul':
+        inner = input_shapes[0][0 if op.get_attr('transpose_a') else 1] if input_shapes[0] is not None else None
+        return None if output_size is None or inner is None else 2 * output_size * inner
+    elif op.type in ['AvgPool', 'MaxPool']:
+        ksize = op.get_attr('ksize')
+        return None if output_size is None else output_size * ksize[1] * ksize[2]
+    elif op.type in elementwise_ops:
+        return output_size
+    elif op.type in reduction_ops:
+        return num_elements(input_shapes[0])
+    return 0
+
+def scope_of(name, depth):
+    # gradient ops are attributed to the scope of their forward op, numbered copies of a scope
+    # created by the faces and towers are merged
+    backward = name.startswith('gradients')
+    components = name.split('/')[:-1]
+    if backward:
+        components = components[1:]
+    components = [re.sub(r'_\d+$', '', component) for component in components]
+    return '/'.join(components[:depth]) or '(root)', backward
+
+def variable_scope_of(variable, depth):
+    # variables are named after their variable scope only, they are attributed to the scope
+    # of the first op using them instead
+    ops = [variable.op]
+    while ops:
+        op = ops.pop(0)
+        for consumer in [consumer for output in op.outputs for consumer in output.consumers()]:
+            if consumer.type not in view_ops and not consumer.name.startswith('gradients'):
+                return scope_of(consumer.name, depth)[0]
+            ops.append(consumer)
+    return scope_of(variable.op.name, depth)[0]
+
+def section_of(scope):
+    components = scope.split('/')
+    if 'sampler' in scope:
+        return 'samplers'
+    elif 'encoder' in components or 'skips' in components:
+        return 'encoder'
+    elif 'decoder' in components:
+        return 'decoder'
+    elif components[0] in loss_scopes:
+        return 'losses'
+    return 'other'
+
+def new_row():
+    return {'forward_flops': 0, 'backward_flops': 0, 'parameters': 0, 'activation_bytes': 0}
+
+def cost_report(params, mode = 'train', backward = True, depth = 3):
+    """Per scope and per section FLOPs, parameters and activation bytes of a model.
+
+    Activation bytes sum the outputs of the forward ops and are an upper bound, TF frees and
+    reuses buffers. Ops of unknown shapes are counted in unknown_ops.
+    """
+    with tf.Graph().as_default() as graph:
+        top = tf.placeholder(tf.float32, [params.batch_size, params.height, params.width, 3])
+        bottom = tf.placeholder(tf.float32, [params.batch_size, params.height, params.width, 3]) if mode == 'train' else None
+        model = MonodepthModel(params, mode, top, bottom)
+
+        if mode == 'train':
+            fetches = [model.total_loss]
+            if backward:
+                fetches += tf.gradients(model.total_loss, tf.trainable_variables())
+        else:
+            fetches = [model.disparity_top_est[0]]
+
+        shapes = inferred_shapes(graph, fetches)
+        scopes = OrderedDict()
+        unknown_ops = 0
+        for op in graph.get_operations():
+            scope, is_backward = scope_of(op.name, depth)
+            row = scopes.setdefault(scope, new_row())
+            output_shapes = shapes.get(op.name, [])
+            input_shapes = [shapes.get(tensor.op.name, [None] * (tensor.value_index + 1))[tensor.value_index] for tensor in op.inputs]
+
+            flops = op_flops(op, input_shapes, output_shapes)
+            if flops is None:
+                unknown_ops += 1
+                flops = 0
+            row['backward_flops' if is_backward else 'forward_flops'] += flops
+
+            if not is_backward and op.type not in view_ops:
+                for output, shape in zip(op.outputs, output_shapes):
+                    size = num_elements(shape)
+                    if size is not None and output.dtype.base_dtype.is_numpy_compatible:
+                        row['activation_bytes'] += size * output.dtype.base_dtype.size
+
+        # shared variables are only counted once
+        for variable in tf.trainable_variables():
+            scope = variable_scope_of(variable, depth)
+            scopes.setdefault(scope, new_row())['parameters'] += int(np.prod(variable.get_shape().as_list()))
+
+    scopes = OrderedDict((scope, row) for scope, row in scopes.items() if any(row.values()))
+    sections = OrderedDict((section, new_row()) for section in ['encoder', 'decoder', 'samplers', 'losses', 'other'])
+    for scope, row in scopes.items():
+        for key, value in row.items():
+            sections[section_of(scope)][key] += value
+    total = new_row()
+    for row in sections.values():
+        for key, value in row.items():
+            total[key] += value
+    return {'scopes': scopes, 'sections': sections, 'total': total, 'unknown_ops': unknown_ops}
+
+def print_rows(rows):
+    print("{:>40} {:>14} {:>15} {:>14} {:>18}".format('', 'forward GFLOPs', 'backward GFLOPs', 'parameters (M)', 'activations (MB)'))
+    for name, row in rows.items():
+        print("{:>40} {:>14.3f} {:>15.3f} {:>14.3f} {:>18.1f}".format(name[-40:], row['forward_flops'] / 1e9, row['backward_flops'] / 1e9,
+                                                                   row['parameters'] / 1e6, row['activation_bytes'] / 2 ** 20))
+
+def main():
+    parser = argparse.ArgumentParser(description='Static FLOPs, parameters and activation memory of the monodepth model.')
+    parser.add_argument('--projections',       type=str,   help='comma separated projection modes', default='cubic,equirectangular')
+    parser.add_argument('--batch_sizes',       type=str,   help='comma separated batch sizes', default='1,8')
+    parser.add_argument('--resolutions',       type=str,   help='comma separated HEIGHTxWIDTH input resolutions', default='256x512')
+    parser.add_argument('--mode',              type=str,   help='train or test', default='train', choices=['train', 'test'])
+    parser.add_argument('--forward_only',                  help='if set, does not build the gradients in train mode', action='store_true')
+    parser.add_argument('--encoder',           type=str,   help='type of encoder, resnet50, vgg or mobile', default='resnet50')
+    parser.add_argument('--channel_config',    type=str,   help='if set, channel config of a pruned model', default='')
+    parser.add_argument('--polar_face_scale',  type=int,   help='downscaling factor of the up and down cube faces', default=1)
+    parser.add_argument('--loss_sampling',     type=str,   help='if set, uniform or gradient sampled losses', default='')
+    parser.add_argument('--use_deconv',                    help='if set, the model uses transposed convolutions', action='store_true')
+    parser.add_argument('--depth',             type=int,   help='number of scope levels of the per scope report', default=3)
+    parser.add_argument('--sections_only',                 help='if set, only prints the totals per section', action='store_true')
+    parser.add_argument('--output_path',       type=str,   help='if set, writes the reports to this JSON file', default='')
+    args = parser.parse_args()
+
+    reports = []
+    for height, width in parse_resolutions(args.resolutions):
+        for batch_size in [int(batch_size) for batch_size in args.batch_sizes.split(',')]:
+            for projection in args.projections.split(','):
+                params = benchmark_params(height=height, width=width, batch_size=batch_size, projection=projection, encoder=args.encoder,
+                                          channel_config=args.channel_config, polar_face_scale=args.polar_face_scale,
+                                          loss_sampling=args.loss_sampling, use_deconv=args.use_deconv)
+                report = cost_report(params, args.mode, not args.forward_only, args.depth)
+                report.update({'projection': projection, 'batch_size': batch_size, 'height': height, 'width': width, 'mode': args.mode})
+                reports.append(report)
+
+                print("\n{} {} at {}x{}, batch {}{}".format(projection, args.mode, height, width, batch_size,
+                      ', {} ops of unknown shape'.format(report['unknown_ops']) if report['unknown_ops'] else ''))
+                if not args.sections_only:
+                    print_rows(report['scopes'])
+                print_rows(report['sections'])
+                print_rows(OrderedDict([('total', report['total'])]))
+
+    print("\n{:>16} {:>6} {:>10} {:>14} {:>15} {:>14} {:>18}".format('projection', 'batch', 'resolution', 'forward GFLOPs', 'backward GFLOPs', 'parameters (M)', 'activations (MB)'))
+    for report in reports:
+        total = report['total']
+        print("{:>16} {:>6} {:>10} {:>14.3f} {:>15.3f} {:>14.3f} {:>18.1f}".format(
+            report['projection'], report['batch_size'], '{}x{}'.format(report['height'], report['width']), total['forward_flops'] / 1e9,
+            total['backward_flops'] / 1e9, total['parameters'] / 1e6, total['activation_bytes'] / 2 ** 20))
+
+    if args.output_path != '':
+        with open(args.output_path, 'w') as f:
+            json.dump(reports, f, indent = 2)
+
+if __name__ == '__main__':
+    main()
@@ -11,27 +11,38 @@
 """Monodepth dataloader.
 """
 
+import numpy as np
 import tensorflow as tf
 
 
 def string_length_tf(t):
     return tf.py_func(len, [t], [tf.int64])
 
+def epoch_permutation(seed, epoch, num_samples):
+    # Seeding with both values makes every epoch's order reproducible after a restart.
+    return np.random.RandomState([int(seed) % 2 ** 32, int(epoch) % 2 ** 32]).permutation(num_samples).astype(np.int64)
+
 
 class MonodepthDataloader(object):
     """Monodepth dataloader"""
 
-    def __init__(self, data_path, filenames_file, params, mode):
+    def __init__(self, data_path, filenames_file, params, mode, seed = 0, teacher_depths_file = ''):
         self.data_path = data_path
         self.params = params
         self.mode = mode
 
         self.top_image_batch = None
         self.bottom_image_batch = None
+        self.teacher_depth_batch = None
+        self.top_pyramid_batch = None
+        self.bottom_pyramid_batch = None
 
-        input_queue = tf.train.string_input_producer([filenames_file], shuffle=False)
-        line_reader = tf.TextLineReader()
-        _, line = line_reader.read(input_queue)
+        if mode == 'train':
+            line_index, line = self.read_line_resumable(filenames_file, seed)
+        else:
+            input_queue = tf.train.string_input_producer([filenames_file], shuffle=False)
+            line_reader = tf.TextLineReader()
+            _, line = line_reader.read(input_queue)
 
         split_line = tf.string_split([line]).values
 
@@ -51,6 +62,11 @@ class MonodepthDataloader(object):
             top_image  = tf.cond(do_flip > 0.5, lambda: tf.image.flip_left_right(top_image_o), lambda: top_image_o)
             bottom_image = tf.cond(do_flip > 0.5, lambda: tf.image.flip_left_right(bottom_image_o),  lambda: bottom_image_o)
 
+            # Cached teacher depths are flipped with the images, colour augmentation does not change them.
+            if teacher_depths_file != '':
+                teacher_depth_o = self.read_teacher_depth(teacher_depths_file, line_index)
+                teacher_depth = tf.cond(do_flip > 0.5, lambda: tf.image.flip_left_right(teacher_depth_o), lambda: teacher_depth_o)
+
             # Randomly augment images.
             do_augment = tf.random_uniform([], 0, 1)
             top_image, bottom_image = tf.cond(do_augment > 0.5,
@@ -61,17 +77,85 @@ class MonodepthDataloader(object):
             top_image.set_shape([None, None, 3])
             bottom_image.set_shape([None, None, 3])
 
-            # capacity = min_after_dequeue + (num_threads + a small safety margin) * batch_size
-            min_after_dequeue = 2048
-            capacity = min_after_dequeue + 4 * params.batch_size
-            self.top_image_batch, self.bottom_image_batch = tf.train.shuffle_batch(
-                [top_image, bottom_image],
-                params.batch_size, capacity, min_after_dequeue, params.num_threads)
+            # Lines are already shuffled per epoch, so a plain batch queue keeps the consumed position exact.
+            # capacity = (num_threads + a small safety margin) * batch_size
+            capacity = (params.num_threads + 4) * params.batch_size
+            batch_inputs = [top_image, bottom_image]
+            # The pyramids are built by the input threads, overlapping with the training step.
+            if params.input_pyramid:
+                batch_inputs += self.scale_pyramid(top_image, 4)[1:] + self.scale_pyramid(bottom_image, 4)[1:]
+            if teacher_depths_file != '':
+                batch_inputs.append(teacher_depth)
+
+            batches = tf.train.batch(batch_inputs, params.batch_size, params.num_threads, capacity)
+            self.top_image_batch, self.bottom_image_batch = batches[:2]
+            if params.input_pyramid:
+                self.top_pyramid_batch = [self.top_image_batch] + batches[2:5]
+                self.bottom_pyramid_batch = [self.bottom_image_batch] + batches[5:8]
+            if teacher_depths_file != '':
+                self.teacher_depth_batch = batches[-1]
 
         elif mode == 'test':
             self.top_image_batch = tf.stack([top_image_o, tf.image.flip_left_right(top_image_o)], 0)
             self.top_image_batch.set_shape([2, None, None, 3])
 
+    def read_line_resumable(self, filenames_file, seed):
+        with open(filenames_file, 'r') as f:
+            lines = [line.rstrip() for line in f if line.strip()]
+        num_lines = len(lines)
+
+        with tf.variable_scope('input_position'):
+            # Seed of the epoch permutations and number of samples consumed by the training loop.
+            # Both are saved with the checkpoints so that a restored run continues where it stopped.
+            self.input_seed = tf.Variable(seed, dtype=tf.int64, trainable=False, name='seed')
+            self.input_position = tf.Variable(0, dtype=tf.int64, trainable=False, name='position')
+
+            # Position of the reader thread, which runs ahead of the training loop.
+            read_position = tf.Variable(0, dtype=tf.int64, trainable=False, name='read_position',
+                                        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+            epoch = read_position // num_lines
+            offset = read_position % num_lines
+            permutation = tf.py_func(epoch_permutation, [self.input_seed, epoch, tf.constant(num_lines, tf.int64)], tf.int64)
+            permutation.set_shape([num_lines])
+
+            # Enqueue the rest of the current epoch, then move the reader to the start of the next one.
+            line_queue = tf.FIFOQueue(32 * self.params.batch_size, [tf.int64], shapes=[[]])
+            enqueue_op = line_queue.enqueue_many([permutation[offset:]])
+            with tf.control_dependencies([enqueue_op]):
+                next_epoch_op = tf.assign(read_position, (epoch + 1) * num_lines)
+
+            # A single thread keeps the epoch order deterministic.
+            tf.train.add_queue_runner(tf.train.QueueRunner(line_queue, [next_epoch_op]))
+
+            self.advance_position_op = tf.assign_add(self.input_position, self.params.batch_size)
+            self.reset_position_op = tf.assign(self.input_position, 0)
+            self.restore_position_op = tf.assign(read_position, self.input_position)
+
+        line_index = line_queue.dequeue()
+        return line_index, tf.gather(tf.constant(lines), line_index)
+
+    def read_teacher_depth(self, teacher_depths_file, line_index):
+        # The cache is memory-mapped, only the requested depth maps are read from disk.
+        teacher_depths = np.load(teacher_depths_file, mmap_mode='r')
+        read_depth = lambda index: teacher_depths[index].astype(np.float32)
+
+        teacher_depth = tf.py_func(read_depth, [line_index], tf.float32)
+        teacher_depth.set_shape(teacher_depths.shape[1:])
+        if teacher_depths.shape[1:3] != (self.params.height, self.params.width):
+            teacher_depth = tf.image.resize_images(teacher_depth, [self.params.height, self.params.width], tf.image.ResizeMethod.AREA)
+        return teacher_depth
+
+    def scale_pyramid(self, image, num_scales):
+        # Same area downsampling as MonodepthModel.scale_pyramid, for a single image of known size.
+        height = self.params.height
+        width = self.params.width
+        scaled_images = [image]
+        for i in range(num_scales - 1):
+            ratio = 2 ** (i + 1)
+            scaled_images.append(tf.image.resize_area(tf.expand_dims(image, 0), [height // ratio, width // ratio])[0])
+        return scaled_images
+
     def augment_image_pair(self, top_image, bottom_image):
         # Randomly shift gamma.
         random_gamma = tf.random_uniform([], 0.8, 1.2)
@@ -11,6 +11,8 @@
 from __future__ import division
 
 import argparse
+import hashlib
+import json
 import numpy as np
 import os
 import re
@@ -18,13 +20,17 @@ import tensorflow as tf
 import tensorflow.contrib.slim as slim
 import time
 
+from collections import OrderedDict
 from monodepth_model import *
 from monodepth_dataloader import *
 from average_gradients import *
+from training_monitor import *
+from multi_tower import *
+from monodepth_quantize import tflite_conv_stack
 
 parser = argparse.ArgumentParser(description='Monodepth TensorFlow implementation.')
 
-parser.add_argument('--mode',                      type=str,   help='Train or test', default='train')
+parser.add_argument('--mode',                      type=str,   help='train, test or distill', default='train')
 parser.add_argument('--model_name',                type=str,   help='Model name', default='monodepth360')
 parser.add_argument('--data_path',                 type=str,   help='Path to the data', required=True)
 parser.add_argument('--filenames_file',            type=str,   help='Path to the filenames text file', required=True)
@@ -33,87 +39,171 @@ parser.add_argument('--input_width',               type=int,   help='Input width
 parser.add_argument('--batch_size',                type=int,   help='Batch size', default=8)
 parser.add_argument('--num_epochs',                type=int,   help='Number of epochs', default=100)
 parser.add_argument('--learning_rate',             type=float, help='Initial learning rate', default=1e-3)
+parser.add_argument('--encoder',                   type=str,   help='type of encoder, resnet50, vgg or mobile', default='resnet50')
+parser.add_argument('--channel_config',            type=str,   help='path to the channel config of a pruned model', default='')
 parser.add_argument('--projection',                type=str,   help='Projection mode - cubic or equirectangular', default='cubic')
+parser.add_argument('--polar_face_scale',          type=int,   help='downscaling factor of the up and down faces in cubic mode, input_width / 4 / scale must be a multiple of 64', default=1)
 parser.add_argument('--tb_loss_weight',            type=float, help='Top-bottom consistency weight', default=1e-3)
 parser.add_argument('--alpha_image_loss',          type=float, help='Weight between SSIM and L1 in the image loss', default=0.75)
 parser.add_argument('--depth_gradient_loss_weight',type=float, help='Depth smoothness weight', default=1e-3)
+parser.add_argument('--output_scale',              type=int,   help='scale of the test disparities, 0 is full resolution and 3 is 1/8, coarser scales skip the finer decoder layers', default=0)
+parser.add_argument('--loss_sampling',             type=str,   help='if set, evaluates the reconstruction and top-bottom losses on sampled pixels, uniform or gradient', default='')
+parser.add_argument('--loss_samples',              type=int,   help='number of sampled pixels per image and scale with --loss_sampling', default=4096)
+parser.add_argument('--input_pyramid',                         help='if set, the image pyramids are built by the input threads instead of the towers', action='store_true')
+parser.add_argument('--teacher_checkpoint_path',   type=str,   help='path to the checkpoint of the teacher in distill mode', default='')
+parser.add_argument('--teacher_encoder',           type=str,   help='type of encoder of the teacher, resnet50, vgg or mobile', default='resnet50')
+parser.add_argument('--teacher_projection',        type=str,   help='projection mode of the teacher, defaults to --projection', default='')
+parser.add_argument('--distillation_loss_weight',  type=float, help='weight of the distillation loss in distill mode', default=1e-1)
 parser.add_argument('--use_deconv',                            help='if set, will use transposed convolutions', action='store_true')
 parser.add_argument('--gpus',                      type=str,   help='GPU indices to train on', default='0')
+parser.add_argument('--virtual_cpus',              type=int,   help='if set, trains one tower on each of this many virtual CPU devices instead of the GPUs', default=0)
 parser.add_argument('--num_threads',               type=int,   help='number of threads to use for data loading', default=8)
 parser.add_argument('--output_directory',          type=str,   help='output directory for test disparities, if empty outputs to checkpoint folder', default='')
 parser.add_argument('--log_directory',             type=str,   help='directory to save checkpoints and summaries', default='')
+parser.add_argument('--quantized_conv_stack',      type=str,   help='path to an int8 TFLite conv stack from monodepth_quantize.py used in test mode', default='')
 parser.add_argument('--checkpoint_path',           type=str,   help='path to a specific checkpoint to load', default='')
+parser.add_argument('--resolution_schedule',       type=str,   help='progressive resolution schedule as epoch:HEIGHTxWIDTH stages, e.g. 0:128x256,20:256x512', default='')
 parser.add_argument('--retrain',                               help='if used with checkpoint_path, will restart training from step zero', action='store_true')
+parser.add_argument('--input_seed',                type=int,   help='seed of the per-epoch shuffling of the training files', default=0)
+parser.add_argument('--stats_trace_interval',      type=int,   help='number of steps between traced steps used to split compute from gradient aggregation and the optimizer update, 0 to disable', default=1000)
+parser.add_argument('--profile_steps',             type=str,   help='range START:END of training steps to trace, END excluded', default='')
+parser.add_argument('--profile_signal_steps',      type=int,   help='number of steps to trace after receiving SIGUSR1', default=10)
 parser.add_argument('--full_summary',                          help='if set, will keep more data for each summary. Warning: the file can become very large', action='store_true')
 
 args = parser.parse_args()
 
+# Fail before building the teacher cache graph rather than when restoring the teacher.
+if args.mode == 'distill' and not tf.train.checkpoint_exists(args.teacher_checkpoint_path):
+    parser.error("--mode distill needs --teacher_checkpoint_path to name an existing checkpoint, '{}' was not found".format(args.teacher_checkpoint_path))
+
+# The profiler only parses the range once the training graph is built.
+if args.profile_steps and not re.match(r'^\d+:\d+$', args.profile_steps):
+    parser.error("--profile_steps must be a range START:END of training steps, got '{}'".format(args.profile_steps))
+
 def setup_environment():
     # Only keep warnings and errors.
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1'
 
-    # Setup GPU usage.
+    # Setup GPU usage, towers on virtual CPU devices do not use the GPUs.
+    if args.virtual_cpus > 0:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        return args.virtual_cpus
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpus
     return len(args.gpus.split(","))
 
-num_gpus = setup_environment()
+num_towers = setup_environment()
+
+def tower_device(index):
+    if args.virtual_cpus > 0:
+        return '/cpu:%d' % index
+    return '/gpu:%d' % index
 
 def count_text_lines(file_path):
+    # Blank lines are skipped by the training dataloader and are not samples.
     with open(file_path, 'r') as f:
-        lines = f.readlines()
-        return len(lines)
-
-def train(params):
+        return len([line for line in f if line.strip()])
+
+def restore_checkpoint(session, checkpoint_path, variables):
+    # Only restore the variables present in the checkpoint, older checkpoints do not store the input position.
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    restore_vars = [variable for variable in variables if reader.has_tensor(variable.op.name)]
+    missing_vars = [variable.op.name for variable in variables if not reader.has_tensor(variable.op.name)]
+    if missing_vars:
+        print("Variables not found in checkpoint: {}".format(", ".join(missing_vars)))
+    tf.train.Saver(restore_vars).restore(session, checkpoint_path)
+
+def checkpoint_step(checkpoint_path):
+    # The global step is the first, unnamed, variable of the training graph.
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    return int(reader.get_tensor('Variable')) if reader.has_tensor('Variable') else 0
+
+def resolution_schedule(params, steps_per_epoch):
+    """Returns the first step, height and width of every stage of the resolution schedule."""
+    if args.resolution_schedule == '':
+        return [(0, params.height, params.width)]
+
+    stages = []
+    for stage in args.resolution_schedule.split(','):
+        epoch, resolution = stage.split(':')
+        height, width = resolution.split('x')
+        stages.append((int(epoch) * steps_per_epoch, int(height), int(width)))
+    stages.sort()
+
+    # The first stage always starts training.
+    stages[0] = (0,) + stages[0][1:]
+    return stages
+
+def train(params, teacher_depths_file=''):
     """Training loop."""
 
+    num_training_samples = count_text_lines(args.filenames_file)
+
+    steps_per_epoch = np.ceil(num_training_samples / params.batch_size).astype(np.int32)
+    num_total_steps = params.num_epochs * steps_per_epoch
+
+    print("Total number of samples: {}".format(num_training_samples))
+    print("Total number of steps: {}".format(num_total_steps))
+
+    # Every resolution stage builds its own graph and restores the weights saved at the end of the previous stage.
+    stages = resolution_schedule(params, steps_per_epoch)
+    if params.projection != 'equirectangular':
+        # Fail before training rather than when a later stage builds its graph.
+        for _, height, width in stages:
+            cube_face_sizes(width, params.polar_face_scale)
+    checkpoint_path = args.checkpoint_path
+    retrain = args.retrain
+    start_step = checkpoint_step(checkpoint_path) if checkpoint_path != '' and not retrain else 0
+
+    # The time left is estimated from the time and steps trained by this run over all stages.
+    trained_time, trained_steps = 0.0, 0
+    for index, (first_step, height, width) in enumerate(stages):
+        end_step = stages[index + 1][0] if index + 1 < len(stages) else num_total_steps
+        if start_step >= end_step:
+            # Stages already trained by a resumed run are not built.
+            print("Skipping resolution stage {}x{} ending at step {}".format(height, width, end_step))
+            continue
+        if len(stages) > 1:
+            print("Resolution stage {}x{} from step {} to {}".format(height, width, first_step, end_step))
+        stage_params = params._replace(height=height, width=width)
+        checkpoint_path, trained_time, trained_steps = train_stage(stage_params, num_total_steps, end_step, checkpoint_path, retrain,
+                                                                   teacher_depths_file, trained_time, trained_steps)
+        start_step = end_step
+        retrain = False
+
+def train_stage(params, num_total_steps, end_step, checkpoint_path, retrain, teacher_depths_file, trained_time = 0.0, trained_steps = 0):
+    """Trains until end_step and returns the path of the last checkpoint with the time and number of steps trained so far."""
+
     with tf.Graph().as_default(), tf.device('/cpu:0'):
 
         global_step = tf.Variable(0, trainable=False)
 
         # OPTIMIZER
-        num_training_samples = count_text_lines(args.filenames_file)
-        
-        steps_per_epoch = np.ceil(num_training_samples / params.batch_size).astype(np.int32)
-        num_total_steps = params.num_epochs * steps_per_epoch
-
         boundaries = [np.int32((3/5) * num_total_steps), np.int32((4/5) * num_total_steps)]
         values = [args.learning_rate, args.learning_rate / 2, args.learning_rate / 4]
         learning_rate = tf.train.piecewise_constant(global_step, boundaries, values)
         
         opt_step = tf.train.AdamOptimizer(learning_rate)
 
-        print("Total number of samples: {}".format(num_training_samples))
-        print("Total number of steps: {}".format(num_total_steps))
-
-        dataloader = MonodepthDataloader(args.data_path, args.filenames_file, params, args.mode)
-        top  = dataloader.top_image_batch
-        bottom = dataloader.bottom_image_batch
-
-        # Split for each GPU.
-        top_splits  = tf.split(top,  num_gpus, 0)
-        bottom_splits = tf.split(bottom, num_gpus, 0)
+        dataloader = MonodepthDataloader(args.data_path, args.filenames_file, params, 'train', args.input_seed, teacher_depths_file)
+        input_batches = OrderedDict([('top', dataloader.top_image_batch), ('bottom', dataloader.bottom_image_batch)])
+        if params.input_pyramid:
+            for scale in range(1, 4):
+                input_batches['top_' + str(scale)] = dataloader.top_pyramid_batch[scale]
+                input_batches['bottom_' + str(scale)] = dataloader.bottom_pyramid_batch[scale]
+        if dataloader.teacher_depth_batch is not None:
+            input_batches['teacher_depth'] = dataloader.teacher_depth_batch
 
-        tower_grads  = []
-        tower_losses = []
-        reuse_variables = None
-        with tf.variable_scope(tf.get_variable_scope()):
-            for i in range(num_gpus):
-                with tf.device('/gpu:%d' % i):
+        # Every tower stages its inputs on its own device.
+        devices = [tower_device(i) for i in range(num_towers)]
+        stage_op, staged_inputs = stage_inputs(input_batches, devices)
 
-                    model = MonodepthModel(params, args.mode, top_splits[i], bottom_splits[i], reuse_variables, i)
+        tower_losses, tower_grads = build_towers(params, opt_step, staged_inputs, devices)
 
-                    loss = model.total_loss
-                    tower_losses.append(loss)
-
-                    reuse_variables = True
-
-                    grads = opt_step.compute_gradients(loss)
-
-                    tower_grads.append(grads)
-
-        grads = average_gradients(tower_grads)
+        with tf.name_scope('gradient_aggregation'):
+            grads = average_gradients(tower_grads)
 
         apply_gradient_op = opt_step.apply_gradients(grads, global_step=global_step)
+        train_op = tf.group(apply_gradient_op, dataloader.advance_position_op)
 
         total_loss = tf.reduce_mean(tower_losses)
         
@@ -121,15 +211,23 @@ def train(params):
         tf.summary.scalar('total_loss', total_loss, ['model_0'])
         summary_op = tf.summary.merge_all('model_0')
 
+        queue_runners = tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS)
+        queue_sizes = [queue_runner.queue.size() for queue_runner in queue_runners]
+
         # SESSION
         config = tf.ConfigProto(allow_soft_placement=True)
         config.gpu_options.allow_growth=True
+        if args.virtual_cpus > 0:
+            config.device_count['CPU'] = args.virtual_cpus
         session = tf.Session(config=config)
 
         # SAVER
         summary_writer = tf.summary.FileWriter(args.log_directory + '/' + args.model_name, session.graph)
-        res_vars = slim.get_variables_to_restore(exclude = ["model/scaling"])
+        res_vars = slim.get_variables_to_restore()
         train_saver = tf.train.Saver(res_vars)
+        step_monitor = StepMonitor(args.log_directory + '/' + args.model_name, params.batch_size, summary_writer,
+                                   [queue_runner.name for queue_runner in queue_runners], trace_interval=args.stats_trace_interval)
+        step_profiler = StepProfiler(args.log_directory + '/' + args.model_name, args.profile_steps, args.profile_signal_steps)
 
         # COUNT PARAMS 
         total_num_parameters = 0
@@ -140,35 +238,156 @@ def train(params):
         # INIT
         session.run(tf.global_variables_initializer())
         session.run(tf.local_variables_initializer())
-        coordinator = tf.train.Coordinator()
-        threads = tf.train.start_queue_runners(sess=session, coord=coordinator)
 
         # LOAD CHECKPOINT IF SET
-        if args.checkpoint_path != '':
-            train_saver.restore(session, args.checkpoint_path)
+        if checkpoint_path != '':
+            restore_checkpoint(session, checkpoint_path, res_vars)
             
-            if args.retrain:
+            if retrain:
                 session.run(global_step.assign(0))
+                session.run(dataloader.reset_position_op)
 
-        # GO!
+        # Resume reading from the restored input position before the queues start filling.
+        session.run(dataloader.restore_position_op)
+        coordinator = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess=session, coord=coordinator)
+
+        # Stage the inputs of the first step, unless there is no step left to train.
         start_step = global_step.eval(session=session)
+        input_prefetcher = InputPrefetcher(session, [stage_op, queue_sizes])
+        if start_step < end_step:
+            input_prefetcher.start()
+
+        # GO!
         start_time = time.time()
-        for step in range(start_step, num_total_steps):
+        for step in range(start_step, end_step):
+            timings = {}
+
+            # Only the part of the staging that did not overlap with the previous step is waited for.
             before_op_time = time.time()
-            _, loss_value = session.run([apply_gradient_op, total_loss])
-            duration = time.time() - before_op_time
-            if step and step % 100 == 0:
-                examples_per_sec = params.batch_size / duration
-                time_sofar = (time.time() - start_time) / 3600
-                training_time_left = (num_total_steps / step - 1.0) * time_sofar
+            _, queue_levels = input_prefetcher.wait()
+            timings['input_wait'] = time.time() - before_op_time
+            if step + 1 < end_step:
+                input_prefetcher.start()
+
+            run_options, run_metadata = step_profiler.trace_options(step)
+            if run_options is None:
+                run_options, run_metadata = step_monitor.trace_options(step)
+            # Summaries are fetched with the training step so they describe the same batch as the loss.
+            log_step = step and step % 100 == 0
+            fetches = [train_op, total_loss]
+            if log_step:
+                fetches.append(summary_op)
+            before_op_time = time.time()
+            results = session.run(fetches, options=run_options, run_metadata=run_metadata)
+            timings['compute'] = time.time() - before_op_time
+            loss_value = results[1]
+            step_monitor.update_trace(run_metadata)
+            step_profiler.record(step, run_metadata)
+
+            if log_step:
+                examples_per_sec = step_monitor.average_examples_per_sec()
+                time_sofar = (trained_time + time.time() - start_time) / 3600
+                training_time_left = (num_total_steps - step - 1) / (trained_steps + step - start_step + 1) * time_sofar
                 print_string = 'Batch {:>6} | Examples/s: {:4.2f} | Loss: {:.5f} | Time elapsed: {:.2f}h | Time left: {:.2f}h'
                 print(print_string.format(step, examples_per_sec, loss_value, time_sofar, training_time_left))
-                summary_str = session.run(summary_op)
-                summary_writer.add_summary(summary_str, global_step=step)
+                before_op_time = time.time()
+                summary_writer.add_summary(results[2], global_step=step)
+                timings['summary'] = time.time() - before_op_time
             if step and step % 10000 == 0:
+                before_op_time = time.time()
                 train_saver.save(session, args.log_directory + '/' + args.model_name + '/model', global_step=step)
+                timings['checkpoint'] = time.time() - before_op_time
+
+            step_monitor.record(step, timings, queue_levels)
+
+        trained_time += time.time() - start_time
+        if start_step < end_step:
+            trained_steps += end_step - start_step
+            checkpoint_path = train_saver.save(session, args.log_directory + '/' + args.model_name + '/model', global_step=end_step)
+        step_monitor.close()
+
+        coordinator.request_stop()
+        coordinator.join(threads, stop_grace_period_secs=10)
+        session.close()
+
+    return checkpoint_path, trained_time, trained_steps
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def checkpoint_signature(checkpoint_path):
+    # Size and modification time of the index of the checkpoint, or of the checkpoint file itself for V1 checkpoints.
+    path = checkpoint_path + '.index' if os.path.isfile(checkpoint_path + '.index') else checkpoint_path
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+def build_teacher_cache(params):
+    """Caches the depths of the teacher for every training sample and returns the path of the cache."""
+
+    num_samples = count_text_lines(args.filenames_file)
+
+    cache_directory = args.log_directory + '/' + args.model_name
+    cache_path = cache_directory + '/teacher_depths.npy'
+    info_path = cache_directory + '/teacher_depths.json'
+    cache_info = {
+        'filenames_file': os.path.abspath(args.filenames_file),
+        'filenames_hash': file_hash(args.filenames_file),
+        'num_samples': num_samples,
+        'height': params.height,
+        'width': params.width,
+        'teacher_checkpoint_path': os.path.abspath(args.teacher_checkpoint_path),
+        'teacher_checkpoint': checkpoint_signature(args.teacher_checkpoint_path),
+        'teacher_encoder': args.teacher_encoder,
+        'teacher_projection': args.teacher_projection or params.projection
+    }
+
+    # Reuse the cache if it was completed for the same teacher and training files.
+    if os.path.isfile(cache_path) and os.path.isfile(info_path):
+        with open(info_path, 'r') as f:
+            if json.load(f) == cache_info:
+                print('Using cached teacher depths {}'.format(cache_path))
+                return cache_path
+        os.remove(info_path)
+
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+
+    teacher_params = params._replace(encoder=cache_info['teacher_encoder'], projection=cache_info['teacher_projection'],
+                                     channel_config='', output_scale=0, polar_face_scale=1)
+    with tf.Graph().as_default():
+        dataloader = MonodepthDataloader(args.data_path, args.filenames_file, teacher_params, 'test')
+        model = MonodepthModel(teacher_params, 'test', dataloader.top_image_batch, None)
+        depth = model.depth_est[0][0]
 
-        train_saver.save(session, args.log_directory + '/' + args.model_name + '/model', global_step=num_total_steps)
+        config = tf.ConfigProto(allow_soft_placement=True)
+        session = tf.Session(config=config)
+        session.run(tf.global_variables_initializer())
+        session.run(tf.local_variables_initializer())
+        restore_checkpoint(session, args.teacher_checkpoint_path, tf.global_variables())
+        coordinator = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess=session, coord=coordinator)
+
+        # Half precision halves the size of the cache, clip far depths to keep them finite.
+        print('caching teacher depths for {} files'.format(num_samples))
+        max_depth = np.finfo(np.float16).max
+        teacher_depths = np.lib.format.open_memmap(cache_path, mode='w+', dtype=np.float16,
+                                                   shape=(num_samples, params.height, params.width, 2))
+        for index in range(num_samples):
+            teacher_depths[index] = np.minimum(session.run(depth), max_depth)
+        teacher_depths.flush()
+        del teacher_depths
+
+        coordinator.request_stop()
+        coordinator.join(threads)
+        session.close()
+
+    # The info file is written last and marks the cache as complete.
+    with open(info_path, 'w') as f:
+        json.dump(cache_info, f)
+
+    return cache_path
 
 def test(params):
     """Test function."""
@@ -177,15 +396,13 @@ def test(params):
     top  = dataloader.top_image_batch
     bottom = dataloader.bottom_image_batch
     
-    model = MonodepthModel(params, args.mode, top, bottom)
+    conv_stack = tflite_conv_stack(args.quantized_conv_stack) if args.quantized_conv_stack != '' else None
+    model = MonodepthModel(params, args.mode, top, bottom, conv_stack = conv_stack)
 
     # SESSION
     config = tf.ConfigProto(allow_soft_placement=True)
     session = tf.Session(config=config)
 
-    # SAVER
-    train_saver = tf.train.Saver()
-
     # INIT
     session.run(tf.global_variables_initializer())
     session.run(tf.local_variables_initializer())
@@ -197,12 +414,12 @@ def test(params):
         restore_path = tf.train.latest_checkpoint(args.log_directory + '/' + args.model_name)
     else:
         restore_path = args.checkpoint_path
-    train_saver.restore(session, restore_path)
+    restore_checkpoint(session, restore_path, tf.global_variables())
 
     num_test_samples = count_text_lines(args.filenames_file)
 
     print('now testing {} files'.format(num_test_samples))
-    disparities    = np.zeros((num_test_samples, params.height, params.width), dtype=np.float32)
+    disparities    = np.zeros((num_test_samples, params.height // 2 ** params.output_scale, params.width // 2 ** params.output_scale), dtype=np.float32)
     for step in range(num_test_samples):
         disp = session.run(model.disparity_top_est[0])
         disparities[step] = disp[0].squeeze()
@@ -227,16 +444,26 @@ def main(_):
         num_threads=args.num_threads,
         num_epochs=args.num_epochs,
         projection=args.projection,
+        encoder=args.encoder,
+        channel_config=args.channel_config,
+        polar_face_scale=args.polar_face_scale,
         use_deconv=args.use_deconv,
+        output_scale=args.output_scale,
+        loss_sampling=args.loss_sampling,
+        loss_samples=args.loss_samples,
+        input_pyramid=args.input_pyramid,
         alpha_image_loss=args.alpha_image_loss, 
         depth_gradient_loss_weight=args.depth_gradient_loss_weight,
         tb_loss_weight=args.tb_loss_weight,
+        distillation_loss_weight=args.distillation_loss_weight,
         full_summary=args.full_summary)
 
     if args.mode == 'train':
         train(params)
     elif args.mode == 'test':
         test(params)
+    elif args.mode == 'distill':
+        train(params, build_teacher_cache(params))
 
 if __name__ == '__main__':
     tf.app.run()
\ No newline at end of file
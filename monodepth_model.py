@@ -13,12 +13,13 @@
     http://visual.cs.ucl.ac.uk/pubs/monoDepth/
 """
 
+import json
 import numpy as np
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
 
 from bilinear_sampler import *
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from spherical import *
 
 monodepth_parameters = namedtuple('parameters',
@@ -27,24 +28,72 @@ monodepth_parameters = namedtuple('parameters',
                         'num_threads, '
                         'num_epochs, '
                         'projection,'
+                        'polar_face_scale, '
+                        'encoder, '
+                        'channel_config, '
                         'use_deconv, '
+                        'output_scale, '
+                        'loss_sampling, '
+                        'loss_samples, '
+                        'input_pyramid, '
                         'alpha_image_loss, '
                         'depth_gradient_loss_weight, '
                         'tb_loss_weight, '
+                        'distillation_loss_weight, '
                         'full_summary')
 
+def load_channel_config(path):
+    """Layer widths of a pruned model, keyed by layer name, empty for the full model."""
+    if not path:
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# The encoders downsample by 64 and the decoder concatenates the upsampled features with the skips.
+network_stride = 64
+
+def cube_face_sizes(width, polar_face_scale):
+    """Sizes of the cube faces of a panorama, in the order of face_map."""
+    face_size = width // 4
+    face_sizes = [face_size // polar_face_scale if face in polar_faces else face_size for face in face_map]
+    for face, size in zip(face_map, face_sizes):
+        if size == 0 or size % network_stride != 0:
+            raise ValueError("The {} face of a {} pixels wide panorama with polar_face_scale {} is {} pixels, cube faces must be "
+                             "multiples of {} pixels".format(face, width, polar_face_scale, size, network_stride))
+    return face_sizes
+
 class MonodepthModel(object):
     """Monodepth model"""
 
-    def __init__(self, params, mode, top, bottom, reuse_variables = None, model_index = 0):
+    def __init__(self, params, mode, top, bottom, reuse_variables = None, model_index = 0, teacher_depth = None, conv_stack = None,
+                 top_pyramid = None, bottom_pyramid = None):
         self.params = params
         self.mode = mode
         self.top = top
         self.bottom = bottom
+        self.input_top_pyramid = top_pyramid
+        self.input_bottom_pyramid = bottom_pyramid
+        self.teacher_depth = teacher_depth
+        self.conv_stack = conv_stack
         self.model_collection = ['model_' + str(model_index)]
 
         self.reuse_variables = reuse_variables
 
+        # Named layers record their variables and outputs, pruned models override their widths.
+        self.channel_widths = load_channel_config(self.params.channel_config)
+        self.layer_variables = OrderedDict()
+        self.layer_outputs = OrderedDict()
+        # Disparities returned by every call of the network, one per face or one for the panorama.
+        self.network_outputs = []
+
+        # Training needs every scale, at test time only the requested scale is built.
+        if self.mode == 'test':
+            self.output_scale = self.params.output_scale
+            self.num_output_scales = 1
+        else:
+            self.output_scale = 0
+            self.num_output_scales = 4
+
         if self.params.projection == 'cubic':
             self.cubic_net()
         elif self.params.projection == 'equirectangular':
@@ -86,6 +135,11 @@ class MonodepthModel(object):
             scaled_imgs.append(tf.image.resize_area(img, tf.cast([nh, nw], tf.int32)))
         return scaled_imgs
 
+    def input_pyramid(self, pyramid, img):
+        if pyramid is not None:
+            return pyramid
+        return self.scale_pyramid(img, 4)
+
     def pyramid_shapes(self, shape, num_scales):
         shapes = [shape]
         h = shape[0]
@@ -102,6 +156,10 @@ class MonodepthModel(object):
         T_grids = tf.expand_dims(tf.tile(tf.expand_dims(T, 0), [batch_size, 1, 1]), 3)
         return S_grids, T_grids
 
+    def resample_face(self, face_image, shape):
+        # Corner pixels lie on the face edges, as in the backprojection grid.
+        return tf.image.resize_bilinear(face_image, shape, align_corners = True)
+
     def cubic_disparity_to_depth(self, disparity, face, epsilon = 1e-6):
         perpendicular_distance = self.depth_scale / (disparity + epsilon)
         return backproject_cubic(perpendicular_distance, tf.shape(disparity), face)
@@ -128,12 +186,32 @@ class MonodepthModel(object):
         C1 = 0.01 ** 2
         C2 = 0.03 ** 2
 
-        mu_x = slim.avg_pool2d(x, 3, 1, 'VALID')
-        mu_y = slim.avg_pool2d(y, 3, 1, 'VALID')
+        # Pool the five moments in a single call by stacking them along the channels.
+        moments = slim.avg_pool2d(tf.concat([x, y, x ** 2, y ** 2, x * y], 3), 3, 1, 'VALID')
+        mu_x, mu_y, x_2, y_2, xy = tf.split(moments, 5, 3)
 
-        sigma_x  = slim.avg_pool2d(x ** 2, 3, 1, 'VALID') - mu_x ** 2
-        sigma_y  = slim.avg_pool2d(y ** 2, 3, 1, 'VALID') - mu_y ** 2
-        sigma_xy = slim.avg_pool2d(x * y , 3, 1, 'VALID') - mu_x * mu_y
+        sigma_x  = x_2 - mu_x ** 2
+        sigma_y  = y_2 - mu_y ** 2
+        sigma_xy = xy - mu_x * mu_y
+
+        SSIM_n = (2 * mu_x * mu_y + C1) * (2 * sigma_xy + C2)
+        SSIM_d = (mu_x ** 2 + mu_y ** 2 + C1) * (sigma_x + sigma_y + C2)
+
+        SSIM = SSIM_n / SSIM_d
+
+        return tf.clip_by_value((1 - SSIM) / 2, 0, 1)
+
+    # SSIM of [batch, num_samples, 9, channels] 3x3 patches, equal to SSIM at the patch centres.
+    def patch_SSIM(self, x, y):
+        C1 = 0.01 ** 2
+        C2 = 0.03 ** 2
+
+        mu_x = tf.reduce_mean(x, 2)
+        mu_y = tf.reduce_mean(y, 2)
+
+        sigma_x  = tf.reduce_mean(x ** 2, 2) - mu_x ** 2
+        sigma_y  = tf.reduce_mean(y ** 2, 2) - mu_y ** 2
+        sigma_xy = tf.reduce_mean(x * y , 2) - mu_x * mu_y
 
         SSIM_n = (2 * mu_x * mu_y + C1) * (2 * sigma_xy + C2)
         SSIM_d = (mu_x ** 2 + mu_y ** 2 + C1) * (sigma_x + sigma_y + C2)
@@ -156,10 +234,25 @@ class MonodepthModel(object):
         smoothness_y = [depth_gradients_y[i] * weights_y[i] for i in range(4)]
         return smoothness_x + smoothness_y
 
-    def get_disparity(self, x):
-        disparity = self.conv(x, 2, 3, 1, tf.nn.sigmoid)
+    def get_disparity(self, x, name = None):
+        disparity = self.named_layer(name, self.conv, x, 2, 3, 1, tf.nn.sigmoid)
         return disparity
 
+    def named_layer(self, name, layer, x, num_out_layers, *args):
+        if name is None:
+            return layer(x, num_out_layers, *args)
+
+        # The name scope groups the ops of the layer in profiles, variable names do not change.
+        num_variables = len(tf.trainable_variables())
+        with tf.name_scope(name.split('/')[-1]):
+            output = layer(x, self.channel_widths.get(name, num_out_layers), *args)
+
+        # Variables are only created by the first call, later faces and towers reuse them.
+        if name not in self.layer_variables:
+            self.layer_variables[name] = tf.trainable_variables()[num_variables:]
+        self.layer_outputs.setdefault(name, []).append(output)
+        return output
+
     def conv(self, x, num_out_layers, kernel_size, stride, activation_fn = tf.nn.elu):
         p = np.floor((kernel_size - 1) / 2).astype(np.int32)
         p_x = tf.pad(x, [[0, 0], [p, p], [p, p], [0, 0]])
@@ -175,23 +268,24 @@ class MonodepthModel(object):
         p_x = tf.pad(x, [[0, 0], [p, p], [p, p], [0, 0]])
         return slim.max_pool2d(p_x, kernel_size)
 
-    def resconv(self, x, num_layers, stride):
+    def resconv(self, x, num_layers, stride, name):
         do_proj = tf.shape(x)[3] != num_layers or stride == 2
         shortcut = []
-        conv1 = self.conv(x,         num_layers, 1, 1)
-        conv2 = self.conv(conv1,     num_layers, 3, stride)
-        conv3 = self.conv(conv2, 4 * num_layers, 1, 1, None)
+        conv1 = self.named_layer(name + '/conv1', self.conv, x,         num_layers, 1, 1)
+        conv2 = self.named_layer(name + '/conv2', self.conv, conv1,     num_layers, 3, stride)
+        conv3 = self.named_layer(name + '/conv3', self.conv, conv2, 4 * num_layers, 1, 1, None)
         if do_proj:
             shortcut = self.conv(x, 4 * num_layers, 1, stride, None)
         else:
             shortcut = x
         return tf.nn.elu(conv3 + shortcut)
 
-    def resblock(self, x, num_layers, num_blocks):
+    def resblock(self, x, num_layers, num_blocks, name):
         out = x
-        for i in range(num_blocks - 1):
-            out = self.resconv(out, num_layers, 1)
-        out = self.resconv(out, num_layers, 2)
+        with tf.name_scope(name.split('/')[-1]):
+            for i in range(num_blocks - 1):
+                out = self.resconv(out, num_layers, 1, name + '_' + str(i))
+            out = self.resconv(out, num_layers, 2, name + '_' + str(num_blocks - 1))
         return out
 
     def upconv(self, x, num_out_layers, kernel_size, scale):
@@ -204,20 +298,43 @@ class MonodepthModel(object):
         conv = slim.conv2d_transpose(p_x, num_out_layers, kernel_size, scale, 'SAME')
         return conv[:,3:-1,3:-1,:]
 
+    def separable_conv(self, x, num_out_layers, kernel_size, stride, activation_fn = tf.nn.elu):
+        p = np.floor((kernel_size - 1) / 2).astype(np.int32)
+        p_x = tf.pad(x, [[0, 0], [p, p], [p, p], [0, 0]])
+        return slim.separable_conv2d(p_x, num_out_layers, kernel_size, 1, stride, 'VALID', activation_fn = activation_fn)
+
+    def separable_conv_block(self, x, num_out_layers, kernel_size):
+        conv1 = self.separable_conv(x,     num_out_layers, kernel_size, 1)
+        conv2 = self.separable_conv(conv1, num_out_layers, kernel_size, 2)
+        return conv2
+
+    # Returns the disparities from the output scale to the coarsest one.
+    def network(self, input):
+        # A converted conv stack, e.g. the int8 TFLite model, replaces the float layers.
+        if self.conv_stack is not None:
+            disparities = self.conv_stack(input)
+        else:
+            if self.params.encoder == 'vgg':
+                features, skips = self.vgg(input)
+            elif self.params.encoder == 'mobile':
+                features, skips = self.mobile(input)
+            else:
+                features, skips = self.resnet50(input)
+            disparities = self.decoder(features, skips)
+        self.network_outputs.append(disparities)
+        return disparities
+
+    # All encoders return H/64 features and skip connections at H/2, H/4, H/8, H/16 and H/32.
     def resnet50(self, input):
         conv = self.conv
-        if self.params.use_deconv:
-            upconv = self.deconv
-        else:
-            upconv = self.upconv
 
         with tf.variable_scope('encoder'):
             conv1 = conv(input, 64, 7, 2) # H/2  -   64D
             pool1 = self.maxpool(conv1,           3) # H/4  -   64D
-            conv2 = self.resblock(pool1,      64, 3) # H/8  -  256D
-            conv3 = self.resblock(conv2,     128, 4) # H/16 -  512D
-            conv4 = self.resblock(conv3,     256, 6) # H/32 - 1024D
-            conv5 = self.resblock(conv4,     512, 3) # H/64 - 2048D
+            conv2 = self.resblock(pool1,      64, 3, 'encoder/conv2') # H/8  -  256D
+            conv3 = self.resblock(conv2,     128, 4, 'encoder/conv3') # H/16 -  512D
+            conv4 = self.resblock(conv3,     256, 6, 'encoder/conv4') # H/32 - 1024D
+            conv5 = self.resblock(conv4,     512, 3, 'encoder/conv5') # H/64 - 2048D
 
         with tf.variable_scope('skips'):
             skip1 = conv1
@@ -226,46 +343,104 @@ class MonodepthModel(object):
             skip4 = conv3
             skip5 = conv4
 
+        return conv5, [skip1, skip2, skip3, skip4, skip5]
+
+    def vgg(self, input):
+        conv_block = self.conv_block
+
+        with tf.variable_scope('encoder'):
+            conv1 = conv_block(input,  32, 7) # H/2  -  32D
+            conv2 = conv_block(conv1,  64, 5) # H/4  -  64D
+            conv3 = conv_block(conv2, 128, 3) # H/8  - 128D
+            conv4 = conv_block(conv3, 256, 3) # H/16 - 256D
+            conv5 = conv_block(conv4, 512, 3) # H/32 - 512D
+            conv6 = conv_block(conv5, 512, 3) # H/64 - 512D
+
+        with tf.variable_scope('skips'):
+            skip1 = conv1
+            skip2 = conv2
+            skip3 = conv3
+            skip4 = conv4
+            skip5 = conv5
+
+        return conv6, [skip1, skip2, skip3, skip4, skip5]
+
+    def mobile(self, input):
+        conv_block = self.separable_conv_block
+
+        with tf.variable_scope('encoder'):
+            conv1 = self.conv(input,   32, 3, 2) # H/2  -  32D
+            conv2 = conv_block(conv1,  64, 3) # H/4  -  64D
+            conv3 = conv_block(conv2, 128, 3) # H/8  - 128D
+            conv4 = conv_block(conv3, 256, 3) # H/16 - 256D
+            conv5 = conv_block(conv4, 512, 3) # H/32 - 512D
+            conv6 = conv_block(conv5, 512, 3) # H/64 - 512D
+
+        with tf.variable_scope('skips'):
+            skip1 = conv1
+            skip2 = conv2
+            skip3 = conv3
+            skip4 = conv4
+            skip5 = conv5
+
+        return conv6, [skip1, skip2, skip3, skip4, skip5]
+
+    def decoder(self, features, skips):
+        conv = self.conv
+        if self.params.use_deconv:
+            upconv = self.deconv
+        else:
+            upconv = self.upconv
+        layer = self.named_layer
+
+        skip1, skip2, skip3, skip4, skip5 = skips
+
         # DECODING
         with tf.variable_scope('decoder'):
-            upconv6 = upconv(conv5,   512, 3, 2) #H/32
+            upconv6 = layer('decoder/upconv6', upconv, features, 512, 3, 2) #H/32
             concat6 = tf.concat([upconv6, skip5], 3)
-            iconv6  = conv(concat6,   512, 3, 1)
+            iconv6  = layer('decoder/iconv6', conv, concat6, 512, 3, 1)
 
-            upconv5 = upconv(iconv6, 256, 3, 2) #H/16
+            upconv5 = layer('decoder/upconv5', upconv, iconv6, 256, 3, 2) #H/16
             concat5 = tf.concat([upconv5, skip4], 3)
-            iconv5  = conv(concat5,   256, 3, 1)
+            iconv5  = layer('decoder/iconv5', conv, concat5, 256, 3, 1)
 
-            upconv4 = upconv(iconv5,  128, 3, 2) #H/8
+            upconv4 = layer('decoder/upconv4', upconv, iconv5, 128, 3, 2) #H/8
             concat4 = tf.concat([upconv4, skip3], 3)
-            iconv4  = conv(concat4,   128, 3, 1)
-            disparity4 = self.get_disparity(iconv4)
+            iconv4  = layer('decoder/iconv4', conv, concat4, 128, 3, 1)
+            disparity4 = self.get_disparity(iconv4, 'decoder/disparity4')
+            if self.output_scale == 3:
+                return [disparity4]
             udepth4  = self.upsample_nn(disparity4, 2)
 
-            upconv3 = upconv(iconv4,   64, 3, 2) #H/4
+            upconv3 = layer('decoder/upconv3', upconv, iconv4, 64, 3, 2) #H/4
             concat3 = tf.concat([upconv3, skip2, udepth4], 3)
-            iconv3  = conv(concat3,    64, 3, 1)
-            disparity3 = self.get_disparity(iconv3)
+            iconv3  = layer('decoder/iconv3', conv, concat3, 64, 3, 1)
+            disparity3 = self.get_disparity(iconv3, 'decoder/disparity3')
+            if self.output_scale == 2:
+                return [disparity3, disparity4]
             udepth3  = self.upsample_nn(disparity3, 2)
 
-            upconv2 = upconv(iconv3,   32, 3, 2) #H/2
+            upconv2 = layer('decoder/upconv2', upconv, iconv3, 32, 3, 2) #H/2
             concat2 = tf.concat([upconv2, skip1, udepth3], 3)
-            iconv2  = conv(concat2,    32, 3, 1)
-            disparity2 = self.get_disparity(iconv2)
+            iconv2  = layer('decoder/iconv2', conv, concat2, 32, 3, 1)
+            disparity2 = self.get_disparity(iconv2, 'decoder/disparity2')
+            if self.output_scale == 1:
+                return [disparity2, disparity3, disparity4]
             udepth2  = self.upsample_nn(disparity2, 2)
 
-            upconv1 = upconv(iconv2,  16, 3, 2) #H
+            upconv1 = layer('decoder/upconv1', upconv, iconv2, 16, 3, 2) #H
             concat1 = tf.concat([upconv1, udepth2], 3)
-            iconv1  = conv(concat1,   16, 3, 1)
-            disparity1 = self.get_disparity(iconv1)
+            iconv1  = layer('decoder/iconv1', conv, concat1, 16, 3, 1)
+            disparity1 = self.get_disparity(iconv1, 'decoder/disparity1')
 
-            return disparity1, disparity2, disparity3, disparity4
+            return [disparity1, disparity2, disparity3, disparity4]
 
     def equirectangular_net(self):
         with slim.arg_scope([slim.conv2d, slim.conv2d_transpose], activation_fn = tf.nn.elu):
             with tf.variable_scope('model', reuse = self.reuse_variables) as scope:
-                # Calculate pyramid for equirectangular top image.
-                self.top_pyramid = self.scale_pyramid(self.top, 4)
+                # Calculate pyramid for equirectangular top image, unless the dataloader built it.
+                self.top_pyramid = self.input_pyramid(self.input_top_pyramid, self.top)
 
                 with tf.variable_scope("scaling"):
                     self.depth_scale = tf.constant(1.0, shape = [1])
@@ -274,23 +449,23 @@ class MonodepthModel(object):
 
                 if self.mode == 'train':
                     # Calculate pyramid for equirectangular bottom image.
-                    self.bottom_pyramid = self.scale_pyramid(self.bottom, 4)
+                    self.bottom_pyramid = self.input_pyramid(self.input_bottom_pyramid, self.bottom)
 
-                disparity1, disparity2, disparity3, disparity4 = self.resnet50(self.top)
-                self.depth1 = self.equirectangular_disparity_to_depth(disparity1)
-                self.depth2 = self.equirectangular_disparity_to_depth(disparity2)
-                self.depth3 = self.equirectangular_disparity_to_depth(disparity3)
-                self.depth4 = self.equirectangular_disparity_to_depth(disparity4)
+                # The network returns the disparities from the output scale to the coarsest one.
+                disparities = self.network(self.top)
+                self.depth_est = [self.equirectangular_disparity_to_depth(disparities[i]) for i in range(self.num_output_scales)]
 
     def cubic_net(self):
         batch_size = tf.shape(self.top)[0]
         with slim.arg_scope([slim.conv2d, slim.conv2d_transpose], activation_fn = tf.nn.elu):
             with tf.variable_scope('model', reuse = self.reuse_variables) as scope:
-                # Calculate pyramid for equirectangular top image.
-                self.top_pyramid = self.scale_pyramid(self.top, 4)
+                # Calculate pyramid for equirectangular top image, unless the dataloader built it.
+                self.top_pyramid = self.input_pyramid(self.input_top_pyramid, self.top)
 
-                # Convert top image into cubic format.
-                self.top_faces = [tf.reshape(face, [batch_size, 128, 128, 3]) for face in equirectangular_to_cubic(self.top, [128, 128])]
+                # Convert top image into cubic format, the faces cover a quarter of the panorama width.
+                # The up and down faces can be processed at a reduced resolution.
+                face_sizes = cube_face_sizes(self.params.width, self.params.polar_face_scale)
+                self.top_faces = [tf.reshape(project_face(self.top, face, [size, size]), [batch_size, size, size, 3]) for face, size in zip(face_map, face_sizes)]
 
                 with tf.variable_scope("scaling"):
                     self.depth_scale = tf.get_variable("depth_scale", shape = [1], trainable = True, initializer = tf.constant_initializer(1.0))
@@ -298,40 +473,42 @@ class MonodepthModel(object):
 
                 if self.mode == 'train':
                     # Calculate pyramid for equirectangular bottom image.
-                    self.bottom_pyramid = self.scale_pyramid(self.bottom, 4)
+                    self.bottom_pyramid = self.input_pyramid(self.input_bottom_pyramid, self.bottom)
 
                 # Calculate disparity and depth maps for each face direction individually.
-                depth_map_pyramids = [[] for index in range(4)]
-                pyramid_shapes = self.pyramid_shapes([256, 512], 4)
+                # Only the output scales are converted, the network returns them from the finest one.
+                depth_map_pyramids = [[] for index in range(self.num_output_scales)]
+                pyramid_shapes = self.pyramid_shapes([self.params.height, self.params.width], 4)[self.output_scale:]
 
                 for face_index in range(6):
-                    disparity1, disparity2, disparity3, disparity4 = self.resnet50(self.top_faces[face_index])
+                    disparities = self.network(self.top_faces[face_index])
                     if face_index < 5:
                         scope.reuse_variables()
 
-                    depth_map_pyramids[0].append(self.cubic_disparity_to_depth(disparity1, face_map[face_index]))
-                    depth_map_pyramids[1].append(self.cubic_disparity_to_depth(disparity2, face_map[face_index]))
-                    depth_map_pyramids[2].append(self.cubic_disparity_to_depth(disparity3, face_map[face_index]))
-                    depth_map_pyramids[3].append(self.cubic_disparity_to_depth(disparity4, face_map[face_index]))
+                    for scale_index in range(self.num_output_scales):
+                        depth_map_pyramids[scale_index].append(self.cubic_disparity_to_depth(disparities[scale_index], face_map[face_index]))
+
+                # Upsample reduced resolution faces to the size of the other faces before stacking them.
+                if self.params.polar_face_scale > 1:
+                    for scale_index in range(self.num_output_scales):
+                        face_shape = tf.shape(depth_map_pyramids[scale_index][0])[1:3]
+                        depth_map_pyramids[scale_index] = [
+                            self.resample_face(depth_map, face_shape) if face in polar_faces else depth_map
+                            for face, depth_map in zip(face_map, depth_map_pyramids[scale_index])
+                        ]
 
                 # Convert depth maps to equirectangular format.
-                depth_maps = [
+                self.depth_est = [
                     cubic_to_equirectangular(
                         depth_map_pyramids[scale_index],
                         pyramid_shapes[scale_index]
                     )
-                    for scale_index in range(4)
+                    for scale_index in range(self.num_output_scales)
                 ]
 
-                self.depth1 = depth_maps[0]
-                self.depth2 = depth_maps[1]
-                self.depth3 = depth_maps[2]
-                self.depth4 = depth_maps[3]
-
     def build_outputs(self):
         # Store depth maps.
         with tf.variable_scope('depths'):
-            self.depth_est  = [self.depth1, self.depth2, self.depth3, self.depth4]
             self.depth_top_est  = [tf.expand_dims(depth[:,:,:,0], 3) for depth in self.depth_est]
             self.depth_bottom_est = [tf.expand_dims(depth[:,:,:,1], 3) for depth in self.depth_est]
 
@@ -340,37 +517,143 @@ class MonodepthModel(object):
             self.disparity_top_est = [self.depth_to_disparity(depth, "top") for depth in self.depth_top_est]
             self.disparity_bottom_est = [self.depth_to_disparity(depth, "bottom") for depth in self.depth_bottom_est]
 
+        # There is no bottom image to reconstruct from at test time.
+        if self.mode == 'test':
+            return
+
+        # Edge-aware depth smoothness.
+        with tf.variable_scope('smoothness'):
+            self.depth_top_smoothness  = self.get_depth_smoothness(self.depth_top_est,  self.top_pyramid)
+            self.depth_bottom_smoothness = self.get_depth_smoothness(self.depth_bottom_est, self.bottom_pyramid)
+
+        # Sampled losses only warp the images at the sampled pixels.
+        if self.params.loss_sampling:
+            return
+
         # Generate top and bottom images.
         with tf.variable_scope('images'):
             self.top_est  = [self.generate_image_top(self.bottom_pyramid[i], self.disparity_top_est[i])  for i in range(4)]
             self.bottom_est = [self.generate_image_bottom(self.top_pyramid[i], self.disparity_bottom_est[i]) for i in range(4)]
 
-        if self.mode == 'test':
-            return
-
         # Top-bottom consistency.
         with tf.variable_scope('top-bottom'):
             self.bottom_to_top_depth = [self.generate_image_top(self.depth_bottom_est[i], self.disparity_top_est[i])  for i in range(4)]
             self.top_to_bottom_depth = [self.generate_image_bottom(self.depth_top_est[i], self.disparity_bottom_est[i]) for i in range(4)]
 
-        # Edge-aware depth smoothness.
-        with tf.variable_scope('smoothness'):
-            self.depth_top_smoothness  = self.get_depth_smoothness(self.depth_top_est,  self.top_pyramid)
-            self.depth_bottom_smoothness = self.get_depth_smoothness(self.depth_bottom_est, self.bottom_pyramid)
+    def build_dense_losses(self):
+        # L1
+        self.l1_top = [tf.abs(self.top_est[i] - self.top_pyramid[i]) for i in range(4)]
+        self.l1_reconstruction_loss_top  = [tf.reduce_mean(l) for l in self.l1_top]
+        self.l1_bottom = [tf.abs(self.bottom_est[i] - self.bottom_pyramid[i]) for i in range(4)]
+        self.l1_reconstruction_loss_bottom = [tf.reduce_mean(l) for l in self.l1_bottom]
+
+        # SSIM, top and bottom views are batched through a single call per scale.
+        ssim = [self.SSIM(tf.concat([self.top_est[i], self.bottom_est[i]], 0), tf.concat([self.top_pyramid[i], self.bottom_pyramid[i]], 0)) for i in range(4)]
+        self.ssim_top = [s[:tf.shape(self.top_est[i])[0]] for i, s in enumerate(ssim)]
+        self.ssim_loss_top  = [tf.reduce_mean(s) for s in self.ssim_top]
+        self.ssim_bottom = [s[tf.shape(self.top_est[i])[0]:] for i, s in enumerate(ssim)]
+        self.ssim_loss_bottom = [tf.reduce_mean(s) for s in self.ssim_bottom]
+
+        # TB CONSISTENCY
+        self.tb_top_loss  = [tf.reduce_mean(tf.abs(self.bottom_to_top_depth[i] - self.depth_top_est[i]))  for i in range(4)]
+        self.tb_bottom_loss = [tf.reduce_mean(tf.abs(self.top_to_bottom_depth[i] - self.depth_bottom_est[i])) for i in range(4)]
+
+    def sample_loss_pixels(self, top, bottom):
+        """Draws the loss pixels of one scale with their importance weights.
+
+        Pixels are drawn uniformly or, with gradient sampling, half uniformly and half proportionally
+        to the image gradients. Weighting each sample by 1 / (num_pixels * probability) keeps the mean
+        over the samples an unbiased estimate of the mean over all pixels.
+        """
+        batch_size = tf.shape(top)[0]
+        height = tf.shape(top)[1]
+        width = tf.shape(top)[2]
+        num_pixels = height * width
+        num_samples = self.params.loss_samples
+
+        if self.params.loss_sampling == 'gradient':
+            gradients = [tf.reduce_mean(tf.abs(g), 3) for image in [top, bottom] for g in [self.gradient_x(image), self.gradient_y(image)]]
+            magnitude = tf.add_n([tf.pad(gradients[0], [[0, 0], [0, 0], [0, 1]]), tf.pad(gradients[1], [[0, 0], [0, 1], [0, 0]]),
+                                  tf.pad(gradients[2], [[0, 0], [0, 0], [0, 1]]), tf.pad(gradients[3], [[0, 0], [0, 1], [0, 0]])])
+            magnitude = tf.reshape(magnitude, tf.stack([batch_size, num_pixels]))
+            probabilities = 0.5 / tf.cast(num_pixels, tf.float32) + 0.5 * magnitude / (tf.reduce_sum(magnitude, 1, keep_dims = True) + 1e-12)
+            indices = tf.cast(tf.multinomial(tf.log(probabilities), num_samples), tf.int32)
+            sample_probabilities = tf.gather_nd(probabilities, tf.stack([tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, num_samples]), indices], 2))
+            weights = 1.0 / (tf.cast(num_pixels, tf.float32) * sample_probabilities)
+        else:
+            indices = tf.random_uniform(tf.stack([batch_size, num_samples]), 0, num_pixels, tf.int32)
+            weights = tf.ones(tf.stack([batch_size, num_samples]))
+
+        rows = indices // width
+        columns = indices % width
+        return rows, columns, tf.stop_gradient(weights)
+
+    def build_sampled_losses(self):
+        # The 3x3 neighbourhood of every sample is gathered for SSIM, the centre is used for L1 and TB consistency.
+        offsets = [(dy, dx) for dy in [-1, 0, 1] for dx in [-1, 0, 1]]
+        centre = 4
+
+        self.l1_reconstruction_loss_top, self.l1_reconstruction_loss_bottom = [], []
+        self.ssim_loss_top, self.ssim_loss_bottom = [], []
+        self.tb_top_loss, self.tb_bottom_loss = [], []
+        for i in range(4):
+            top = self.top_pyramid[i]
+            bottom = self.bottom_pyramid[i]
+            batch_size = tf.shape(top)[0]
+            height = tf.shape(top)[1]
+            width = tf.shape(top)[2]
+            num_samples = self.params.loss_samples
+
+            rows, columns, weights = self.sample_loss_pixels(top, bottom)
+            height_f = tf.cast(height - 1, tf.float32)
+            width_f = tf.cast(width - 1, tf.float32)
+            # Neighbours outside the image repeat the border, these samples are excluded from SSIM below.
+            x = tf.stack([tf.cast(tf.clip_by_value(columns + dx, 0, width - 1), tf.float32) / width_f for dy, dx in offsets], 2)
+            y = tf.stack([tf.cast(tf.clip_by_value(rows + dy, 0, height - 1), tf.float32) / height_f for dy, dx in offsets], 2)
+            x = tf.reshape(x, tf.stack([batch_size, 9 * num_samples]))
+            y = tf.reshape(y, tf.stack([batch_size, 9 * num_samples]))
+
+            # SSIM is only defined away from the borders, the indicator and the ratio of areas keep it unbiased.
+            interior = tf.cast((rows > 0) & (rows < height - 1) & (columns > 0) & (columns < width - 1), tf.float32)
+            ssim_weights = weights * interior * tf.cast(height * width, tf.float32) / tf.cast((height - 2) * (width - 2), tf.float32)
+
+            with tf.variable_scope('images'):
+                patch_shape = tf.stack([batch_size, num_samples, 9, -1])
+                disparity_top = sample_points(self.disparity_top_est[i], x, y)[:, :, 0]
+                disparity_bottom = sample_points(self.disparity_bottom_est[i], x, y)[:, :, 0]
+                top_est = tf.reshape(sample_points(bottom, x, y + disparity_top), patch_shape)
+                bottom_est = tf.reshape(sample_points(top, x, y - disparity_bottom), patch_shape)
+                top_patch = tf.reshape(sample_points(top, x, y), patch_shape)
+                bottom_patch = tf.reshape(sample_points(bottom, x, y), patch_shape)
 
-    def build_losses(self):
-        with tf.variable_scope('losses', reuse = self.reuse_variables):
             # L1
-            self.l1_top = [tf.abs(self.top_est[i] - self.top_pyramid[i]) for i in range(4)]
-            self.l1_reconstruction_loss_top  = [tf.reduce_mean(l) for l in self.l1_top]
-            self.l1_bottom = [tf.abs(self.bottom_est[i] - self.bottom_pyramid[i]) for i in range(4)]
-            self.l1_reconstruction_loss_bottom = [tf.reduce_mean(l) for l in self.l1_bottom]
+            self.l1_reconstruction_loss_top.append(tf.reduce_mean(weights * tf.reduce_mean(tf.abs(top_est[:, :, centre] - top_patch[:, :, centre]), 2)))
+            self.l1_reconstruction_loss_bottom.append(tf.reduce_mean(weights * tf.reduce_mean(tf.abs(bottom_est[:, :, centre] - bottom_patch[:, :, centre]), 2)))
 
             # SSIM
-            self.ssim_top = [self.SSIM(self.top_est[i],  self.top_pyramid[i]) for i in range(4)]
-            self.ssim_loss_top  = [tf.reduce_mean(s) for s in self.ssim_top]
-            self.ssim_bottom = [self.SSIM(self.bottom_est[i], self.bottom_pyramid[i]) for i in range(4)]
-            self.ssim_loss_bottom = [tf.reduce_mean(s) for s in self.ssim_bottom]
+            self.ssim_loss_top.append(tf.reduce_mean(ssim_weights * tf.reduce_mean(self.patch_SSIM(top_est, top_patch), 2)))
+            self.ssim_loss_bottom.append(tf.reduce_mean(ssim_weights * tf.reduce_mean(self.patch_SSIM(bottom_est, bottom_patch), 2)))
+
+            # TB CONSISTENCY
+            with tf.variable_scope('top-bottom'):
+                centre_x = tf.reshape(x, tf.stack([batch_size, num_samples, 9]))[:, :, centre]
+                centre_y = tf.reshape(y, tf.stack([batch_size, num_samples, 9]))[:, :, centre]
+                centre_disparity_top = tf.reshape(disparity_top, tf.stack([batch_size, num_samples, 9]))[:, :, centre]
+                centre_disparity_bottom = tf.reshape(disparity_bottom, tf.stack([batch_size, num_samples, 9]))[:, :, centre]
+                depth_top = sample_points(self.depth_top_est[i], centre_x, centre_y)[:, :, 0]
+                depth_bottom = sample_points(self.depth_bottom_est[i], centre_x, centre_y)[:, :, 0]
+                bottom_to_top_depth = sample_points(self.depth_bottom_est[i], centre_x, centre_y + centre_disparity_top)[:, :, 0]
+                top_to_bottom_depth = sample_points(self.depth_top_est[i], centre_x, centre_y - centre_disparity_bottom)[:, :, 0]
+
+            self.tb_top_loss.append(tf.reduce_mean(weights * tf.abs(bottom_to_top_depth - depth_top)))
+            self.tb_bottom_loss.append(tf.reduce_mean(weights * tf.abs(top_to_bottom_depth - depth_bottom)))
+
+    def build_losses(self):
+        with tf.variable_scope('losses', reuse = self.reuse_variables):
+            if self.params.loss_sampling:
+                self.build_sampled_losses()
+            else:
+                self.build_dense_losses()
 
             # WEIGTHED SUM
             self.image_loss_bottom = [self.params.alpha_image_loss * self.ssim_loss_bottom[i] + (1 - self.params.alpha_image_loss) * self.l1_reconstruction_loss_bottom[i] for i in range(4)]
@@ -383,13 +666,18 @@ class MonodepthModel(object):
             self.depth_gradient_loss = tf.add_n(self.depth_top_loss + self.depth_bottom_loss)
 
             # TB CONSISTENCY
-            self.tb_top_loss  = [tf.reduce_mean(tf.abs(self.bottom_to_top_depth[i] - self.depth_top_est[i]))  for i in range(4)]
-            self.tb_bottom_loss = [tf.reduce_mean(tf.abs(self.top_to_bottom_depth[i] - self.depth_bottom_est[i])) for i in range(4)]
             self.tb_loss = tf.add_n(self.tb_top_loss + self.tb_bottom_loss)
 
             # TOTAL LOSS
             self.total_loss = self.image_loss + self.params.depth_gradient_loss_weight * self.depth_gradient_loss + self.params.tb_loss_weight * self.tb_loss
 
+            # DISTILLATION
+            if self.teacher_depth is not None:
+                self.teacher_depth_pyramid = self.scale_pyramid(self.teacher_depth, 4)
+                self.distillation_loss_scales = [tf.reduce_mean(tf.abs(tf.log(self.depth_est[i] + 1e-6) - tf.log(self.teacher_depth_pyramid[i] + 1e-6))) for i in range(4)]
+                self.distillation_loss = tf.add_n(self.distillation_loss_scales)
+                self.total_loss += self.params.distillation_loss_weight * self.distillation_loss
+
     # Normalize images to be between 0 and 1.
     def normalize_image(self, input_images):
         max = tf.reduce_max(input_images, axis = [1, 2], keep_dims = True)
@@ -401,6 +689,8 @@ class MonodepthModel(object):
         return self.normalize_image(tf.log(1.0 + input_images))
 
     def build_summaries(self):
+        # Image summaries only keep the first max_outputs images, slice them before any normalisation.
+        max_outputs = 4
         with tf.device('/cpu:0'):
             for i in [0]:
                 # Scalar summaries.
@@ -409,21 +699,29 @@ class MonodepthModel(object):
                 tf.summary.scalar('image_loss_' + str(i), self.image_loss_top[i] + self.image_loss_bottom[i], collections=self.model_collection)
                 tf.summary.scalar('depth_gradient_loss_' + str(i), self.depth_top_loss[i] + self.depth_bottom_loss[i], collections=self.model_collection)
                 tf.summary.scalar('tb_loss_' + str(i), self.tb_top_loss[i] + self.tb_bottom_loss[i], collections=self.model_collection)
+                if self.teacher_depth is not None:
+                    tf.summary.scalar('distillation_loss_' + str(i), self.distillation_loss_scales[i], collections=self.model_collection)
                 tf.summary.scalar('depth_scale', tf.reshape(self.depth_scale, []), collections=self.model_collection)
                 tf.summary.scalar('disparity_scale', tf.reshape(self.disparity_scale, []), collections = self.model_collection)
 
                 # Network outputs.
-                tf.summary.image('disparity_top_est_' + str(i), self.disparity_top_est[i], max_outputs=4, collections = self.model_collection)
-                tf.summary.image('disparity_bottom_est_' + str(i), self.disparity_bottom_est[i], max_outputs=4, collections = self.model_collection)
-                tf.summary.image('depth_top_est_' + str(i), self.normalize_depth(self.depth_top_est[i]), max_outputs=4, collections = self.model_collection)
-                tf.summary.image('depth_bottom_est_' + str(i), self.normalize_depth(self.depth_bottom_est[i]), max_outputs = 4, collections = self.model_collection)
-
-                # Image reconstruction summaries.
-                tf.summary.image('top_est_' + str(i), self.top_est[i], max_outputs = 4, collections = self.model_collection)
-                tf.summary.image('bottom_est_' + str(i), self.bottom_est[i], max_outputs = 4, collections = self.model_collection)
-                tf.summary.image('ssim_top_'  + str(i), self.ssim_top[i],  max_outputs = 4, collections = self.model_collection)
-                tf.summary.image('ssim_bottom_' + str(i), self.ssim_bottom[i], max_outputs = 4, collections = self.model_collection)
-                tf.summary.image('l1_top_'  + str(i), self.l1_top[i],  max_outputs = 4, collections = self.model_collection)
-                tf.summary.image('l1_bottom_' + str(i), self.l1_bottom[i], max_outputs = 4, collections = self.model_collection)
-                tf.summary.image('top_' + str(i),  self.top_pyramid[i],   max_outputs = 4, collections = self.model_collection)
-                tf.summary.image('bottom_' + str(i), self.bottom_pyramid[i],  max_outputs = 4, collections = self.model_collection)
\ No newline at end of file
+                tf.summary.image('disparity_top_est_' + str(i), self.disparity_top_est[i][:max_outputs], max_outputs=max_outputs, collections = self.model_collection)
+                tf.summary.image('disparity_bottom_est_' + str(i), self.disparity_bottom_est[i][:max_outputs], max_outputs=max_outputs, collections = self.model_collection)
+                tf.summary.image('depth_top_est_' + str(i), self.normalize_depth(self.depth_top_est[i][:max_outputs]), max_outputs=max_outputs, collections = self.model_collection)
+                tf.summary.image('depth_bottom_est_' + str(i), self.normalize_depth(self.depth_bottom_est[i][:max_outputs]), max_outputs = max_outputs, collections = self.model_collection)
+
+                # Image reconstruction summaries, sampled losses only warp the summarised images when summaries are run.
+                if self.params.loss_sampling:
+                    top_est = self.generate_image_top(self.bottom_pyramid[i][:max_outputs], self.disparity_top_est[i][:max_outputs])
+                    bottom_est = self.generate_image_bottom(self.top_pyramid[i][:max_outputs], self.disparity_bottom_est[i][:max_outputs])
+                else:
+                    top_est = self.top_est[i][:max_outputs]
+                    bottom_est = self.bottom_est[i][:max_outputs]
+                    tf.summary.image('ssim_top_'  + str(i), self.ssim_top[i][:max_outputs],  max_outputs = max_outputs, collections = self.model_collection)
+                    tf.summary.image('ssim_bottom_' + str(i), self.ssim_bottom[i][:max_outputs], max_outputs = max_outputs, collections = self.model_collection)
+                    tf.summary.image('l1_top_'  + str(i), self.l1_top[i][:max_outputs],  max_outputs = max_outputs, collections = self.model_collection)
+                    tf.summary.image('l1_bottom_' + str(i), self.l1_bottom[i][:max_outputs], max_outputs = max_outputs, collections = self.model_collection)
+                tf.summary.image('top_est_' + str(i), top_est, max_outputs = max_outputs, collections = self.model_collection)
+                tf.summary.image('bottom_est_' + str(i), bottom_est, max_outputs = max_outputs, collections = self.model_collection)
+                tf.summary.image('top_' + str(i),  self.top_pyramid[i][:max_outputs],   max_outputs = max_outputs, collections = self.model_collection)
+                tf.summary.image('bottom_' + str(i), self.bottom_pyramid[i][:max_outputs],  max_outputs = max_outputs, collections = self.model_collection)
\ No newline at end of file
@@ -0,0 +1,273 @@
+"""Structured channel pruning of a trained monodepth model.
+
+Ranks the channels of the ResNet-50 bottlenecks and of the decoder layers, removes the least
+important ones until the model fits a FLOP budget and writes a thinner checkpoint together with
+the channel config that MonodepthModel builds it from.
+"""
+
+from __future__ import division
+
+import argparse
+import json
+import os
+import numpy as np
+import tensorflow as tf
+
+from collections import OrderedDict
+
+from monodepth_utils import benchmark_params, count_flops, load_images, time_run
+from monodepth_model import *
+
+def prunable_layers(layer_names):
+    """Maps each prunable layer to the layers consuming its channels.
+
+    The consumed channels always come first in the input of the consumers, the decoder
+    concatenates the upsampled features before the skips.
+    """
+    consumers = OrderedDict()
+    for name in layer_names:
+        if name.endswith('/conv1') or name.endswith('/conv2'):
+            consumers[name] = [name[:-1] + str(int(name[-1]) + 1)]
+        elif name.startswith('decoder/upconv'):
+            consumers[name] = ['decoder/iconv' + name[-1]]
+        elif name.startswith('decoder/iconv'):
+            index = int(name[-1])
+            consumers[name] = [consumer for consumer in ['decoder/upconv' + str(index - 1), 'decoder/disparity' + str(index)]
+                               if consumer in layer_names]
+    return consumers
+
+def channel_axes(name, use_deconv):
+    # Transposed convolution kernels are stored as [height, width, out, in].
+    if use_deconv and name.startswith('decoder/upconv'):
+        return 2, 3
+    return 3, 2
+
+def build_network(params):
+    """Builds a test model on a placeholder and returns it with the placeholder."""
+    top = tf.placeholder(tf.float32, [params.batch_size, params.height, params.width, 3])
+    model = MonodepthModel(params, 'test', top, None)
+    return model, top
+
+def layer_shapes(model, params):
+    """Kernel size, input and output channels and output pixels per image of every named layer."""
+    shapes = OrderedDict()
+    for name, variables in model.layer_variables.items():
+        weights_shape = variables[0].get_shape().as_list()
+        out_axis, in_axis = channel_axes(name, params.use_deconv)
+        pixels = sum(np.prod(output.get_shape().as_list()[1:3]) for output in model.layer_outputs[name])
+        shapes[name] = {
+            'kernel': weights_shape[0] * weights_shape[1],
+            'in': weights_shape[in_axis],
+            'out': weights_shape[out_axis],
+            'pixels': int(pixels)
+        }
+    return shapes
+
+def network_flops(shapes, consumers, widths):
+    """Multiply-add FLOPs per image of the named layers for the given widths of the prunable layers."""
+    removed_inputs = dict((name, 0) for name in shapes)
+    for name, layer_consumers in consumers.items():
+        for consumer in layer_consumers:
+            removed_inputs[consumer] += shapes[name]['out'] - widths[name]
+
+    flops = 0
+    for name, shape in shapes.items():
+        num_out = widths.get(name, shape['out'])
+        num_in = shape['in'] - removed_inputs[name]
+        flops += 2 * shape['kernel'] * num_in * num_out * shape['pixels']
+    return flops
+
+def weight_norm_scores(session, model, consumers, params):
+    """L1 norm of the kernel of every output channel."""
+    scores = {}
+    for name in consumers:
+        weights = session.run(model.layer_variables[name][0])
+        out_axis, _ = channel_axes(name, params.use_deconv)
+        axes = tuple(axis for axis in range(4) if axis != out_axis)
+        scores[name] = np.abs(weights).sum(axis = axes)
+    return scores
+
+def calibration_scores(session, model, top, consumers, images, batch_size):
+    """Mean absolute activation of every output channel over the calibration images."""
+    outputs = [model.layer_outputs[name] for name in consumers]
+    activations = [tf.add_n([tf.reduce_mean(tf.abs(output), [0, 1, 2]) for output in layer_outputs]) for layer_outputs in outputs]
+
+    totals = [0.0] * len(activations)
+    num_batches = 0
+    for i in range(0, len(images) - batch_size + 1, batch_size):
+        values = session.run(activations, {top: images[i:i + batch_size]})
+        totals = [total + value for total, value in zip(totals, values)]
+        num_batches += 1
+    return dict((name, total / max(num_batches, 1)) for name, total in zip(consumers, totals))
+
+def select_channels(scores, shapes, consumers, flop_budget, min_channel_fraction):
+    """Greedily removes the globally least important channels until the FLOPs fit the budget.
+
+    Scores are normalised by their mean per layer so that layers of different scales compete fairly.
+    Returns the sorted indices of the kept channels of every prunable layer.
+    """
+    widths = dict((name, shapes[name]['out']) for name in consumers)
+    min_widths = dict((name, max(1, int(np.ceil(min_channel_fraction * shapes[name]['out'])))) for name in consumers)
+    target_flops = flop_budget * network_flops(shapes, consumers, widths)
+
+    candidates = []
+    for name in consumers:
+        normalised = scores[name] / max(np.mean(scores[name]), 1e-12)
+        candidates.extend((score, name, channel) for channel, score in enumerate(normalised))
+    candidates.sort()
+
+    removed = dict((name, set()) for name in consumers)
+    for score, name, channel in candidates:
+        if network_flops(shapes, consumers, widths) <= target_flops:
+            break
+        if widths[name] <= min_widths[name]:
+            continue
+        widths[name] -= 1
+        removed[name].add(channel)
+
+    return OrderedDict((name, [channel for channel in range(shapes[name]['out']) if channel not in removed[name]]) for name in consumers)
+
+def is_optimizer_variable(name):
+    return 'Adam' in name or name.endswith('beta1_power') or name.endswith('beta2_power')
+
+def prune_checkpoint(checkpoint_path, output_path, model, consumers, kept_channels, params):
+    """Writes the checkpoint of the thinner model, optimizer slots are dropped."""
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    values = OrderedDict((name, reader.get_tensor(name)) for name in sorted(reader.get_variable_to_shape_map())
+                         if not is_optimizer_variable(name))
+
+    for name, channels in kept_channels.items():
+        out_axis, _ = channel_axes(name, params.use_deconv)
+        weights, biases = [variable.op.name for variable in model.layer_variables[name]]
+        values[weights] = np.take(values[weights], channels, axis = out_axis)
+        values[biases] = np.take(values[biases], channels, axis = 0)
+
+        # The channels of the producer come first in the input of its consumers, the rest of the input is kept.
+        num_out = model.layer_variables[name][0].get_shape().as_list()[out_axis]
+        for consumer in consumers[name]:
+            _, in_axis = channel_axes(consumer, params.use_deconv)
+            consumer_weights = model.layer_variables[consumer][0].op.name
+            num_in = values[consumer_weights].shape[in_axis]
+            input_channels = list(channels) + list(range(num_out, num_in))
+            values[consumer_weights] = np.take(values[consumer_weights], input_channels, axis = in_axis)
+
+    with tf.Graph().as_default():
+        variables = dict((name, tf.Variable(value, name = name)) for name, value in values.items())
+        session = tf.Session()
+        session.run(tf.global_variables_initializer())
+        tf.train.Saver(variables).save(session, output_path)
+        session.close()
+
+def restore_test_model(params, checkpoint_path):
+    graph = tf.Graph()
+    with graph.as_default():
+        model, top = build_network(params)
+        session = tf.Session()
+        session.run(tf.global_variables_initializer())
+        if checkpoint_path != '':
+            tf.train.Saver().restore(session, checkpoint_path)
+    return graph, model, top, session
+
+def predict_depths(session, depth, top, images, batch_size):
+    return np.concatenate([session.run(depth, {top: images[i:i + batch_size]})
+                           for i in range(0, len(images) - batch_size + 1, batch_size)], 0)
+
+def compare_models(params, checkpoint_path, pruned_params, pruned_checkpoint_path, num_iterations, images = None):
+    """FLOPs, latency and depth agreement of the full and the pruned model."""
+    results = {}
+    depths = {}
+    for key, model_params, model_checkpoint in [('original', params, checkpoint_path), ('pruned', pruned_params, pruned_checkpoint_path)]:
+        graph, model, top, session = restore_test_model(model_params, model_checkpoint)
+        with graph.as_default():
+            depth = model.depth_top_est[0]
+            inputs = np.random.rand(*top.get_shape().as_list())
+            results[key] = {
+                'flops': count_flops(graph),
+                'parameters': int(sum(np.prod(variable.get_shape().as_list()) for variable in tf.trainable_variables())),
+                'latency': time_run(session, depth, num_iterations, {top: inputs})
+            }
+            if images is not None:
+                depths[key] = predict_depths(session, depth, top, images, params.batch_size)
+        session.close()
+
+    results['speedup'] = results['original']['latency'] / results['pruned']['latency']
+    results['flop_ratio'] = results['pruned']['flops'] / results['original']['flops']
+    if images is not None:
+        # The full model is the reference, the thresholded accuracy uses the usual 1.25 ratio.
+        ratio = np.maximum(depths['pruned'] / depths['original'], depths['original'] / depths['pruned'])
+        results['abs_rel'] = float(np.mean(np.abs(depths['pruned'] - depths['original']) / depths['original']))
+        results['a1'] = float(np.mean(ratio < 1.25))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Monodepth structured channel pruning.')
+    parser.add_argument('--checkpoint_path',         type=str,   help='checkpoint of the full model', required=True)
+    parser.add_argument('--output_directory',        type=str,   help='directory of the pruned checkpoint, channel config and report', required=True)
+    parser.add_argument('--pruned_checkpoint_path',  type=str,   help='if set, only compares this pruned (e.g. fine-tuned) checkpoint with the full model', default='')
+    parser.add_argument('--channel_config',          type=str,   help='channel config of --pruned_checkpoint_path', default='')
+    parser.add_argument('--flop_budget',             type=float, help='fraction of the FLOPs of the named layers to keep', default=0.5)
+    parser.add_argument('--ranking',                 type=str,   help='channel ranking, weight_norm or calibration', default='weight_norm', choices=['weight_norm', 'calibration'])
+    parser.add_argument('--min_channel_fraction',    type=float, help='minimum fraction of the channels kept in every layer', default=0.25)
+    parser.add_argument('--data_path',               type=str,   help='path to the data of the calibration and comparison images', default='')
+    parser.add_argument('--filenames_file',          type=str,   help='filenames of the calibration and comparison images', default='')
+    parser.add_argument('--num_images',              type=int,   help='number of calibration and comparison images', default=32)
+    parser.add_argument('--encoder',                 type=str,   help='type of encoder, resnet50, vgg or mobile', default='resnet50')
+    parser.add_argument('--projection',              type=str,   help='projection mode - cubic or equirectangular', default='cubic')
+    parser.add_argument('--use_deconv',                          help='if set, the model uses transposed convolutions', action='store_true')
+    parser.add_argument('--input_height',            type=int,   help='input height', default=256)
+    parser.add_argument('--input_width',             type=int,   help='input width', default=512)
+    parser.add_argument('--batch_size',              type=int,   help='batch size of the calibration and timing runs', default=1)
+    parser.add_argument('--num_iterations',          type=int,   help='number of timed iterations', default=20)
+    args = parser.parse_args()
+
+    params = benchmark_params(height=args.input_height, width=args.input_width, batch_size=args.batch_size,
+                              encoder=args.encoder, projection=args.projection, use_deconv=args.use_deconv)
+
+    images = None
+    if args.filenames_file != '':
+        images = load_images(args.data_path, args.filenames_file, args.input_height, args.input_width, args.num_images)
+
+    if not os.path.isdir(args.output_directory):
+        os.makedirs(args.output_directory)
+
+    if args.pruned_checkpoint_path != '':
+        pruned_checkpoint_path = args.pruned_checkpoint_path
+        channel_config_path = args.channel_config
+    else:
+        graph, model, top, session = restore_test_model(params, args.checkpoint_path)
+        with graph.as_default():
+            shapes = layer_shapes(model, params)
+            consumers = prunable_layers(list(shapes.keys()))
+            if args.ranking == 'calibration':
+                if images is None:
+                    raise ValueError('calibration ranking needs --filenames_file')
+                scores = calibration_scores(session, model, top, consumers, images, args.batch_size)
+            else:
+                scores = weight_norm_scores(session, model, consumers, params)
+        session.close()
+
+        kept_channels = select_channels(scores, shapes, consumers, args.flop_budget, args.min_channel_fraction)
+        widths = OrderedDict((name, len(channels)) for name, channels in kept_channels.items())
+
+        channel_config_path = os.path.join(args.output_directory, 'channel_config.json')
+        with open(channel_config_path, 'w') as f:
+            json.dump(widths, f, indent = 2)
+
+        pruned_checkpoint_path = os.path.join(args.output_directory, 'model-pruned')
+        prune_checkpoint(args.checkpoint_path, pruned_checkpoint_path, model, consumers, kept_channels, params)
+        print('Pruned checkpoint written to {} with channel config {}'.format(pruned_checkpoint_path, channel_config_path))
+
+    pruned_params = params._replace(channel_config=channel_config_path)
+    results = compare_models(params, args.checkpoint_path, pruned_params, pruned_checkpoint_path, args.num_iterations, images)
+    with open(os.path.join(args.output_directory, 'prune_report.json'), 'w') as f:
+        json.dump(results, f, indent = 2, sort_keys = True)
+
+    print("{:>10} {:>14} {:>10} {:>15}".format('', 'parameters (M)', 'GFLOPs', 'latency (ms)'))
+    for key in ['original', 'pruned']:
+        print("{:>10} {:>14.2f} {:>10.2f} {:>15.3f}".format(key, results[key]['parameters'] / 1e6, results[key]['flops'] / 1e9, 1e3 * results[key]['latency']))
+    print("Speedup {:.2f}x, FLOP ratio {:.3f}".format(results['speedup'], results['flop_ratio']))
+    if 'abs_rel' in results:
+        print("Depth agreement with the full model: abs_rel {:.4f}, a1 {:.4f}".format(results['abs_rel'], results['a1']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Post-training int8 quantisation of the monodepth conv stack for CPU inference.
+
+The encoder and decoder are converted to a TFLite model with int8 weights and activations,
+calibrated on the faces (or panoramas) of a sample of training images. The projections and the
+disparity to depth conversions stay in float and run in TensorFlow around the converted stack.
+"""
+
+from __future__ import division
+
+import argparse
+import json
+import os
+import threading
+import numpy as np
+import tensorflow as tf
+
+from monodepth_utils import benchmark_params, load_images, time_run
+from monodepth_model import *
+
+def conv_stack_shape(params):
+    # Cubic models run the conv stack on faces covering a quarter of the panorama width.
+    if params.projection == 'equirectangular':
+        return [params.height, params.width]
+    face_size = params.width // 4
+    return [face_size, face_size]
+
+def calibration_inputs(params, images):
+    """Conv stack inputs of the calibration panoramas, one image per entry."""
+    if params.projection == 'equirectangular':
+        return [image for image in images]
+
+    size = conv_stack_shape(params)
+    with tf.Graph().as_default():
+        top = tf.placeholder(tf.float32, [1, params.height, params.width, 3])
+        faces = [tf.reshape(project_face(top, face, size), [1] + size + [3]) for face in face_map]
+        session = tf.Session()
+        inputs = []
+        for image in images:
+            inputs.extend(face[0] for face in session.run(faces, {top: image[None]}))
+        session.close()
+    return inputs
+
+def convert_conv_stack(params, checkpoint_path, inputs):
+    """Converts the conv stack of a checkpoint to an int8 TFLite model.
+
+    Ops without int8 kernels fall back to float inside the TFLite model.
+    """
+    shape = conv_stack_shape(params)
+    stack_params = params._replace(projection='equirectangular', height=shape[0], width=shape[1], batch_size=1, polar_face_scale=1)
+    with tf.Graph().as_default():
+        top = tf.placeholder(tf.float32, [1] + shape + [3])
+        model = MonodepthModel(stack_params, 'test', top, None)
+
+        # Only the conv stack is restored, the scaling variables of the projections stay in float.
+        session = tf.Session()
+        session.run(tf.global_variables_initializer())
+        stack_variables = [variable for variable in tf.global_variables() if '/scaling/' not in variable.op.name]
+        tf.train.Saver(stack_variables).restore(session, checkpoint_path)
+
+        # The equirectangular stack model calls the network once.
+        converter = tf.lite.TFLiteConverter.from_session(session, [top], model.network_outputs[0])
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([input[None].astype(np.float32)] for input in inputs)
+        tflite_model = converter.convert()
+        session.close()
+    return tflite_model
+
+def tflite_conv_stack(model_path, num_threads = None):
+    """Returns a conv stack for MonodepthModel running the TFLite model on CPU.
+
+    Each image of the batch is run separately, one interpreter is kept per input size so that
+    reduced resolution polar faces do not reallocate the tensors on every call.
+    """
+    interpreters = {}
+    lock = threading.Lock()
+
+    def interpreter_for(shape):
+        if shape not in interpreters:
+            interpreter = tf.lite.Interpreter(model_path = model_path)
+            input_index = interpreter.get_input_details()[0]['index']
+            if list(interpreter.get_input_details()[0]['shape'][1:3]) != list(shape):
+                interpreter.resize_tensor_input(input_index, [1] + list(shape) + [3])
+            interpreter.allocate_tensors()
+            if num_threads is not None and hasattr(interpreter, 'set_num_threads'):
+                interpreter.set_num_threads(num_threads)
+            # The network returns the disparities from the finest scale to the coarsest one.
+            outputs = sorted(interpreter.get_output_details(), key = lambda details: -details['shape'][1])
+            interpreters[shape] = (interpreter, input_index, outputs)
+        return interpreters[shape]
+
+    def run(images):
+        # The interpreters are not thread-safe and the faces can be run concurrently.
+        with lock:
+            interpreter, input_index, outputs = interpreter_for(images.shape[1:3])
+            results = [[] for _ in outputs]
+            for image in images:
+                interpreter.set_tensor(input_index, image[None].astype(np.float32))
+                interpreter.invoke()
+                for result, details in zip(results, outputs):
+                    result.append(interpreter.get_tensor(details['index'])[0])
+        return [np.stack(result, 0).astype(np.float32) for result in results]
+
+    def conv_stack(input):
+        shape = tuple(input.get_shape().as_list()[1:3])
+        _, _, outputs = interpreter_for(shape)
+        disparities = tf.py_func(run, [input], [tf.float32] * len(outputs), stateful = False)
+        for disparity, details in zip(disparities, outputs):
+            disparity.set_shape([None] + list(details['shape'][1:]))
+        return disparities
+
+    return conv_stack
+
+def compare_models(params, checkpoint_path, model_path, images, num_iterations):
+    """Latency and depth agreement of the float model and the int8 conv stack on the same images."""
+    config = tf.ConfigProto(device_count = {'GPU': 0})
+    results = {}
+    depths = {}
+    for key, conv_stack in [('float', None), ('int8', tflite_conv_stack(model_path))]:
+        with tf.Graph().as_default():
+            top = tf.placeholder(tf.float32, [params.batch_size, params.height, params.width, 3])
+            model = MonodepthModel(params, 'test', top, None, conv_stack = conv_stack)
+            depth = model.depth_top_est[0]
+
+            session = tf.Session(config = config)
+            session.run(tf.global_variables_initializer())
+            tf.train.Saver().restore(session, checkpoint_path)
+
+            results[key] = {'latency': time_run(session, depth, num_iterations, {top: images[:params.batch_size]})}
+            depths[key] = np.concatenate([session.run(depth, {top: images[i:i + params.batch_size]})
+                                          for i in range(0, len(images) - params.batch_size + 1, params.batch_size)], 0)
+            session.close()
+
+    # The float model is the reference, the thresholded accuracy uses the usual 1.25 ratio.
+    ratio = np.maximum(depths['int8'] / depths['float'], depths['float'] / depths['int8'])
+    results['speedup'] = results['float']['latency'] / results['int8']['latency']
+    results['abs_rel'] = float(np.mean(np.abs(depths['int8'] - depths['float']) / depths['float']))
+    results['rmse_log'] = float(np.sqrt(np.mean((np.log(depths['int8']) - np.log(depths['float'])) ** 2)))
+    results['a1'] = float(np.mean(ratio < 1.25))
+    results['model_size'] = os.path.getsize(model_path)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Monodepth int8 post-training quantisation.')
+    parser.add_argument('--checkpoint_path',  type=str, help='checkpoint of the float model', required=True)
+    parser.add_argument('--output_path',      type=str, help='path of the int8 TFLite conv stack', required=True)
+    parser.add_argument('--data_path',        type=str, help='path to the data', required=True)
+    parser.add_argument('--filenames_file',   type=str, help='filenames of the calibration panoramas', required=True)
+    parser.add_argument('--test_filenames_file', type=str, help='filenames of the comparison panoramas, defaults to the calibration ones', default='')
+    parser.add_argument('--num_images',       type=int, help='number of calibration and comparison panoramas', default=32)
+    parser.add_argument('--encoder',          type=str, help='type of encoder, resnet50, vgg or mobile', default='resnet50')
+    parser.add_argument('--channel_config',   type=str, help='channel config of a pruned model', default='')
+    parser.add_argument('--projection',       type=str, help='projection mode - cubic or equirectangular', default='cubic')
+    parser.add_argument('--polar_face_scale', type=int, help='downscaling factor of the up and down faces in cubic mode', default=1)
+    parser.add_argument('--output_scale',     type=int, help='scale of the output disparities', default=0)
+    parser.add_argument('--use_deconv',                 help='if set, the model uses transposed convolutions', action='store_true')
+    parser.add_argument('--input_height',     type=int, help='input height', default=256)
+    parser.add_argument('--input_width',      type=int, help='input width', default=512)
+    parser.add_argument('--num_iterations',   type=int, help='number of timed iterations', default=10)
+    parser.add_argument('--compare_only',               help='if set, only compares an existing TFLite model with the float one', action='store_true')
+    args = parser.parse_args()
+
+    params = benchmark_params(height=args.input_height, width=args.input_width, encoder=args.encoder,
+                              channel_config=args.channel_config, projection=args.projection,
+                              polar_face_scale=args.polar_face_scale, output_scale=args.output_scale,
+                              use_deconv=args.use_deconv)
+
+    if not args.compare_only:
+        images = load_images(args.data_path, args.filenames_file, args.input_height, args.input_width, args.num_images)
+        tflite_model = convert_conv_stack(params, args.checkpoint_path, calibration_inputs(params, images))
+        with open(args.output_path, 'wb') as f:
+            f.write(tflite_model)
+        print('Int8 conv stack written to {}'.format(args.output_path))
+
+    test_filenames_file = args.test_filenames_file or args.filenames_file
+    images = load_images(args.data_path, test_filenames_file, args.input_height, args.input_width, args.num_images)
+    results = compare_models(params, args.checkpoint_path, args.output_path, images, args.num_iterations)
+    with open(os.path.splitext(args.output_path)[0] + '_report.json', 'w') as f:
+        json.dump(results, f, indent = 2, sort_keys = True)
+
+    print("{:>8} {:>15}".format('', 'latency (ms)'))
+    for key in ['float', 'int8']:
+        print("{:>8} {:>15.3f}".format(key, 1e3 * results[key]['latency']))
+    print("Speedup {:.2f}x, TFLite model {:.1f} MB".format(results['speedup'], results['model_size'] / 2 ** 20))
+    print("Depth agreement with the float model: abs_rel {:.4f}, rmse_log {:.4f}, a1 {:.4f}".format(results['abs_rel'], results['rmse_log'], results['a1']))
+
+if __name__ == '__main__':
+    main()
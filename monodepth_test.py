@@ -0,0 +1,97 @@
+import numpy as np
+import tensorflow as tf
+
+from average_gradients import average_gradients
+from monodepth_utils import benchmark_params
+from collections import OrderedDict
+from monodepth_model import *
+from multi_tower import InputPrefetcher, build_towers, stage_inputs
+
+def cube_face_size_test():
+    # Scale 4 at the default width gives 32 pixel polar faces, which the decoder cannot concatenate with its skips.
+    try:
+        cube_face_sizes(512, 4)
+    except ValueError as error:
+        print("width 512, polar_face_scale 4: {}".format(error))
+    else:
+        raise AssertionError("32 pixel polar faces were accepted")
+
+    with tf.Graph().as_default():
+        try:
+            MonodepthModel(benchmark_params(polar_face_scale = 4), 'test', tf.placeholder(tf.float32, [1, 256, 512, 3]), None)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("the model was built with 32 pixel polar faces")
+
+    # At width 1024 the polar faces are 64 pixels and the depth is upsampled back to the panorama.
+    assert cube_face_sizes(1024, 4) == [256, 256, 256, 256, 64, 64]
+    with tf.Graph().as_default():
+        params = benchmark_params(height = 512, width = 1024, polar_face_scale = 4)
+        top = tf.placeholder(tf.float32, [1, 512, 1024, 3])
+        model = MonodepthModel(params, 'test', top, None)
+        assert [face.get_shape().as_list() for face in model.top_faces] == [[1, size, size, 3] for size in [256, 256, 256, 256, 64, 64]]
+
+        session = tf.Session()
+        session.run(tf.global_variables_initializer())
+        depth = session.run(model.depth_top_est[0], {top: np.random.rand(1, 512, 1024, 3)})
+        session.close()
+        print("width 1024, polar_face_scale 4: depth {}".format(depth.shape))
+        assert depth.shape == (1, 512, 1024, 1)
+
+def multi_tower_smoke_test(num_towers = 2, num_steps = 4):
+    # Trains towers on virtual CPU devices for a few steps at a tiny resolution, staging the inputs
+    # of the next step in the background like monodepth_main. Each put numbers the batches of the
+    # towers, the marker of tower i at put k is k * num_towers + i.
+    params = benchmark_params(height = 64, width = 128, batch_size = num_towers, projection = 'equirectangular')
+    devices = ['/cpu:%d' % i for i in range(num_towers)]
+    with tf.Graph().as_default(), tf.device('/cpu:0'):
+        num_puts = tf.Variable(0, trainable = False)
+        put_index = num_puts.assign_add(1) - 1
+        input_batches = OrderedDict([('top', tf.random_uniform([num_towers, 64, 128, 3])),
+                                     ('bottom', tf.random_uniform([num_towers, 64, 128, 3])),
+                                     ('marker', put_index * num_towers + tf.range(num_towers))])
+        stage_op, staged_inputs = stage_inputs(input_batches, devices)
+
+        opt_step = tf.train.AdamOptimizer(1e-4)
+        tower_losses, tower_grads = build_towers(params, opt_step, staged_inputs, devices)
+        with tf.name_scope('gradient_aggregation'):
+            grads = average_gradients(tower_grads)
+        train_op = opt_step.apply_gradients(grads)
+        total_loss = tf.reduce_mean(tower_losses)
+        markers = [tower_inputs['marker'][0] for tower_inputs in staged_inputs]
+
+        config = tf.ConfigProto(allow_soft_placement = True)
+        config.device_count['CPU'] = num_towers
+        session = tf.Session(config = config)
+        session.run(tf.global_variables_initializer())
+
+        input_prefetcher = InputPrefetcher(session, [stage_op])
+        input_prefetcher.start()
+        for step in range(num_steps):
+            input_prefetcher.wait()
+            if step + 1 < num_steps:
+                input_prefetcher.start()
+
+            run_metadata = tf.RunMetadata()
+            _, loss, step_markers = session.run([train_op, total_loss, markers], options = tf.RunOptions(trace_level = tf.RunOptions.SOFTWARE_TRACE),
+                                                run_metadata = run_metadata)
+            print("step {}: loss {:.5f}, batches {}".format(step, loss, list(step_markers)))
+            assert np.isfinite(loss), "loss is not finite at step {}".format(step)
+            assert list(step_markers) == [step * num_towers + i for i in range(num_towers)], "batches consumed out of order at step {}".format(step)
+        session.close()
+
+    # The model of tower i is built in the 'model' scope, numbered from the second tower on.
+    tower_devices = [set() for _ in range(num_towers)]
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for i in range(num_towers):
+                if node_stats.node_name.startswith('model/' if i == 0 else 'model_{}/'.format(i)):
+                    tower_devices[i].add(tf.DeviceSpec.from_string(dev_stats.device).device_index)
+    for i, placed in enumerate(tower_devices):
+        print("tower {}: ops placed on CPU {}".format(i, sorted(placed)))
+        assert placed == set([i]), "tower {} ran on CPU {}".format(i, sorted(placed))
+
+if __name__ == "__main__":
+    cube_face_size_test()
+    multi_tower_smoke_test()
@@ -0,0 +1,67 @@
+"""Helpers shared by the benchmark, pruning, quantisation and cost report scripts.
+"""
+
+from __future__ import division
+
+import numpy as np
+import tensorflow as tf
+import time
+
+from monodepth_dataloader import *
+from monodepth_model import *
+
+def benchmark_params(**kwargs):
+    params = dict(
+        height=256,
+        width=512,
+        batch_size=1,
+        num_threads=1,
+        num_epochs=1,
+        projection='cubic',
+        encoder='resnet50',
+        channel_config='',
+        polar_face_scale=1,
+        use_deconv=False,
+        output_scale=0,
+        loss_sampling='',
+        loss_samples=4096,
+        input_pyramid=False,
+        alpha_image_loss=0.75,
+        depth_gradient_loss_weight=1e-3,
+        tb_loss_weight=1e-3,
+        distillation_loss_weight=1e-1,
+        full_summary=False)
+    params.update(kwargs)
+    return monodepth_parameters(**params)
+
+def time_run(session, fetches, num_iterations, feed_dict = None, num_warmup = 2):
+    """Mean wall-clock time in seconds of session.run(fetches)."""
+    for _ in range(num_warmup):
+        session.run(fetches, feed_dict)
+    start_time = time.time()
+    for _ in range(num_iterations):
+        session.run(fetches, feed_dict)
+    return (time.time() - start_time) / num_iterations
+
+def count_flops(graph):
+    """Floating point operations of all ops in the graph with known shapes."""
+    options = tf.profiler.ProfileOptionBuilder.float_operation()
+    options['output'] = 'none'
+    return tf.profiler.profile(graph, options=options).total_float_ops
+
+def load_images(data_path, filenames_file, height, width, num_images):
+    """Reads the first top images of a filenames file."""
+    with tf.Graph().as_default():
+        dataloader = MonodepthDataloader(data_path, filenames_file, benchmark_params(height=height, width=width), 'test')
+        session = tf.Session()
+        coordinator = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess=session, coord=coordinator)
+        images = np.stack([session.run(dataloader.top_image_batch)[0] for _ in range(num_images)], 0)
+        coordinator.request_stop()
+        coordinator.join(threads)
+        session.close()
+    return images
+
+def parse_resolutions(resolutions):
+    # 128x256,256x512 -> [(128, 256), (256, 512)]
+    return [tuple(int(size) for size in resolution.split('x')) for resolution in resolutions.split(',')]
@@ -0,0 +1,84 @@
+"""Input staging and model replicas of multi-tower training.
+"""
+
+import tensorflow as tf
+import threading
+
+from collections import OrderedDict
+from monodepth_model import *
+
+class InputPrefetcher(object):
+    """Runs the staging of the next inputs in a background thread while the training step computes."""
+
+    def __init__(self, session, fetches):
+        self.session = session
+        self.fetches = fetches
+        self.thread = None
+
+    def start(self):
+        self.results = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.results = self.session.run(self.fetches)
+        except Exception as error:
+            self.error = error
+
+    def wait(self):
+        """Waits for the staging to finish and returns the results of the fetches."""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+def stage_inputs(input_batches, devices):
+    """Splits the input batches between the towers and stages the split of every tower on its device.
+
+    Returns the op putting the next inputs in the staging areas and, for every tower, the staged
+    inputs keyed like input_batches. The inputs of the next step are staged in a background run
+    while the current step computes, taking the copy off the critical path.
+    """
+    input_splits = OrderedDict((name, tf.split(batch, len(devices), 0)) for name, batch in input_batches.items())
+
+    stage_ops = []
+    staged_inputs = []
+    for i, device in enumerate(devices):
+        with tf.device(device):
+            splits = [input_splits[name][i] for name in input_splits]
+            input_stage = tf.contrib.staging.StagingArea([split.dtype for split in splits], [split.get_shape() for split in splits])
+            stage_ops.append(input_stage.put(splits))
+            staged_inputs.append(OrderedDict(zip(input_splits.keys(), input_stage.get())))
+    return tf.group(*stage_ops), staged_inputs
+
+def build_towers(params, opt_step, staged_inputs, devices):
+    """Builds one model on the device of every tower and returns the losses and gradients of the towers."""
+
+    tower_grads  = []
+    tower_losses = []
+    reuse_variables = None
+    with tf.variable_scope(tf.get_variable_scope()):
+        for i in range(len(staged_inputs)):
+            with tf.device(devices[i]):
+
+                tower_inputs = staged_inputs[i]
+                top_pyramid, bottom_pyramid = None, None
+                if params.input_pyramid:
+                    top_pyramid = [tower_inputs['top']] + [tower_inputs['top_' + str(scale)] for scale in range(1, 4)]
+                    bottom_pyramid = [tower_inputs['bottom']] + [tower_inputs['bottom_' + str(scale)] for scale in range(1, 4)]
+
+                model = MonodepthModel(params, 'train', tower_inputs['top'], tower_inputs['bottom'], reuse_variables, i,
+                                       tower_inputs.get('teacher_depth'), top_pyramid = top_pyramid, bottom_pyramid = bottom_pyramid)
+
+                loss = model.total_loss
+                tower_losses.append(loss)
+
+                reuse_variables = True
+
+                grads = opt_step.compute_gradients(loss)
+
+                tower_grads.append(grads)
+
+    return tower_losses, tower_grads
@@ -33,6 +33,11 @@ face_map = [
     "down"
 ]
 
+polar_faces = [
+    "up",
+    "down"
+]
+
 def lat_long_grid(shape, epsilon = 1.0e-12):
     return tf.meshgrid(tf.linspace(-np.pi, np.pi, shape[1]),
                        tf.linspace(-np.pi / 2.0 + epsilon, np.pi / 2.0 - epsilon, shape[0]))
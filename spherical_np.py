@@ -0,0 +1,235 @@
+import numpy as np
+
+# NumPy version of spherical.py with the same functions, for projections outside of a graph.
+# Images are [batch, height, width, channels] arrays. The coordinate grids and the sampling
+# maps of the projections only depend on the shapes and are computed once per shape.
+# Everything is float32 like the TF version.
+
+def atan2(x, y, epsilon = 1.0e-12):
+    # Same branches as spherical.atan2, which returns atan(y / x) in the quadrant of (x, y).
+    x = np.where(x == 0.0, x + epsilon, x).astype(np.float32)
+    y = np.where(y == 0.0, y + epsilon, y).astype(np.float32)
+
+    with np.errstate(divide = 'ignore', over = 'ignore'):
+        ratio = np.arctan(y / x)
+    angle = np.where(x > 0.0, ratio, np.zeros_like(x))
+    angle = np.where(np.logical_and(x < 0.0, y >= 0.0), ratio + np.pi, angle)
+    angle = np.where(np.logical_and(x < 0.0, y < 0.0), ratio - np.pi, angle)
+    return angle.astype(np.float32)
+
+face_map = [
+    "front",
+    "back",
+    "left",
+    "right",
+    "up",
+    "down"
+]
+
+polar_faces = [
+    "up",
+    "down"
+]
+
+grid_cache = {}
+
+def memoise(function):
+    # caches the results of functions of shapes, the cached arrays are read only so that
+    # callers cannot modify them in place
+    def cached(*args):
+        key = (function.__name__,) + tuple(tuple(arg) if isinstance(arg, (list, tuple)) else arg for arg in args)
+        if key not in grid_cache:
+            result = function(*args)
+            for array in result if isinstance(result, tuple) else (result,):
+                array.setflags(write = False)
+            grid_cache[key] = result
+        return grid_cache[key]
+    cached.__name__ = function.__name__
+    cached.__doc__ = function.__doc__
+    return cached
+
+def linspace(start, stop, num):
+    return np.linspace(start, stop, num, dtype = np.float32)
+
+@memoise
+def lat_long_grid(shape, epsilon = 1.0e-12):
+    return tuple(np.meshgrid(linspace(-np.pi, np.pi, shape[1]),
+                             linspace(-np.pi / 2.0 + epsilon, np.pi / 2.0 - epsilon, shape[0])))
+
+@memoise
+def uv_grid(shape):
+    return tuple(np.meshgrid(linspace(-0.5, 0.5, shape[1]),
+                             linspace(-0.5, 0.5, shape[0])))
+
+@memoise
+def xyz_grid(shape, face = "front"):
+    a, b = np.meshgrid(linspace(-1.0, 1.0, shape[1]),
+                       linspace(-1.0, 1.0, shape[0]))
+    c = np.ones(shape, np.float32)
+
+    if face == "front":
+        x = a
+        y = -b
+        z = c
+    elif face == "back":
+        x = -a
+        y = -b
+        z = -c
+    elif face == "left":
+        x = -c
+        y = -b
+        z = a
+    elif face == "right":
+        x = c
+        y = -b
+        z = -a
+    elif face == "up":
+        x = a
+        y = c
+        z = b
+    else:
+        x = a
+        y = -c
+        z = -b
+
+    return x, y, z
+
+def xyz_to_lat_long(x, y, z):
+    S = -atan2(x, z)
+    T = atan2(y, np.sqrt(x ** 2.0 + z ** 2.0))
+    return S, T
+
+def lat_long_to_xyz(S, T):
+    x = np.cos(T) * np.sin(S)
+    y = np.sin(T)
+    z = np.cos(T) * np.cos(S)
+    return x, y, z
+
+def backproject_cubic(depth, shape, face):
+    # shape is [batch, height, width, 1] as in spherical.backproject_cubic
+    a, b = np.meshgrid(linspace(-1.0, 1.0, shape[2]),
+                       linspace(-1.0, 1.0, shape[1]))
+    A = depth * a[np.newaxis, :, :, np.newaxis]
+    B = depth * b[np.newaxis, :, :, np.newaxis]
+    C = depth
+
+    if face == "front":
+        x = A
+        z = C
+    elif face == "back":
+        x = -A
+        z = -C
+    elif face == "left":
+        x = -C
+        z = A
+    elif face == "right":
+        x = C
+        z = -A
+    elif face == "up":
+        x = A
+        z = B
+    else:
+        x = A
+        z = -B
+
+    return np.sqrt(x ** 2.0 + z ** 2.0)
+
+def backproject(S, T, depth):
+    x = depth * np.sin(S)
+    y = depth * np.tan(T)
+    z = depth * np.cos(S)
+    return x, y, z
+
+def lat_long_to_cube_uv(S, T):
+    x, y, z = lat_long_to_xyz(S, T)
+
+    argmax = np.argmax(np.abs([x, y, z]), axis = 0)
+    max = np.max(np.abs([x, y, z]), axis = 0)
+
+    front_check = np.logical_and(argmax == 2, z >= 0.0)
+    back_check = np.logical_and(argmax == 2, z < 0.0)
+    left_check = np.logical_and(argmax == 0, x < 0.0)
+    right_check = np.logical_and(argmax == 0, x >= 0.0)
+    up_check = np.logical_and(argmax == 1, y < 0.0)
+    down_check = np.logical_and(argmax == 1, y >= 0.0)
+
+    x = x / max
+    y = y / max
+    z = z / max
+
+    u = np.where(front_check, 0.5 + x / 2.0, np.zeros_like(x))
+    u = np.where(back_check, 1.0 + (0.5 - x / 2.0), u)
+    u = np.where(left_check, 2.0 + (0.5 + z / 2.0), u)
+    u = np.where(right_check, 3.0 + (0.5 - z / 2.0), u)
+    u = np.where(up_check, 4.0 + (0.5 + x / 2.0), u)
+    u = np.where(down_check, 5.0 + (0.5 + x / 2.0), u)
+    u = u / 6.0
+
+    v = np.where(front_check, (1.0 + y) / 2.0, np.zeros_like(y))
+    v = np.where(back_check, (1.0 + y) / 2.0, v)
+    v = np.where(left_check, (1.0 + y) / 2.0, v)
+    v = np.where(right_check, (1.0 + y) / 2.0, v)
+    v = np.where(up_check, (1.0 + z) / 2.0, v)
+    v = np.where(down_check, (1.0 - z) / 2.0, v)
+
+    return u.astype(np.float32), v.astype(np.float32)
+
+def lat_long_to_equirectangular_uv(S, T):
+    u = np.mod(S / (2.0 * np.pi) - 0.25, 1.0)
+    v = np.mod(T / np.pi, 1.0)
+    return u.astype(np.float32), v.astype(np.float32)
+
+def interpolation_map(height, width, x, y):
+    # flat pixel indices and weights of the four neighbours of every sampled point, with the
+    # same clipping as bilinear_sampler.interpolate
+    x = x.ravel() * (width - 1.0)
+    y = y.ravel() * (height - 1.0)
+
+    x0 = np.floor(x).astype(np.int64)
+    y0 = np.floor(y).astype(np.int64)
+    x1 = np.clip(x0 + 1, 0, width - 1)
+    y1 = np.clip(y0 + 1, 0, height - 1)
+    x0 = np.clip(x0, 0, width - 1)
+    y0 = np.clip(y0, 0, height - 1)
+
+    indices = np.stack([y0 * width + x0, y1 * width + x0, y0 * width + x1, y1 * width + x1])
+    weights = np.stack([(x1 - x) * (y1 - y), (x1 - x) * (y - y0), (x - x0) * (y1 - y), (x - x0) * (y - y0)]).astype(np.float32)
+    return indices, weights
+
+def bilinear_sample(input_images, x_t, y_t, indices = None, weights = None):
+    # samples every image of the batch at the normalised coordinates x_t, y_t
+    batch_size, height, width, num_channels = input_images.shape
+    if indices is None:
+        indices, weights = interpolation_map(height, width, x_t, y_t)
+
+    flat_images = input_images.reshape(batch_size, height * width, num_channels).astype(np.float32)
+    output = sum(weights[k][np.newaxis, :, np.newaxis] * flat_images[:, indices[k]] for k in range(4))
+    return output.reshape((batch_size,) + x_t.shape + (num_channels,))
+
+@memoise
+def face_sampling_map(input_shape, face, cubic_shape):
+    x, y, z = xyz_grid(cubic_shape, face)
+    S, T = xyz_to_lat_long(x, y, z)
+    u, v = lat_long_to_equirectangular_uv(S, T)
+    return (u, v) + interpolation_map(input_shape[0], input_shape[1], u, v)
+
+@memoise
+def equirectangular_sampling_map(input_shape, equirectangular_shape):
+    S, T = lat_long_grid(equirectangular_shape)
+    u, v = lat_long_to_cube_uv(S, T)
+    return (u, v) + interpolation_map(input_shape[0], input_shape[1], u, v)
+
+def project_face(input_images, face, cubic_shape):
+    u, v, indices, weights = face_sampling_map(input_images.shape[1:3], face, cubic_shape)
+    return bilinear_sample(input_images, u, v, indices, weights)
+
+def stack_faces(faces):
+    return np.concatenate(faces, 2)
+
+def equirectangular_to_cubic(input_images, cubic_shape):
+    return [project_face(input_images, face, cubic_shape) for face in face_map]
+
+def cubic_to_equirectangular(input_images, equirectangular_shape):
+    stacked_faces = stack_faces(input_images)
+    u, v, indices, weights = equirectangular_sampling_map(stacked_faces.shape[1:3], equirectangular_shape)
+    return bilinear_sample(stacked_faces, u, v, indices, weights)
@@ -1,5 +1,8 @@
+import numpy as np
 import tensorflow as tf
 
+import spherical
+import spherical_np
 from spherical import cubic_to_equirectangular
 from spherical import equirectangular_to_cubic
 from spherical import face_map
@@ -43,6 +46,43 @@ def cubic_to_equirectangular_test():
     with open("equirectangular_test.jpg", "w") as image_file:
         image_file.write(image_data)
 
+def assert_close(name, tf_value, np_value, tolerance = 1e-4):
+    # Points on cube face edges can land on either face, a few of them are allowed to differ.
+    errors = np.abs(np.asarray(tf_value) - np.asarray(np_value))
+    outliers = np.mean(errors > tolerance)
+    print("{:>36}: max difference {:.2e}, {:.3%} above {:.0e}".format(name, errors.max(), outliers, tolerance))
+    assert outliers < 1e-3, name
+
+def numpy_equivalence_test():
+    # Compare the NumPy projections with the TF ones on a random batch.
+    session = tf.Session()
+    images = np.random.uniform(size = [3, 64, 128, 3]).astype(np.float32)
+    faces = [np.random.uniform(size = [3, 32, 32, 3]).astype(np.float32) for _ in face_map]
+    depth = np.random.uniform(1.0, 10.0, size = [3, 32, 32, 1]).astype(np.float32)
+
+    x = np.random.uniform(-1.0, 1.0, size = [64]).astype(np.float32)
+    y = np.random.uniform(-1.0, 1.0, size = [64]).astype(np.float32)
+    x[:4], y[:4] = [0.0, 0.0, 1.0, -1.0], [0.0, 1.0, 0.0, 0.0]
+    assert_close("atan2", session.run(spherical.atan2(x, y)), spherical_np.atan2(x, y))
+
+    S, T = spherical_np.lat_long_grid([64, 128])
+    assert_close("lat_long_grid", session.run(spherical.lat_long_grid([64, 128])), (S, T))
+    assert_close("lat_long_to_cube_uv", session.run(spherical.lat_long_to_cube_uv(S, T)), spherical_np.lat_long_to_cube_uv(S, T))
+    assert_close("lat_long_to_equirectangular_uv", session.run(spherical.lat_long_to_equirectangular_uv(S, T)),
+                 spherical_np.lat_long_to_equirectangular_uv(S, T))
+
+    for face in face_map:
+        assert_close("xyz_grid " + face, session.run(spherical.xyz_grid([32, 32], face)), spherical_np.xyz_grid([32, 32], face))
+        assert_close("backproject_cubic " + face, session.run(spherical.backproject_cubic(depth, tf.shape(depth), face)),
+                     spherical_np.backproject_cubic(depth, depth.shape, face))
+
+    cubic_images = session.run(spherical.equirectangular_to_cubic(tf.constant(images), [32, 32]))
+    for face, tf_face, np_face in zip(face_map, cubic_images, spherical_np.equirectangular_to_cubic(images, [32, 32])):
+        assert_close("equirectangular_to_cubic " + face, tf_face, np_face, 1e-3)
+    assert_close("cubic_to_equirectangular", session.run(spherical.cubic_to_equirectangular([tf.constant(face) for face in faces], [64, 128])),
+                 spherical_np.cubic_to_equirectangular(faces, [64, 128]), 1e-3)
+
 if __name__ == "__main__":
     equirectangular_to_cubic_test()
-    cubic_to_equirectangular_test()
\ No newline at end of file
+    cubic_to_equirectangular_test()
+    numpy_equivalence_test()
\ No newline at end of file
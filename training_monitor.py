@@ -0,0 +1,232 @@
+"""Step-time instrumentation for the training loop.
+"""
+
+from __future__ import division
+
+import collections
+import csv
+import json
+import re
+import signal
+import time
+
+import tensorflow as tf
+
+from tensorflow.python.client import timeline
+
+def is_device_stats(dev_stats):
+    # GPU traces also report every op per stream, skip those to avoid counting ops twice.
+    return 'stream' not in dev_stats.device and 'memcpy' not in dev_stats.device
+
+def op_time_fraction(run_metadata, prefixes):
+    """Fraction of the traced op time spent in ops whose names start with one of the prefixes."""
+    total_micros = 0
+    matched_micros = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        if not is_device_stats(dev_stats):
+            continue
+        for node_stats in dev_stats.node_stats:
+            total_micros += node_stats.all_end_rel_micros
+            if node_stats.node_name.startswith(prefixes):
+                matched_micros += node_stats.all_end_rel_micros
+    if total_micros == 0:
+        return 0.0
+    return matched_micros / total_micros
+
+def peak_memory_bytes(run_metadata):
+    """Peak memory in use by the allocators during a traced step."""
+    peak_bytes = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peak_bytes = max(peak_bytes, memory.allocator_bytes_in_use, memory.peak_bytes)
+    return peak_bytes
+
+class StepMonitor(object):
+    """Records per-step timings, queue levels and throughput of the training loop.
+
+    Each step is appended to `step_stats.jsonl` and `step_stats.csv` in the log directory and
+    the averages over the last `summary_interval` steps are written as TensorBoard scalars.
+
+    The time of the training run is split between forward/backward compute, the averaging of
+    the tower gradients and the optimizer update using the fractions measured on the last traced
+    step, tracing every `trace_interval` steps.
+    """
+
+    timing_names = ['input_wait', 'compute', 'gradient_aggregation', 'optimizer_update', 'summary', 'checkpoint']
+    traced_prefixes = collections.OrderedDict([('gradient_aggregation', ('gradient_aggregation/',)), ('optimizer_update', ('Adam',))])
+
+    def __init__(self, log_directory, batch_size, summary_writer, queue_names, summary_interval = 100, trace_interval = 1000):
+        self.batch_size = batch_size
+        self.summary_writer = summary_writer
+        self.queue_names = list(queue_names)
+        self.summary_interval = summary_interval
+        self.trace_interval = trace_interval
+        self.traced_fractions = dict((name, 0.0) for name in self.traced_prefixes)
+
+        self.step_times = collections.deque(maxlen = summary_interval)
+        self.window = collections.deque(maxlen = summary_interval)
+
+        self.fields = ['step', 'time'] + self.timing_names + ['step_time', 'examples_per_sec', 'average_examples_per_sec'] + \
+                      ['queue_' + name for name in self.queue_names]
+        self.jsonl_file = open(log_directory + '/step_stats.jsonl', 'a')
+        self.csv_file = open(log_directory + '/step_stats.csv', 'a')
+        self.csv_writer = csv.DictWriter(self.csv_file, self.fields)
+        if self.csv_file.tell() == 0:
+            self.csv_writer.writeheader()
+
+    def trace_options(self, step):
+        """Returns RunOptions and RunMetadata for steps that are traced, None otherwise."""
+        if self.trace_interval <= 0 or step % self.trace_interval != 0:
+            return None, None
+        return tf.RunOptions(trace_level = tf.RunOptions.SOFTWARE_TRACE), tf.RunMetadata()
+
+    def update_trace(self, run_metadata):
+        if run_metadata is not None:
+            for name, prefixes in self.traced_prefixes.items():
+                self.traced_fractions[name] = op_time_fraction(run_metadata, prefixes)
+
+    def average_examples_per_sec(self):
+        return self.batch_size * len(self.step_times) / max(sum(self.step_times), 1e-12)
+
+    def record(self, step, timings, queue_levels):
+        """Logs the timings in seconds and the queue sizes of one training step."""
+        timings = dict((name, timings.get(name, 0.0)) for name in self.timing_names)
+
+        # The training run covers forward/backward compute, gradient aggregation and the optimizer update.
+        train_time = timings['compute']
+        for name in self.traced_prefixes:
+            timings[name] = self.traced_fractions[name] * train_time
+        timings['compute'] = train_time - sum(timings[name] for name in self.traced_prefixes)
+
+        step_time = sum(timings.values())
+        self.step_times.append(step_time)
+
+        row = dict(timings)
+        row['step'] = int(step)
+        row['time'] = time.time()
+        row['step_time'] = step_time
+        row['examples_per_sec'] = self.batch_size / max(step_time, 1e-12)
+        row['average_examples_per_sec'] = self.average_examples_per_sec()
+        for name, level in zip(self.queue_names, queue_levels):
+            row['queue_' + name] = int(level)
+
+        self.jsonl_file.write(json.dumps(row) + '\n')
+        self.csv_writer.writerow(row)
+        self.window.append(row)
+
+        if step and step % self.summary_interval == 0:
+            self.write_summary(step)
+
+    def write_summary(self, step):
+        values = []
+        for field in self.fields[2:]:
+            mean = sum(row[field] for row in self.window) / len(self.window)
+            values.append(tf.Summary.Value(tag = 'step_stats/' + field, simple_value = mean))
+        self.summary_writer.add_summary(tf.Summary(value = values), global_step = step)
+        self.jsonl_file.flush()
+        self.csv_file.flush()
+
+    def close(self):
+        self.jsonl_file.close()
+        self.csv_file.close()
+
+model_scopes = ['encoder', 'decoder', 'skips', 'scaling', 'depths', 'disparities', 'images', 'top-bottom', 'smoothness', 'losses',
+                'gradient_aggregation', 'Adam']
+sampler_scopes = ['bilinear_sampler', 'transform', 'interpolate', 'repeat']
+
+def strip_scope_index(scope):
+    # Scopes entered several times are uniquified as 'encoder_1', 'bilinear_sampler_2', ...
+    return re.sub(r'_\d+$', '', scope)
+
+def op_scope(node_name):
+    """Maps an op name to the model scope it belongs to, e.g. 'backward/images/interpolate'."""
+    scopes = [strip_scope_index(scope) for scope in node_name.split('/')[:-1]]
+    prefix = 'backward/' if scopes and scopes[0] == 'gradients' else ''
+    scope = next((scope for scope in scopes if scope in model_scopes), 'other')
+    samplers = [scope for scope in scopes if scope in sampler_scopes]
+    if samplers:
+        scope += '/' + samplers[-1]
+    return prefix + scope
+
+def op_output_bytes(node_stats):
+    return sum(output.tensor_description.allocation_description.allocated_bytes for output in node_stats.output)
+
+def summarize_step_stats(run_metadata):
+    """Aggregates op time and output memory of a traced step per model scope."""
+    summary = collections.defaultdict(lambda: {'ops': 0, 'time_micros': 0, 'output_bytes': 0})
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        if not is_device_stats(dev_stats):
+            continue
+        for node_stats in dev_stats.node_stats:
+            scope_summary = summary[op_scope(node_stats.node_name)]
+            scope_summary['ops'] += 1
+            scope_summary['time_micros'] += node_stats.all_end_rel_micros
+            scope_summary['output_bytes'] += op_output_bytes(node_stats)
+    return dict(summary)
+
+def format_scope_summary(summary):
+    total_micros = max(sum(scope_summary['time_micros'] for scope_summary in summary.values()), 1)
+    lines = ['{:<40} {:>8} {:>12} {:>8} {:>12}'.format('scope', 'ops', 'time (ms)', 'time %', 'output (MB)')]
+    for scope, scope_summary in sorted(summary.items(), key = lambda item: -item[1]['time_micros']):
+        lines.append('{:<40} {:>8} {:>12.3f} {:>8.2f} {:>12.3f}'.format(
+            scope, scope_summary['ops'], scope_summary['time_micros'] / 1e3,
+            100.0 * scope_summary['time_micros'] / total_micros, scope_summary['output_bytes'] / 2 ** 20))
+    return '\n'.join(lines)
+
+class StepProfiler(object):
+    """Captures full traces of selected training steps.
+
+    Steps in the range `START:END` (END excluded) are traced, as well as the `signal_steps` steps
+    following the reception of SIGUSR1. For every traced step a Chrome trace `timeline_<step>.json`
+    and a per-scope time and memory summary, as JSON in `profile_<step>.json` and as a table in
+    `profile_<step>.txt`, are written to the log directory.
+    Other steps run without any RunOptions.
+    """
+
+    def __init__(self, log_directory, profile_steps = '', signal_steps = 10):
+        self.log_directory = log_directory
+        self.signal_steps = signal_steps
+        self.signal_received = False
+        self.signal_end_step = -1
+        self.profiled_step = None
+
+        if profile_steps:
+            start_step, end_step = profile_steps.split(':')
+            self.start_step, self.end_step = int(start_step), int(end_step)
+        else:
+            self.start_step, self.end_step = 0, 0
+
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.handle_signal)
+
+    def handle_signal(self, signum, frame):
+        self.signal_received = True
+
+    def trace_options(self, step):
+        """Returns RunOptions and RunMetadata for steps that are profiled, None otherwise."""
+        if self.signal_received:
+            self.signal_received = False
+            self.signal_end_step = step + self.signal_steps
+            print("Profiling steps {} to {}".format(step, self.signal_end_step - 1))
+
+        if not (self.start_step <= step < self.end_step or step < self.signal_end_step):
+            self.profiled_step = None
+            return None, None
+
+        self.profiled_step = step
+        return tf.RunOptions(trace_level = tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+    def record(self, step, run_metadata):
+        if self.profiled_step != step or run_metadata is None:
+            return
+
+        trace = timeline.Timeline(run_metadata.step_stats)
+        with open(self.log_directory + '/timeline_{}.json'.format(step), 'w') as trace_file:
+            trace_file.write(trace.generate_chrome_trace_format(show_memory = True))
+
+        summary = summarize_step_stats(run_metadata)
+        with open(self.log_directory + '/profile_{}.json'.format(step), 'w') as summary_file:
+            json.dump(summary, summary_file, indent = 2, sort_keys = True)
+        with open(self.log_directory + '/profile_{}.txt'.format(step), 'w') as summary_file:
+            summary_file.write(format_scope_summary(summary) + '\n')
@@ -0,0 +1,81 @@
+import numpy as np
+import argparse
+import json
+import os
+from evaluation_utils import *
+
+# The manifest indexes everything the Eigen evaluation needs per frame: paths, image sizes read
+# from the file headers and the calibration of each drive date, which is only parsed once.
+# Missing frames are skipped, every frame keeps the index of its line in the test files, which
+# is also the index of its prediction.
+
+MANIFEST_VERSION = 1
+
+def build_manifest(test_files, data_root):
+    frames = []
+    calibrations = {}
+    for index, filename in enumerate(test_files):
+        filename = filename.split()[0]
+        splits = filename.split('/')
+        date = splits[0]
+        im_id = splits[4][:10]
+        camera_id = 2
+
+        im_file = data_root + filename
+        if not os.path.isfile(im_file):
+            print('{} missing'.format(im_file))
+            continue
+
+        calib_dir = data_root + date + '/'
+        if (calib_dir, camera_id) not in calibrations:
+            focal_length, baseline = get_focal_length_baseline(calib_dir, camera_id)
+            calibrations[(calib_dir, camera_id)] = {
+                'focal_length': float(focal_length),
+                'baseline': float(baseline),
+                'P_velo2im': velodyne_projection(calib_dir, camera_id).ravel().tolist()
+            }
+
+        height, width = image_size(im_file)
+        frame = {
+            'index': index,
+            'image': im_file,
+            'velodyne': data_root + '{}/{}/velodyne_points/data/{}.bin'.format(splits[0], splits[1], im_id),
+            'calib_dir': calib_dir,
+            'camera': camera_id,
+            'height': height,
+            'width': width
+        }
+        frame.update(calibrations[(calib_dir, camera_id)])
+        frames.append(frame)
+
+    print('{} files missing'.format(len(test_files) - len(frames)))
+    return {'version': MANIFEST_VERSION, 'data_root': data_root, 'test_files': test_files, 'frames': frames}
+
+def load_manifest(manifest_path, test_files, data_root):
+    """Loads the manifest of the test files, building it if missing or made for other files."""
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION and manifest['data_root'] == data_root and manifest['test_files'] == test_files:
+            return manifest
+
+    manifest = build_manifest(test_files, data_root)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+def projection_matrix(frame):
+    return np.array(frame['P_velo2im']).reshape(3, 4)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Builds the manifest of the Eigen test files')
+    parser.add_argument('--gt_path',       type=str, help='path to the KITTI raw data',  required=True)
+    parser.add_argument('--test_files',    type=str, help='test filenames, defaults to eigen_test_files.txt in gt_path', default='')
+    parser.add_argument('--manifest_path', type=str, help='path of the manifest',        required=True)
+
+    args = parser.parse_args()
+
+    test_files = read_text_lines(args.test_files or args.gt_path + 'eigen_test_files.txt')
+    manifest = load_manifest(args.manifest_path, test_files, args.gt_path)
+    print('{} frames indexed in {}'.format(len(manifest['frames']), args.manifest_path))
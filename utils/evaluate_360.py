@@ -0,0 +1,146 @@
+import numpy as np
+import cv2
+import argparse
+
+# Evaluation of equirectangular predictions. Every pixel is weighted by the solid angle it
+# covers, cos(latitude), so that the stretched rows near the poles do not dominate the metrics.
+# The predictions and ground truth are memory-mapped and evaluated in batches of frames.
+
+metric_names = ['abs_rel', 'sq_rel', 'rms', 'log_rms', 'a1', 'a2', 'a3']
+
+# baseline between the top and bottom cameras used by MonodepthModel.depth_to_disparity
+baseline_distance = 0.5
+
+def lat_long_grid(shape, epsilon = 1.0e-12):
+    # same grid as spherical.lat_long_grid
+    return np.meshgrid(np.linspace(-np.pi, np.pi, shape[1]),
+                       np.linspace(-np.pi / 2.0 + epsilon, np.pi / 2.0 - epsilon, shape[0]))
+
+def solid_angle_weights(shape):
+    _, T = lat_long_grid(shape)
+    return np.cos(T)
+
+def depth_to_disparity(depth, position = "top", disparity_scale = 1.0):
+    # vertical disparity of depth maps of shape [batch, height, width], as MonodepthModel.depth_to_disparity
+    _, T = lat_long_grid(depth.shape[1:])
+    tan_T = np.tan(T)
+    if position == "top":
+        y = (1.0 + tan_T ** 2.0) * (depth ** 2.0) - baseline_distance * depth * tan_T
+    else:
+        y = (1.0 + tan_T ** 2.0) * (depth ** 2.0) + baseline_distance * depth * tan_T
+    return disparity_scale * (np.arctan2(y, baseline_distance * depth) - np.pi / 2)
+
+def disparity_to_depth(disparity, position = "top", disparity_scale = 1.0, epsilon = 1e-6):
+    # inverse of depth_to_disparity, the angle of the disparity is in (-pi / 2, pi / 2)
+    # for positive depths, where tan(angle) = (depth / cos(T) ** 2 -+ baseline * tan(T)) / baseline
+    _, T = lat_long_grid(disparity.shape[1:])
+    angle = np.clip(disparity / disparity_scale + np.pi / 2, -np.pi / 2 + epsilon, np.pi / 2 - epsilon)
+    if position == "top":
+        depth = baseline_distance * (np.tan(angle) + np.tan(T)) * np.cos(T) ** 2
+    else:
+        depth = baseline_distance * (np.tan(angle) - np.tan(T)) * np.cos(T) ** 2
+    return np.maximum(depth, 0)
+
+def evaluation_mask(shape, mask_path = '', pole_latitude = 90.0):
+    # pixels covered by the rig in the mask image and pixels closer to the poles than
+    # pole_latitude degrees are excluded
+    mask = np.ones(shape, bool)
+    if mask_path != '':
+        if mask_path.endswith('.npy'):
+            rig_mask = np.load(mask_path)
+        else:
+            rig_mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+        rig_mask = cv2.resize(rig_mask.astype(np.uint8), (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+        mask = np.logical_and(mask, rig_mask > 0)
+    _, T = lat_long_grid(shape)
+    return np.logical_and(mask, np.abs(T) <= np.radians(pole_latitude))
+
+def resize_batch(images, shape):
+    if images.shape[1:] == tuple(shape):
+        return images
+    return np.stack([cv2.resize(image, (shape[1], shape[0]), interpolation=cv2.INTER_LINEAR) for image in images])
+
+def weighted_errors(gt, pred, weights):
+    # per frame metrics of a batch, weights is zero outside the evaluated pixels
+    total = np.maximum(weights.sum(axis=(1, 2)), 1e-12)
+    mean = lambda x: (weights * x).sum(axis=(1, 2)) / total
+
+    valid = weights > 0
+    gt = np.where(valid, gt, 1.0)
+    pred = np.where(valid, pred, 1.0)
+    thresh = np.maximum((gt / pred), (pred / gt))
+
+    return {
+        'abs_rel': mean(np.abs(gt - pred) / gt),
+        'sq_rel': mean(((gt - pred) ** 2) / gt),
+        'rms': np.sqrt(mean((gt - pred) ** 2)),
+        'log_rms': np.sqrt(mean((np.log(gt) - np.log(pred)) ** 2)),
+        'a1': mean(thresh < 1.25),
+        'a2': mean(thresh < 1.25 ** 2),
+        'a3': mean(thresh < 1.25 ** 3)
+    }
+
+def evaluate(predicted_path, gt_path, min_depth = 1e-3, max_depth = 80, prediction_type = 'disparity', gt_type = 'depth',
+             disparity_scale = 1.0, mask_path = '', pole_latitude = 90.0, batch_size = 16):
+    """Evaluates equirectangular predictions against ground truth and returns the mean of every metric.
+
+    Both are [frames, height, width] .npy files, the predictions are resized to the ground truth.
+    The metrics of every frame are weighted by solid angle and then averaged over the frames.
+    """
+    predictions = np.load(predicted_path, mmap_mode='r')
+    gt_maps = np.load(gt_path, mmap_mode='r')
+    num_samples, gt_height, gt_width = gt_maps.shape
+    assert len(predictions) == num_samples, 'found {} predictions for {} ground truth frames'.format(len(predictions), num_samples)
+
+    weights = solid_angle_weights((gt_height, gt_width)) * evaluation_mask((gt_height, gt_width), mask_path, pole_latitude)
+
+    sums = dict((name, 0.0) for name in metric_names)
+    for start in range(0, num_samples, batch_size):
+        pred = np.array(predictions[start:start + batch_size], np.float32)
+        if prediction_type == 'disparity':
+            pred = disparity_to_depth(pred, "top", disparity_scale)
+        pred = resize_batch(pred, (gt_height, gt_width))
+
+        gt = np.array(gt_maps[start:start + batch_size], np.float32)
+        if gt_type == 'disparity':
+            gt = disparity_to_depth(gt, "top", disparity_scale)
+
+        pred = np.clip(pred, min_depth, max_depth)
+        valid = np.logical_and(gt > min_depth, gt < max_depth)
+        metrics = weighted_errors(gt, pred, weights * valid)
+        for name in metric_names:
+            sums[name] += metrics[name].sum()
+
+    return dict((name, sums[name] / num_samples) for name in metric_names)
+
+def checkpoint_disparity_scale(checkpoint_path):
+    # the disparity scale is a trained variable of the model
+    import tensorflow as tf
+    return float(tf.train.NewCheckpointReader(checkpoint_path).get_tensor('model/scaling/disparity_scale')[0])
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Evaluation of equirectangular depth predictions')
+    parser.add_argument('--predicted_path',  type=str,   help='path to the predicted disparities or depths',   required=True)
+    parser.add_argument('--gt_path',         type=str,   help='path to the ground truth depths or disparities', required=True)
+    parser.add_argument('--prediction_type', type=str,   help='disparity or depth',                             default='disparity')
+    parser.add_argument('--gt_type',         type=str,   help='depth or disparity',                             default='depth')
+    parser.add_argument('--min_depth',       type=float, help='minimum depth for evaluation',                   default=1e-3)
+    parser.add_argument('--max_depth',       type=float, help='maximum depth for evaluation',                   default=80)
+    parser.add_argument('--disparity_scale', type=float, help='disparity scale of the model',                   default=1.0)
+    parser.add_argument('--checkpoint_path', type=str,   help='if set, reads the disparity scale from the checkpoint', default='')
+    parser.add_argument('--mask_path',       type=str,   help='if set, image or .npy mask of the evaluated pixels, zero on the rig', default='')
+    parser.add_argument('--pole_latitude',   type=float, help='pixels above this latitude in degrees are not evaluated', default=90.0)
+    parser.add_argument('--batch_size',      type=int,   help='number of frames evaluated together',            default=16)
+
+    args = parser.parse_args()
+
+    disparity_scale = args.disparity_scale
+    if args.checkpoint_path != '':
+        disparity_scale = checkpoint_disparity_scale(args.checkpoint_path)
+
+    results = evaluate(args.predicted_path, args.gt_path, args.min_depth, args.max_depth, args.prediction_type, args.gt_type,
+                       disparity_scale, args.mask_path, args.pole_latitude, args.batch_size)
+
+    print("{:>10}, {:>10}, {:>10}, {:>10}, {:>10}, {:>10}, {:>10}".format(*metric_names))
+    print("{:10.4f}, {:10.4f}, {:10.3f}, {:10.3f}, {:10.3f}, {:10.3f}, {:10.3f}".format(*[results[name] for name in metric_names]))
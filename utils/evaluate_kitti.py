@@ -1,100 +1,181 @@
 import numpy as np
-import cv, cv2
+import cv2
 import argparse
+import multiprocessing
 from evaluation_utils import *
-
-parser = argparse.ArgumentParser(description='Evaluation on the KITTI dataset')
-parser.add_argument('--split',               type=str,   help='data split, kitti or eigen',         required=True)
-parser.add_argument('--predicted_disp_path', type=str,   help='path to estimated disparities',      required=True)
-parser.add_argument('--gt_path',             type=str,   help='path to ground truth disparities',   required=True)
-parser.add_argument('--min_depth',           type=float, help='minimum depth for evaluation',        default=1e-3)
-parser.add_argument('--max_depth',           type=float, help='maximum depth for evaluation',        default=80)
-parser.add_argument('--eigen_crop',                      help='if set, crops according to Eigen NIPS14',   action='store_true')
-parser.add_argument('--garg_crop',                       help='if set, crops according to Garg  ECCV16',   action='store_true')
-
-args = parser.parse_args()
+from eval_manifest import build_manifest, load_manifest, projection_matrix
+from gt_cache import GTCache, cache_directory, crop_bounds, load_gt_cache
+
+metric_names = ['abs_rel', 'sq_rel', 'rms', 'log_rms', 'd1_all', 'a1', 'a2', 'a3']
+
+class MetricAccumulator(object):
+    """Running sums of the per sample metrics, the results are their means over the samples."""
+
+    def __init__(self):
+        self.sums = dict((name, 0.0) for name in metric_names)
+        self.count = 0
+
+    def add(self, metrics):
+        for name in metric_names:
+            self.sums[name] += metrics[name]
+        self.count += 1
+
+    def means(self):
+        return dict((name, self.sums[name] / max(self.count, 1)) for name in metric_names)
+
+# Every worker memory-maps the predictions and opens the ground truth cache once.
+worker_state = {}
+
+def init_worker(predicted_disp_path, gt_cache_path, min_depth, max_depth, crop):
+    worker_state['pred_disparities'] = np.load(predicted_disp_path, mmap_mode='r')
+    worker_state['gt_cache'] = GTCache(gt_cache_path) if gt_cache_path != '' else None
+    worker_state['min_depth'] = min_depth
+    worker_state['max_depth'] = max_depth
+    worker_state['crop'] = crop
+
+def sample_metrics(gt_depth, pred_depth, mask, d1_all = 0.0):
+    abs_rel, sq_rel, rms, log_rms, a1, a2, a3 = compute_errors(gt_depth[mask], pred_depth[mask])
+    return {'abs_rel': abs_rel, 'sq_rel': sq_rel, 'rms': rms, 'log_rms': log_rms, 'd1_all': d1_all, 'a1': a1, 'a2': a2, 'a3': a3}
+
+def evaluate_kitti_sample(task):
+    i, gt_file = task
+    gt_cache = worker_state['gt_cache']
+    if gt_cache is not None:
+        gt_disp = gt_cache.dense(i)
+    else:
+        gt_disp = cv2.imread(gt_file, -1).astype(np.float32) / 256
+
+    pred_disp = np.array(worker_state['pred_disparities'][i])
+    gt_depth, pred_depth, pred_disp = convert_disp_to_depth_kitti(gt_disp, pred_disp)
+
+    pred_depth[pred_depth < worker_state['min_depth']] = worker_state['min_depth']
+    pred_depth[pred_depth > worker_state['max_depth']] = worker_state['max_depth']
+
+    mask = gt_disp > 0
+    disp_diff = np.abs(gt_disp[mask] - pred_disp[mask])
+    bad_pixels = np.logical_and(disp_diff >= 3, (disp_diff / gt_disp[mask]) >= 0.05)
+    d1_all = 100.0 * bad_pixels.sum() / mask.sum()
+
+    return sample_metrics(gt_depth, pred_depth, mask, d1_all)
+
+def eigen_gt_depth(frame):
+    im_size = (frame['height'], frame['width'])
+    return generate_depth_map(frame['calib_dir'], frame['velodyne'], im_size, frame['camera'], False, True, projection_matrix(frame)).astype(np.float32)
+
+def evaluate_eigen_sample(task):
+    t_id, frame = task
+    gt_cache = worker_state['gt_cache']
+    if gt_cache is not None:
+        gt_depth = gt_cache.dense(t_id)
+    else:
+        gt_depth = eigen_gt_depth(frame)
+
+    # t_id indexes the evaluated frames and their cached ground truth, missing frames keep the
+    # prediction of their test file line
+    disp_pred = cv2.resize(np.array(worker_state['pred_disparities'][frame['index']]), (frame['width'], frame['height']), interpolation=cv2.INTER_LINEAR)
+    disp_pred = disp_pred * disp_pred.shape[1]
+
+    # need to convert from disparity to depth
+    pred_depth = (frame['baseline'] * frame['focal_length']) / disp_pred
+    pred_depth[np.isinf(pred_depth)] = 0
+
+    min_depth, max_depth = worker_state['min_depth'], worker_state['max_depth']
+    pred_depth[pred_depth < min_depth] = min_depth
+    pred_depth[pred_depth > max_depth] = max_depth
+
+    mask = np.logical_and(gt_depth > min_depth, gt_depth < max_depth)
+    if worker_state['crop'] != 'none':
+        gt_height, gt_width = gt_depth.shape
+        bounds = crop_bounds(worker_state['crop'], gt_height, gt_width)
+
+        crop_mask = np.zeros(mask.shape)
+        crop_mask[bounds[0]:bounds[1],bounds[2]:bounds[3]] = 1
+        mask = np.logical_and(mask, crop_mask)
+
+    return sample_metrics(gt_depth, pred_depth, mask)
+
+def evaluate(split, predicted_disp_path, gt_path, min_depth=1e-3, max_depth=80, crop='none', gt_cache='', num_workers=None, manifest_path=''):
+    """Evaluates the disparities of a split and returns the mean of every metric.
+
+    The predictions are memory-mapped and the samples are evaluated by a pool of num_workers
+    processes, all CPUs by default or in this process if 0. Only the running sums are kept.
+    The Eigen frames are indexed by the manifest at manifest_path if set.
+    """
+    if split == 'kitti':
+        num_samples = 200
+        num_predictions = num_samples
+        gt_files = [gt_path + "/training/disp_noc_0/" + str(i).zfill(6) + "_10.png" for i in range(num_samples)]
+        tasks = [(i, gt_files[i]) for i in range(num_samples)]
+        evaluate_sample = evaluate_kitti_sample
+
+        source_files = [[gt_file] for gt_file in gt_files]
+        cache_crop = 'none'
+        compute_gt = lambda i: cv2.imread(gt_files[i], -1).astype(np.float32) / 256
+
+    elif split == 'eigen':
+        test_files = read_text_lines(gt_path + 'eigen_test_files.txt')
+        if manifest_path != '':
+            frames = load_manifest(manifest_path, test_files, gt_path)['frames']
+        else:
+            frames = build_manifest(test_files, gt_path)['frames']
+        num_samples = len(frames)
+        num_predictions = len(test_files)
+        tasks = [(t_id, frames[t_id]) for t_id in range(num_samples)]
+        evaluate_sample = evaluate_eigen_sample
+
+        source_files = [[frame['velodyne'], frame['calib_dir'] + 'calib_cam_to_cam.txt', frame['calib_dir'] + 'calib_velo_to_cam.txt'] for frame in frames]
+        cache_crop = crop
+        compute_gt = lambda t_id: eigen_gt_depth(frames[t_id])
+
+    # predictions are read by index, a file of another split or length would be scored against the wrong frames
+    predictions_shape = np.load(predicted_disp_path, mmap_mode='r').shape
+    if predictions_shape[0] != num_predictions:
+        raise ValueError('{} holds {} predictions, the {} split has {}'.format(predicted_disp_path, predictions_shape[0], split, num_predictions))
+
+    gt_cache_path = ''
+    if gt_cache != '':
+        load_gt_cache(gt_cache, split, cache_crop, source_files, compute_gt)
+        gt_cache_path = cache_directory(gt_cache, split, cache_crop, source_files)
+
+    initargs = (predicted_disp_path, gt_cache_path, min_depth, max_depth, crop)
+    accumulator = MetricAccumulator()
+    if num_workers == 0:
+        init_worker(*initargs)
+        for task in tasks:
+            accumulator.add(evaluate_sample(task))
+    else:
+        pool = multiprocessing.Pool(num_workers, init_worker, initargs)
+        for metrics in pool.imap_unordered(evaluate_sample, tasks, chunksize=4):
+            accumulator.add(metrics)
+        pool.close()
+        pool.join()
+
+    return accumulator.means()
 
 if __name__ == '__main__':
 
-    pred_disparities = np.load(args.predicted_disp_path)
-
-    if args.split == 'kitti':
-        num_samples = 200
-        
-        gt_disparities = load_gt_disp_kitti(args.gt_path)
-        gt_depths, pred_depths, pred_disparities_resized = convert_disps_to_depths_kitti(gt_disparities, pred_disparities)
-
-    elif args.split == 'eigen':
-        num_samples = 697
-        test_files = read_text_lines(args.gt_path + 'eigen_test_files.txt')
-        gt_files, gt_calib, im_sizes, im_files, cams = read_file_data(test_files, args.gt_path)
-
-        num_test = len(im_files)
-        gt_depths = []
-        pred_depths = []
-        for t_id in range(num_samples):
-            camera_id = cams[t_id]  # 2 is left, 3 is right
-            depth = generate_depth_map(gt_calib[t_id], gt_files[t_id], im_sizes[t_id], camera_id, False, True)
-            gt_depths.append(depth.astype(np.float32))
-
-            disp_pred = cv2.resize(pred_disparities[t_id], (im_sizes[t_id][1], im_sizes[t_id][0]), interpolation=cv2.INTER_LINEAR)
-            disp_pred = disp_pred * disp_pred.shape[1]
-
-            # need to convert from disparity to depth
-            focal_length, baseline = get_focal_length_baseline(gt_calib[t_id], camera_id)
-            depth_pred = (baseline * focal_length) / disp_pred
-            depth_pred[np.isinf(depth_pred)] = 0
-
-            pred_depths.append(depth_pred)
-
-    rms     = np.zeros(num_samples, np.float32)
-    log_rms = np.zeros(num_samples, np.float32)
-    abs_rel = np.zeros(num_samples, np.float32)
-    sq_rel  = np.zeros(num_samples, np.float32)
-    d1_all  = np.zeros(num_samples, np.float32)
-    a1      = np.zeros(num_samples, np.float32)
-    a2      = np.zeros(num_samples, np.float32)
-    a3      = np.zeros(num_samples, np.float32)
-    
-    for i in range(num_samples):
-        
-        gt_depth = gt_depths[i]
-        pred_depth = pred_depths[i]
-
-        pred_depth[pred_depth < args.min_depth] = args.min_depth
-        pred_depth[pred_depth > args.max_depth] = args.max_depth
-
-        if args.split == 'eigen':
-            mask = np.logical_and(gt_depth > args.min_depth, gt_depth < args.max_depth)
-
-            
-            if args.garg_crop or args.eigen_crop:
-                gt_height, gt_width = gt_depth.shape
-
-                # crop used by Garg ECCV16
-                # if used on gt_size 370x1224 produces a crop of [-218, -3, 44, 1180]
-                if args.garg_crop:
-                    crop = np.array([0.40810811 * gt_height,  0.99189189 * gt_height,   
-                                     0.03594771 * gt_width,   0.96405229 * gt_width]).astype(np.int32)
-                # crop we found by trial and error to reproduce Eigen NIPS14 results
-                elif args.eigen_crop:
-                    crop = np.array([0.3324324 * gt_height,  0.91351351 * gt_height,   
-                                     0.0359477 * gt_width,   0.96405229 * gt_width]).astype(np.int32)
-
-                crop_mask = np.zeros(mask.shape)
-                crop_mask[crop[0]:crop[1],crop[2]:crop[3]] = 1
-                mask = np.logical_and(mask, crop_mask)
-
-        if args.split == 'kitti':
-            gt_disp = gt_disparities[i]
-            mask = gt_disp > 0
-            pred_disp = pred_disparities_resized[i]
-
-            disp_diff = np.abs(gt_disp[mask] - pred_disp[mask])
-            bad_pixels = np.logical_and(disp_diff >= 3, (disp_diff / gt_disp[mask]) >= 0.05)
-            d1_all[i] = 100.0 * bad_pixels.sum() / mask.sum()
-
-        abs_rel[i], sq_rel[i], rms[i], log_rms[i], a1[i], a2[i], a3[i] = compute_errors(gt_depth[mask], pred_depth[mask])
+    parser = argparse.ArgumentParser(description='Evaluation on the KITTI dataset')
+    parser.add_argument('--split',               type=str,   help='data split, kitti or eigen',         required=True)
+    parser.add_argument('--predicted_disp_path', type=str,   help='path to estimated disparities',      required=True)
+    parser.add_argument('--gt_path',             type=str,   help='path to ground truth disparities',   required=True)
+    parser.add_argument('--min_depth',           type=float, help='minimum depth for evaluation',        default=1e-3)
+    parser.add_argument('--max_depth',           type=float, help='maximum depth for evaluation',        default=80)
+    parser.add_argument('--eigen_crop',                      help='if set, crops according to Eigen NIPS14',   action='store_true')
+    parser.add_argument('--garg_crop',                       help='if set, crops according to Garg  ECCV16',   action='store_true')
+    parser.add_argument('--gt_cache',            type=str,   help='if set, directory of the ground truth cache', default='')
+    parser.add_argument('--manifest_path',       type=str,   help='if set, path of the Eigen manifest, built if missing', default='')
+    parser.add_argument('--num_workers',         type=int,   help='number of evaluation processes, all CPUs by default, 0 to evaluate in this process', default=None)
+
+    args = parser.parse_args()
+
+    if args.garg_crop:
+        crop = 'garg'
+    elif args.eigen_crop:
+        crop = 'eigen'
+    else:
+        crop = 'none'
+
+    results = evaluate(args.split, args.predicted_disp_path, args.gt_path, args.min_depth, args.max_depth, crop, args.gt_cache, args.num_workers, args.manifest_path)
 
     print("{:>10}, {:>10}, {:>10}, {:>10}, {:>10}, {:>10}, {:>10}, {:>10}".format('abs_rel', 'sq_rel', 'rms', 'log_rms', 'd1_all', 'a1', 'a2', 'a3'))
-    print("{:10.4f}, {:10.4f}, {:10.3f}, {:10.3f}, {:10.3f}, {:10.3f}, {:10.3f}, {:10.3f}".format(abs_rel.mean(), sq_rel.mean(), rms.mean(), log_rms.mean(), d1_all.mean(), a1.mean(), a2.mean(), a3.mean()))
+    print("{:10.4f}, {:10.4f}, {:10.3f}, {:10.3f}, {:10.3f}, {:10.3f}, {:10.3f}, {:10.3f}".format(*[results[name] for name in metric_names]))
@@ -0,0 +1,116 @@
+import numpy as np
+import argparse
+import time
+from collections import Counter
+from evaluation_utils import *
+
+parser = argparse.ArgumentParser(description='Benchmark of the velodyne depth map generation')
+parser.add_argument('--benchmark',      type=str,   help='duplicates or interp',                                          default='duplicates')
+parser.add_argument('--num_points',     type=int,   help='number of projected points per frame',                          default=30000)
+parser.add_argument('--num_frames',     type=int,   help='number of frames',                                              default=20)
+parser.add_argument('--gt_path',        type=str,   help='path to the KITTI raw data, if set uses the Eigen test frames',  default='')
+parser.add_argument('--holdout',        type=float, help='fraction of the points held out to measure the interp accuracy', default=0.1)
+parser.add_argument('--batch_size',     type=int,   help='number of frames densified together',                           default=8)
+
+args = parser.parse_args()
+
+def reference_depth_image(velo_pts_im, im_shape):
+    # per duplicate implementation previously used by generate_depth_map
+    depth = np.zeros((im_shape))
+    depth[velo_pts_im[:, 1].astype(int), velo_pts_im[:, 0].astype(int)] = velo_pts_im[:, 2]
+
+    inds = sub2ind(depth.shape, velo_pts_im[:, 1], velo_pts_im[:, 0])
+    dupe_inds = [item for item, count in Counter(inds).items() if count > 1]
+    for dd in dupe_inds:
+        pts = np.where(inds==dd)[0]
+        x_loc = int(velo_pts_im[pts[0], 0])
+        y_loc = int(velo_pts_im[pts[0], 1])
+        depth[y_loc, x_loc] = velo_pts_im[pts, 2].min()
+    depth[depth<0] = 0
+    return depth
+
+def random_frame(num_points, im_shape):
+    # velodyne points are denser towards the horizon, which produces many duplicate pixels
+    x = np.round(np.random.uniform(0, im_shape[1] - 1, num_points))
+    y = np.round(np.clip(np.random.normal(0.45 * im_shape[0], 0.1 * im_shape[0], num_points), 0, im_shape[0] - 1))
+    d = np.random.uniform(1, 80, num_points)
+    return np.stack([x, y, d, np.ones(num_points)], 1)
+
+def eigen_frames(gt_path, num_frames):
+    test_files = read_text_lines(gt_path + 'eigen_test_files.txt')[:num_frames]
+    gt_files, gt_calib, im_sizes, im_files, cams = read_file_data(test_files, gt_path)
+    frames = []
+    for t_id in range(len(gt_files)):
+        velo_pts_im = project_velodyne_points(gt_calib[t_id], gt_files[t_id], im_sizes[t_id], cams[t_id], True)
+        frames.append((velo_pts_im, im_sizes[t_id]))
+    return frames
+
+def holdout_errors(dense, velo_pts_im):
+    # abs rel and rms errors at the held out points covered by the dense map
+    pred = dense[velo_pts_im[:, 1].astype(int), velo_pts_im[:, 0].astype(int)]
+    gt = velo_pts_im[:, 2]
+    valid = np.logical_and(pred > 0, gt > 0)
+    return np.abs(pred[valid] - gt[valid]) / gt[valid], (pred[valid] - gt[valid]) ** 2, valid.mean()
+
+def interp_benchmark(frames):
+    # the held out points are removed before densifying and used as ground truth
+    inputs, heldout = [], []
+    for velo_pts_im, im_shape in frames:
+        is_heldout = np.random.uniform(size=len(velo_pts_im)) < args.holdout
+        inputs.append((velo_pts_im[~is_heldout], im_shape))
+        heldout.append(velo_pts_im[is_heldout])
+
+    timings = {}
+    outputs = {}
+    for method in ['linear', 'nearest']:
+        start_time = time.time()
+        outputs[method] = []
+        for b in range(0, len(inputs), args.batch_size):
+            batch = inputs[b:b + args.batch_size]
+            depths = [velodyne_depth_image(velo_pts_im, im_shape) for velo_pts_im, im_shape in batch]
+            outputs[method] += densify_depth_maps(depths, [velo_pts_im for velo_pts_im, _ in batch], method)
+        timings[method] = (time.time() - start_time) / len(frames)
+
+    print("{} frames, {:.0%} of the points held out".format(len(frames), args.holdout))
+    print("{:>10}, {:>14}, {:>10}, {:>10}, {:>10}".format('', 'per frame (ms)', 'abs_rel', 'rms', 'coverage'))
+    for method in ['linear', 'nearest']:
+        errors = [holdout_errors(dense, velo_pts_im) for dense, velo_pts_im in zip(outputs[method], heldout)]
+        abs_rel = np.concatenate([e[0] for e in errors]).mean()
+        rms = np.sqrt(np.concatenate([e[1] for e in errors]).mean())
+        coverage = np.mean([e[2] for e in errors])
+        print("{:>10}, {:14.3f}, {:10.4f}, {:10.3f}, {:10.3f}".format(method, 1e3 * timings[method], abs_rel, rms, coverage))
+
+    # agreement of the two methods where the triangulation is defined
+    diffs = [np.abs(linear - nearest)[linear > 0] for linear, nearest in zip(outputs['linear'], outputs['nearest'])]
+    print("mean difference between the methods {:.3f}m".format(np.concatenate(diffs).mean()))
+    print("speedup {:.1f}x".format(timings['linear'] / timings['nearest']))
+
+def duplicates_benchmark(frames):
+    timings = {}
+    outputs = {}
+    for name, function in [('reference', reference_depth_image), ('vectorised', velodyne_depth_image)]:
+        start_time = time.time()
+        outputs[name] = [function(velo_pts_im, im_shape) for velo_pts_im, im_shape in frames]
+        timings[name] = (time.time() - start_time) / len(frames)
+
+    identical = all(np.array_equal(reference, vectorised) for reference, vectorised in zip(outputs['reference'], outputs['vectorised']))
+    num_points = np.mean([len(velo_pts_im) for velo_pts_im, _ in frames])
+
+    print("{} frames, {:.0f} points per frame, identical outputs: {}".format(len(frames), num_points, identical))
+    print("{:>12}, {:>14}".format('', 'per frame (ms)'))
+    for name in ['reference', 'vectorised']:
+        print("{:>12}, {:14.3f}".format(name, 1e3 * timings[name]))
+    print("speedup {:.1f}x".format(timings['reference'] / timings['vectorised']))
+
+if __name__ == '__main__':
+
+    if args.gt_path != '':
+        frames = eigen_frames(args.gt_path, args.num_frames)
+    else:
+        im_shape = (375, 1242)
+        frames = [(random_frame(args.num_points, im_shape), im_shape) for _ in range(args.num_frames)]
+
+    if args.benchmark == 'interp':
+        interp_benchmark(frames)
+    else:
+        duplicates_benchmark(frames)
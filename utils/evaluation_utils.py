@@ -1,9 +1,11 @@
 import numpy as np
 import pandas as pd
 import os
-import cv, cv2
-from collections import Counter
+import struct
+import cv2
 import pickle
+from scipy.interpolate import LinearNDInterpolator
+from scipy.ndimage import distance_transform_edt
 
 def compute_errors(gt, pred):
     thresh = np.maximum((gt / pred), (pred / gt))
@@ -40,27 +42,29 @@ def load_gt_disp_kitti(path):
         gt_disparities.append(disp)
     return gt_disparities
 
+def convert_disp_to_depth_kitti(gt_disp, pred_disp):
+    height, width = gt_disp.shape
+
+    pred_disp = width * cv2.resize(pred_disp, (width, height), interpolation=cv2.INTER_LINEAR)
+
+    mask = gt_disp > 0
+
+    gt_depth = width_to_focal[width] * 0.54 / (gt_disp + (1.0 - mask))
+    pred_depth = width_to_focal[width] * 0.54 / pred_disp
+
+    return gt_depth, pred_depth, pred_disp
+
 def convert_disps_to_depths_kitti(gt_disparities, pred_disparities):
     gt_depths = []
     pred_depths = []
     pred_disparities_resized = []
     
     for i in range(len(gt_disparities)):
-        gt_disp = gt_disparities[i]
-        height, width = gt_disp.shape
-
-        pred_disp = pred_disparities[i]
-        pred_disp = width * cv2.resize(pred_disp, (width, height), interpolation=cv2.INTER_LINEAR)
-
-        pred_disparities_resized.append(pred_disp) 
-
-        mask = gt_disp > 0
-
-        gt_depth = width_to_focal[width] * 0.54 / (gt_disp + (1.0 - mask))
-        pred_depth = width_to_focal[width] * 0.54 / pred_disp
+        gt_depth, pred_depth, pred_disp = convert_disp_to_depth_kitti(gt_disparities[i], pred_disparities[i])
 
         gt_depths.append(gt_depth)
         pred_depths.append(pred_depth)
+        pred_disparities_resized.append(pred_disp) 
     return gt_depths, pred_depths, pred_disparities_resized
 
 
@@ -95,13 +99,13 @@ def read_file_data(files, data_root):
         if os.path.isfile(data_root + im):
             gt_files.append(data_root + vel)
             gt_calib.append(data_root + date + '/')
-            im_sizes.append(cv2.imread(data_root + im).shape[:2])
+            im_sizes.append(image_size(data_root + im))
             im_files.append(data_root + im)
             cams.append(2)
         else:
             num_probs += 1
             print('{} missing'.format(data_root + im))
-    print num_probs, 'files missing'
+    print('{} files missing'.format(num_probs))
 
     return gt_files, gt_calib, im_sizes, im_files, cams
 
@@ -122,8 +126,67 @@ def lin_interp(shape, xyd):
     disparity = f(IJ).reshape(shape)
     return disparity
 
+def nearest_interp(depths, max_distance=None):
+    # fills every pixel of a batch of sparse depth maps with the depth of the closest point,
+    # using a single distance transform on the stacked maps. The frames are placed further
+    # apart than any pixel distance within a frame so that they do not fill each other.
+    num_frames, m, n = depths.shape
+    empty = depths == 0
+    distances, indices = distance_transform_edt(empty, sampling=(m + n, 1, 1), return_indices=True)
+    dense = depths[tuple(indices)]
+
+    # pixels far from any point are left empty, as outside the triangulation of lin_interp
+    if max_distance is not None:
+        dense[distances > max_distance] = 0
+    dense[~np.any(depths > 0, axis=(1, 2))] = 0
+    return dense
+
+def densify_depth_maps(depths, velo_pts_ims, method='linear'):
+    # depths is a list of sparse depth maps and velo_pts_ims their points,
+    # with 'nearest' the maps of the same size are densified together
+    if method == 'linear':
+        return [lin_interp(depth.shape, velo_pts_im) for depth, velo_pts_im in zip(depths, velo_pts_ims)]
+    elif method == 'nearest':
+        dense = [None] * len(depths)
+        shapes = [depth.shape for depth in depths]
+        for shape in set(shapes):
+            inds = [i for i in range(len(depths)) if shapes[i] == shape]
+            for i, dense_depth in zip(inds, nearest_interp(np.stack([depths[i] for i in inds]))):
+                dense[i] = dense_depth
+        return dense
+    raise ValueError('unknown interpolation method {}'.format(method))
+
+
+def image_size(path):
+    # reads (height, width) from the PNG or JPEG header without decoding the image
+    with open(path, 'rb') as f:
+        header = f.read(24)
+        if header[:8] == b'\x89PNG\r\n\x1a\n':
+            width, height = struct.unpack('>II', header[16:24])
+            return int(height), int(width)
+        if header[:2] == b'\xff\xd8':
+            f.seek(2)
+            segment = f.read(4)
+            while len(segment) == 4:
+                _, code, length = struct.unpack('>BBH', segment)
+                # start of frame markers, DHT, JPG and DAC share the range
+                if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+                    height, width = struct.unpack('>xHH', f.read(5))
+                    return int(height), int(width)
+                f.seek(length - 2, 1)
+                segment = f.read(4)
+    # unknown format, decode the image
+    return cv2.imread(path).shape[:2]
+
+# calibration files are shared by all the frames of a drive date, they are only parsed once
+calib_files = {}
 
 def read_calib_file(path):
+    if path not in calib_files:
+        calib_files[path] = parse_calib_file(path)
+    return calib_files[path]
+
+def parse_calib_file(path):
     # taken from https://github.com/hunse/kitti
     float_chars = set("0123456789.e+- ")
     data = {}
@@ -135,7 +198,7 @@ def read_calib_file(path):
             if float_chars.issuperset(value):
                 # try to cast to float array
                 try:
-                    data[key] = np.array(map(float, value.split(' ')))
+                    data[key] = np.array(list(map(float, value.split(' '))))
                 except ValueError:
                     # casting error: data[key] already eq. value, so pass
                     pass
@@ -166,7 +229,25 @@ def sub2ind(matrixSize, rowSub, colSub):
     m, n = matrixSize
     return rowSub * (n-1) + colSub - 1
 
-def generate_depth_map(calib_dir, velo_file_name, im_shape, cam=2, interp=False, vel_depth=False):
+def velodyne_depth_image(velo_pts_im, im_shape):
+    # project to image
+    depth = np.zeros((im_shape))
+    depth[velo_pts_im[:, 1].astype(int), velo_pts_im[:, 0].astype(int)] = velo_pts_im[:, 2]
+
+    # find the duplicate points and choose the closest depth
+    # points are grouped by sub2ind, as in the KITTI matlab code, and the depth is written at
+    # the location of the first point of each group
+    inds = sub2ind(depth.shape, velo_pts_im[:, 1], velo_pts_im[:, 0])
+    _, first_inds, group_inds, counts = np.unique(inds, return_index=True, return_inverse=True, return_counts=True)
+    min_depths = np.full(len(first_inds), np.inf)
+    np.minimum.at(min_depths, group_inds, velo_pts_im[:, 2])
+    dupes = counts > 1
+    first_pts = velo_pts_im[first_inds[dupes]]
+    depth[first_pts[:, 1].astype(int), first_pts[:, 0].astype(int)] = min_depths[dupes]
+    depth[depth<0] = 0
+    return depth
+
+def velodyne_projection(calib_dir, cam=2):
     # load calibration files
     cam2cam = read_calib_file(calib_dir + 'calib_cam_to_cam.txt')
     velo2cam = read_calib_file(calib_dir + 'calib_velo_to_cam.txt')
@@ -178,6 +259,11 @@ def generate_depth_map(calib_dir, velo_file_name, im_shape, cam=2, interp=False,
     R_cam2rect[:3,:3] = cam2cam['R_rect_00'].reshape(3,3)
     P_rect = cam2cam['P_rect_0'+str(cam)].reshape(3,4)
     P_velo2im = np.dot(np.dot(P_rect, R_cam2rect), velo2cam)
+    return P_velo2im
+
+def project_velodyne_points(calib_dir, velo_file_name, im_shape, cam=2, vel_depth=False, P_velo2im=None):
+    if P_velo2im is None:
+        P_velo2im = velodyne_projection(calib_dir, cam)
 
     # load velodyne points and remove all behind image plane (approximation)
     # each row of the velodyne data is forward, left, up, reflectance
@@ -198,24 +284,16 @@ def generate_depth_map(calib_dir, velo_file_name, im_shape, cam=2, interp=False,
     val_inds = (velo_pts_im[:, 0] >= 0) & (velo_pts_im[:, 1] >= 0)
     val_inds = val_inds & (velo_pts_im[:,0] < im_shape[1]) & (velo_pts_im[:,1] < im_shape[0])
     velo_pts_im = velo_pts_im[val_inds, :]
+    return velo_pts_im
 
-    # project to image
-    depth = np.zeros((im_shape))
-    depth[velo_pts_im[:, 1].astype(np.int), velo_pts_im[:, 0].astype(np.int)] = velo_pts_im[:, 2]
-
-    # find the duplicate points and choose the closest depth
-    inds = sub2ind(depth.shape, velo_pts_im[:, 1], velo_pts_im[:, 0])
-    dupe_inds = [item for item, count in Counter(inds).iteritems() if count > 1]
-    for dd in dupe_inds:
-        pts = np.where(inds==dd)[0]
-        x_loc = int(velo_pts_im[pts[0], 0])
-        y_loc = int(velo_pts_im[pts[0], 1])
-        depth[y_loc, x_loc] = velo_pts_im[pts, 2].min()
-    depth[depth<0] = 0
+def generate_depth_map(calib_dir, velo_file_name, im_shape, cam=2, interp=False, vel_depth=False, P_velo2im=None, interp_method='linear'):
+    velo_pts_im = project_velodyne_points(calib_dir, velo_file_name, im_shape, cam, vel_depth, P_velo2im)
+    depth = velodyne_depth_image(velo_pts_im, im_shape)
 
     if interp:
-        # interpolate the depth map to fill in holes
-        depth_interp = lin_interp(im_shape, velo_pts_im)
+        # interpolate the depth map to fill in holes, 'linear' triangulates the points and
+        # 'nearest' copies the closest point, which is much faster
+        depth_interp = densify_depth_maps([depth], [velo_pts_im], interp_method)[0]
         return depth, depth_interp
     else:
         return depth
@@ -1,42 +1,143 @@
-import os, random, sys
+import argparse
+import hashlib
+import json
+import os
+import cv2
+from multiprocessing.pool import Pool, ThreadPool
+from evaluation_utils import image_size
 
-data_path = sys.argv[1]
-output_path = sys.argv[2]
-train_path = output_path + "train_filenames.txt"
-test_path = output_path + "test_filenames.txt"
+# The manifest records the size and modification time of the top and bottom images of every
+# sample, so that a rescan only reads the headers of, or decodes, the new and changed pairs.
+# The train and test split is a hash of the sample name, samples keep their split as the data grows.
 
-if len(sys.argv) > 3:
-	random.seed(sys.argv[3])
-else:
-	random.seed(0)
+MANIFEST_VERSION = 1
 
-if len(sys.argv) > 4:
-	split_ratio = float(sys.argv[4])
-else:
-	split_ratio = 0.9
+def list_images(directory):
+    # the dataloader reads <name>.jpg from the top and bottom folders
+    return dict((os.path.splitext(entry.name)[0], entry.path) for entry in os.scandir(directory)
+                if entry.name.endswith('.jpg') and entry.is_file())
 
-# Find all top image filenames in input path.
-all_filenames = os.listdir(os.path.join(data_path, 'top'))
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
 
-if len(all_filenames) < 1:
-	exit(0)
+def pair_signatures(pair):
+    name, top_path, bottom_path = pair
+    return name, file_signature(top_path), file_signature(bottom_path)
 
-# Remove file extenstions and shuffle order.
-stripped_filenames = [os.path.splitext(filename)[0] for filename in all_filenames if os.path.isfile(os.path.join(data_path, 'bottom', filename))]
-random.shuffle(stripped_filenames)
+def check_pair(task):
+    # sizes are read from the headers, or from the decoded images if decode is set
+    name, top_path, bottom_path, decode = task
+    sizes = []
+    for path in [top_path, bottom_path]:
+        try:
+            if decode:
+                image = cv2.imread(path)
+                size = image.shape[:2] if image is not None else None
+            else:
+                size = image_size(path)
+        except Exception:
+            size = None
+        sizes.append(size)
 
-# Split into train and test sets.
-split_index = int(split_ratio * len(stripped_filenames))
-train_filenames = stripped_filenames[:split_index]
-test_filenames = stripped_filenames[(split_index + 1):]
+    if None in sizes:
+        return name, None, 'unreadable'
+    if sizes[0] != sizes[1]:
+        return name, list(sizes[0]), 'top {}x{} and bottom {}x{} differ'.format(sizes[0][1], sizes[0][0], sizes[1][1], sizes[1][0])
+    return name, list(sizes[0]), ''
 
-# Write training filenames.
-with open(train_path, 'w') as train_file:
-	train_file.write(train_filenames[0])
-	train_file.writelines('\n' + filename for filename in train_filenames[1:])
+def load_manifest(manifest_path):
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+    return {'version': MANIFEST_VERSION, 'samples': {}}
 
-# Write testing filenames.
-with open(test_path, 'w') as test_file:
-	test_file.write(test_filenames[0])
-	test_file.writelines('\n' + filename for filename in test_filenames[1:])
+def update_manifest(manifest, data_path, num_workers, verify = False):
+    """Rescans data_path and checks the pairs that are new, changed or, with verify, not yet decoded."""
+    top_images = list_images(os.path.join(data_path, 'top'))
+    bottom_images = list_images(os.path.join(data_path, 'bottom'))
+    pairs = [(name, top_images[name], bottom_images[name]) for name in top_images if name in bottom_images]
 
+    # stat calls are I/O bound and run in threads
+    thread_pool = ThreadPool(num_workers)
+    signatures = thread_pool.map(pair_signatures, pairs, chunksize=256)
+    thread_pool.close()
+
+    samples = manifest['samples']
+    tasks = []
+    updated = {}
+    for (name, top_path, bottom_path), (_, top_signature, bottom_signature) in zip(pairs, signatures):
+        sample = samples.get(name)
+        unchanged = sample is not None and sample['top'] == top_signature and sample['bottom'] == bottom_signature
+        if unchanged and (sample['decoded'] or not verify):
+            updated[name] = sample
+        else:
+            updated[name] = {'top': top_signature, 'bottom': bottom_signature, 'decoded': verify}
+            tasks.append((name, top_path, bottom_path, verify))
+
+    # header reads and decoding are CPU bound and run in processes
+    print('checking {} new or changed pairs out of {}'.format(len(tasks), len(pairs)))
+    if tasks:
+        pool = Pool(num_workers)
+        for name, size, error in pool.imap_unordered(check_pair, tasks, chunksize=64):
+            updated[name]['size'] = size
+            updated[name]['error'] = error
+        pool.close()
+        pool.join()
+
+    removed = len(set(samples) - set(updated))
+    if removed:
+        print('{} pairs removed'.format(removed))
+
+    manifest['samples'] = updated
+    return manifest
+
+def save_manifest(manifest, manifest_path):
+    # written to a temporary file first so that an interrupted scan keeps the previous manifest
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+def split_hash(name, seed):
+    return hashlib.sha1('{}:{}'.format(seed, name).encode('utf-8')).hexdigest()
+
+def split_filenames(manifest, seed, split_ratio):
+    # the hash orders the samples randomly and assigns each sample to the same split on every run
+    names = [name for name, sample in manifest['samples'].items() if sample['error'] == '']
+    hashes = dict((name, split_hash(name, seed)) for name in names)
+    names.sort(key=lambda name: hashes[name])
+    train_filenames = [name for name in names if int(hashes[name][:8], 16) < split_ratio * 16 ** 8]
+    test_filenames = [name for name in names if int(hashes[name][:8], 16) >= split_ratio * 16 ** 8]
+    return train_filenames, test_filenames
+
+def write_filenames(path, filenames):
+    with open(path, 'w') as f:
+        f.write('\n'.join(filenames))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Builds the manifest and the filenames files of a top and bottom panorama folder')
+    parser.add_argument('data_path',        type=str,   help='folder holding the top and bottom folders')
+    parser.add_argument('output_path',      type=str,   help='prefix of the train_filenames.txt and test_filenames.txt files')
+    parser.add_argument('seed',             type=str,   help='seed of the split',                  nargs='?', default='0')
+    parser.add_argument('split_ratio',      type=float, help='fraction of training samples',       nargs='?', default=0.9)
+    parser.add_argument('--manifest_path',  type=str,   help='path of the manifest, defaults to manifest.json in the output path', default='')
+    parser.add_argument('--num_workers',    type=int,   help='number of scanning threads and processes', default=None)
+    parser.add_argument('--verify',                     help='if set, decodes every image instead of reading its header', action='store_true')
+
+    args = parser.parse_args()
+
+    manifest_path = args.manifest_path or args.output_path + 'manifest.json'
+    manifest = update_manifest(load_manifest(manifest_path), args.data_path, args.num_workers, args.verify)
+    save_manifest(manifest, manifest_path)
+
+    for name, sample in sorted(manifest['samples'].items()):
+        if sample['error'] != '':
+            print('skipping {}: {}'.format(name, sample['error']))
+
+    train_filenames, test_filenames = split_filenames(manifest, args.seed, args.split_ratio)
+    write_filenames(args.output_path + 'train_filenames.txt', train_filenames)
+    write_filenames(args.output_path + 'test_filenames.txt', test_filenames)
+    print('{} training and {} test samples'.format(len(train_filenames), len(test_filenames)))
@@ -0,0 +1,108 @@
+import numpy as np
+import hashlib
+import json
+import os
+
+# Ground truth maps are sparse, each frame is stored as the flat indices and values of its
+# non zero pixels inside the evaluation crop. The arrays of all frames are concatenated in
+# memory-mappable .npy files and located with per frame offsets.
+
+CACHE_VERSION = 1
+
+def crop_bounds(crop, gt_height, gt_width):
+    # crop used by Garg ECCV16
+    # if used on gt_size 370x1224 produces a crop of [-218, -3, 44, 1180]
+    if crop == 'garg':
+        return np.array([0.40810811 * gt_height,  0.99189189 * gt_height,
+                         0.03594771 * gt_width,   0.96405229 * gt_width]).astype(np.int32)
+    # crop we found by trial and error to reproduce Eigen NIPS14 results
+    elif crop == 'eigen':
+        return np.array([0.3324324 * gt_height,  0.91351351 * gt_height,
+                         0.0359477 * gt_width,   0.96405229 * gt_width]).astype(np.int32)
+    return np.array([0, gt_height, 0, gt_width]).astype(np.int32)
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [path, stat.st_size, int(stat.st_mtime)]
+
+def cache_manifest(split, crop, source_files):
+    # source_files holds the list of files each ground truth frame is computed from
+    return {
+        'version': CACHE_VERSION,
+        'split': split,
+        'crop': crop,
+        'files': [[file_signature(path) for path in frame_files] for frame_files in source_files]
+    }
+
+def cache_directory(cache_root, split, crop, source_files):
+    files_hash = hashlib.sha1(json.dumps(source_files).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_root, '{}_{}_{}'.format(split, crop, files_hash))
+
+class GTCache(object):
+    """Memory-mapped ground truth maps of one split and crop."""
+
+    def __init__(self, path):
+        self.indices = np.load(os.path.join(path, 'indices.npy'), mmap_mode='r')
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.shapes = np.load(os.path.join(path, 'shapes.npy'))
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def sparse(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return np.asarray(self.indices[start:end]), np.asarray(self.values[start:end])
+
+    def dense(self, i):
+        indices, values = self.sparse(i)
+        gt = np.zeros(int(np.prod(self.shapes[i])), np.float32)
+        gt[indices] = values
+        return gt.reshape(self.shapes[i])
+
+def is_valid_cache(path, manifest):
+    manifest_path = os.path.join(path, 'manifest.json')
+    if not os.path.isfile(manifest_path):
+        return False
+    with open(manifest_path, 'r') as f:
+        return json.load(f) == manifest
+
+def build_gt_cache(path, manifest, num_frames, compute_gt):
+    # compute_gt(i) returns the dense ground truth map of frame i
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    # the manifest is written last, an interrupted build is never considered valid
+    manifest_path = os.path.join(path, 'manifest.json')
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+
+    indices, values, shapes = [], [], []
+    offsets = [0]
+    for i in range(num_frames):
+        gt = compute_gt(i)
+        bounds = crop_bounds(manifest['crop'], gt.shape[0], gt.shape[1])
+        crop_mask = np.zeros(gt.shape, bool)
+        crop_mask[bounds[0]:bounds[1], bounds[2]:bounds[3]] = True
+
+        frame_indices = np.flatnonzero(np.logical_and(gt > 0, crop_mask)).astype(np.int32)
+        indices.append(frame_indices)
+        values.append(gt.ravel()[frame_indices].astype(np.float32))
+        shapes.append(gt.shape)
+        offsets.append(offsets[-1] + len(frame_indices))
+
+    np.save(os.path.join(path, 'indices.npy'), np.concatenate(indices))
+    np.save(os.path.join(path, 'values.npy'), np.concatenate(values))
+    np.save(os.path.join(path, 'offsets.npy'), np.array(offsets, np.int64))
+    np.save(os.path.join(path, 'shapes.npy'), np.array(shapes, np.int32))
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+def load_gt_cache(cache_root, split, crop, source_files, compute_gt):
+    """Returns the cached ground truth, building it first if missing or out of date."""
+    path = cache_directory(cache_root, split, crop, source_files)
+    manifest = cache_manifest(split, crop, source_files)
+    if not is_valid_cache(path, manifest):
+        print('building ground truth cache {}'.format(path))
+        build_gt_cache(path, manifest, len(source_files), compute_gt)
+    return GTCache(path)